@@ -5,6 +5,12 @@ load_dotenv()  # Load environment variables from .env file
 configs = {
     # directories
     'BOOTSTRAP_DIR': 'data/bootstrap', 
+    'RAW_SNAPSHOT_DIR': 'data/raw_snapshot',
+    'PROFILE_DIR': 'data/profiles',
+    
+    # Analytics query-result cache: memory budget (0 disables) and optional Parquet spill directory
+    'QUERY_CACHE_MAX_MB': os.getenv('QUERY_CACHE_MAX_MB', '64'),
+    'QUERY_CACHE_SPILL_DIR': os.getenv('QUERY_CACHE_SPILL_DIR'),
     
     # Database configurations
     "MONGO_URI": os.getenv("MONGO_URI"),
@@ -14,5 +20,10 @@ configs = {
     "database": os.getenv("database"),
     "user": os.getenv("user"),
     "password": os.getenv("password"),
-    "port": os.getenv("port")
+    "port": os.getenv("port"),
+    
+    # MongoDB storage options
+    "MONGO_COMPRESSORS": os.getenv("MONGO_COMPRESSORS"),  # wire compression, e.g. "zstd,snappy"
+    "MONGO_BLOCK_COMPRESSOR": os.getenv("MONGO_BLOCK_COMPRESSOR"),  # events_raw block compressor: zstd, snappy, zlib or none
+    "EVENT_ID_FORMAT": os.getenv("EVENT_ID_FORMAT", "string"),  # 'binary' stores hex event_ids as BinData
 }
\ No newline at end of file
@@ -8,7 +8,7 @@ from src.pipeline import run_pipeline
     # Skip bootstrap, only load live events
     python src/main.py --skip-bootstrap
 
-    # Force reload bootstrap even if already loaded
+    # Force reload of every bootstrap file (by default only new or changed files are loaded)
     python src/main.py --force-rerun-bootstrap
 
     # Load only bootstrap data, skip live events
@@ -17,6 +17,36 @@ from src.pipeline import run_pipeline
     # Specify a different date for live events
     python src/main.py --date 2026-01-18
 
+    # Derive order_key/skus for events_raw documents loaded before they existed
+    python src/main.py --backfill-order-keys
+
+    # Show bytes per event of events_raw as stored, in text form and in compact form
+    python src/main.py --storage-report
+
+    # Rewrite events_raw ids and timestamps into the configured form (EVENT_ID_FORMAT, dates)
+    python src/main.py --compact-raw
+
+    # ... and copy it into a new collection using MONGO_BLOCK_COMPRESSOR (stop the loaders first)
+    python src/main.py --compact-raw --recompress
+
+    # Export newly loaded events_raw documents to the Parquet raw snapshot
+    python src/main.py --export-snapshot
+
+    # Transform and rebuild order state from the Parquet raw snapshot instead of MongoDB
+    python src/main.py --skip-bootstrap --from-snapshot data/raw_snapshot
+
+    # Rebuild the Postgres model for a date range in a shadow schema, then swap it in
+    python src/main.py --reprocess-from 2023-01-01 --reprocess-to 2023-12-31 --workers 8
+
+    # ... when the new logic is expected to change the model, swap it in anyway
+    python src/main.py --reprocess-from 2023-01-01 --reprocess-to 2023-12-31 --accept-changes
+
+    # Keep Postgres in sync with events_raw through a change stream (needs a replica set)
+    python src/main.py --sync --sync-max-wait 0.5
+
+    # Sample every stage and write collapsed stacks plus a hotspot summary to data/profiles
+    python src/main.py --profile
+
     # Change batch size
     python src/main.py --batch-size 2000
 
@@ -42,7 +72,7 @@ def main():
     parser.add_argument(
         '--force-rerun-bootstrap',
         action='store_true',
-        help='Force re-run bootstrap loading even if already loaded'
+        help='Reload every bootstrap file, including those unchanged since their last load'
     )
     
     parser.add_argument(
@@ -64,6 +94,91 @@ def main():
         help='Load only bootstrap data, skip live events'
     )
     
+    parser.add_argument(
+        '--backfill-order-keys',
+        action='store_true',
+        help='Backfill canonical order_key and skus fields on existing events_raw documents'
+    )
+    
+    parser.add_argument(
+        '--storage-report',
+        action='store_true',
+        help='Print bytes per event of events_raw as stored, in text form and in compact form'
+    )
+    
+    parser.add_argument(
+        '--compact-raw',
+        action='store_true',
+        help='Convert existing events_raw documents to the configured event_id format and date timestamps before loading'
+    )
+    
+    parser.add_argument(
+        '--recompress',
+        action='store_true',
+        help='With --compact-raw, rebuild events_raw in a new collection created with MONGO_BLOCK_COMPRESSOR'
+    )
+    
+    parser.add_argument(
+        '--export-snapshot',
+        action='store_true',
+        help='Export newly loaded events_raw documents to the Parquet raw snapshot'
+    )
+    
+    parser.add_argument(
+        '--from-snapshot',
+        type=str,
+        help='Read the transform and order state from a Parquet raw snapshot directory instead of MongoDB'
+    )
+    
+    parser.add_argument(
+        '--reprocess-from',
+        type=str,
+        help='First event date (YYYY-MM-DD) to rebuild into the shadow schema; skips loading'
+    )
+    
+    parser.add_argument(
+        '--reprocess-to',
+        type=str,
+        help='Last event date (YYYY-MM-DD) to rebuild (defaults to --reprocess-from)'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Number of reprocessing worker processes (default: number of CPUs)'
+    )
+    
+    parser.add_argument(
+        '--no-swap',
+        action='store_true',
+        help='Build and validate the shadow schema without swapping it in'
+    )
+    
+    parser.add_argument(
+        '--accept-changes',
+        action='store_true',
+        help='Swap the reprocessed shadow schema in even when table checksums differ from the live ones'
+    )
+    
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Run the change-stream sync worker loading new events_raw documents into PostgreSQL until interrupted'
+    )
+    
+    parser.add_argument(
+        '--sync-max-wait',
+        type=float,
+        default=1.0,
+        help='Seconds a change may wait in a partial sync micro-batch (default: 1.0)'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Profile each pipeline stage; writes per-stage collapsed stacks and a hotspot summary to data/profiles'
+    )
+    
     args = parser.parse_args()
     
     run_pipeline(args)
@@ -2,11 +2,12 @@ from sqlalchemy import create_engine, text
 from urllib.parse import quote_plus
 from pymongo import MongoClient
 import pandas as pd
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from config import configs
 
 # Try DATABASE_URL first, then construct from components if not available
 MONGO_URI = configs["MONGO_URI"]
+MONGO_COMPRESSORS = configs["MONGO_COMPRESSORS"]
 PostgreSQL_URI = configs["PostgreSQL_URI"]
 
 def construct_postgresql_uri():
@@ -27,6 +28,14 @@ def construct_postgresql_uri():
     PostgreSQL_URI = f'postgresql+psycopg2://{user}:{encoded_password}@{host}:{port}/{database}'
     return PostgreSQL_URI
 
+# Schema searched by unqualified table names; None keeps the server default
+SEARCH_PATH = None
+
+def use_schema(schema: Optional[str]) -> None:
+    """Route unqualified table names of this process to another schema (e.g. a reprocessing shadow)."""
+    global SEARCH_PATH
+    SEARCH_PATH = schema
+
 # If PostgreSQL_URI is not set, construct it
 URI = construct_postgresql_uri()
 if not URI:
@@ -36,8 +45,9 @@ if not URI:
 def make_sqlalchemy_db_connection():
     """Create a SQLAlchemy engine for the PostgreSQL database."""
     engine = None
+    connect_args = {'options': f'-csearch_path={SEARCH_PATH}'} if SEARCH_PATH else {}
     try:
-        engine = create_engine(URI)
+        engine = create_engine(URI, connect_args=connect_args)
         # Fallback to PostgreSQL_URI if engine creation fails with URI construction
         if not engine:
             engine = create_engine(PostgreSQL_URI)
@@ -47,14 +57,14 @@ def make_sqlalchemy_db_connection():
     return engine
 
 
-def execute_postgre_query(query: str) -> pd.DataFrame | None:
+def execute_postgre_query(query: str, params: Optional[Dict[str, Any]] = None) -> pd.DataFrame | None:
     """Execute a SQL query and return the results as a DataFrame or None if the connection is not initialized or the query is not a fetch query."""
     connection_engine = make_sqlalchemy_db_connection()
     if not connection_engine:
         raise ValueError("Database connection engine is not initialized.")
     
     with connection_engine.connect() as connection:
-        result = connection.execute(text(query))
+        result = connection.execute(text(query), params or {})
         if query.strip().lower().startswith("select"):
             executed = pd.DataFrame(result.fetchall(), columns=result.keys())
             print("Query executed successfully.")
@@ -65,10 +75,55 @@ def execute_postgre_query(query: str) -> pd.DataFrame | None:
             return None
         
 
+def insert_on_conflict_do_nothing(table, conn, keys, data_iter):
+    """pandas.to_sql insert method: multi-row INSERT that skips rows whose key already exists."""
+    from sqlalchemy.dialects.postgresql import insert
+    rows = [dict(zip(keys, row)) for row in data_iter]
+    if not rows:
+        return 0
+    result = conn.execute(insert(table.table).values(rows).on_conflict_do_nothing())
+    return result.rowcount
+
+
+def bulk_insert_dataframe(df: pd.DataFrame, table_name: str, connection=None, schema: Optional[str] = None, chunk_size: int = 1000) -> int:
+    """
+    Bulk insert a DataFrame into an existing table, ignoring rows that conflict on the primary key.
+
+    Args:
+        df: Rows to insert, with columns named after the table columns
+        table_name: Target table
+        connection: Optional open connection to run inside an existing transaction
+        schema: Optional schema of the target table
+        chunk_size: Number of rows per INSERT statement
+    Returns:
+        Number of rows inserted
+    """
+    if df.empty:
+        return 0
+    target = connection
+    if target is None:
+        target = make_sqlalchemy_db_connection()
+        if not target:
+            raise ValueError("Database connection engine is not initialized.")
+    inserted = df.to_sql(
+        table_name,
+        target,
+        schema=schema,
+        if_exists='append',
+        index=False,
+        chunksize=chunk_size,
+        method=insert_on_conflict_do_nothing
+    )
+    return inserted or 0
+
+
 def get_mongo_client() -> MongoClient:
     print("Connecting to MongoDB...")
     print(f"MONGO_URI: {MONGO_URI}")
-    return MongoClient(MONGO_URI)
+    # Wire compression is negotiated per connection; compressors the server or this
+    # environment (zstandard, python-snappy) do not support are skipped with a warning
+    options = {'compressors': MONGO_COMPRESSORS} if MONGO_COMPRESSORS else {}
+    return MongoClient(MONGO_URI, **options)
 
 
 # load data from MongoDB, for transformation and storing into tables for analytics
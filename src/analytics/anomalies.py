@@ -0,0 +1,392 @@
+import json
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, get_mongo_client
+from ..raw_zone import decode_event_id
+from ..utility import parse_timestamp, first_present
+from ..watermarks import loaded_after_query, max_loaded_at
+from .transform import (
+    ORDER_EVENT_TYPES, PAYMENT_EVENT_TYPES, REFUND_EVENT_TYPES,
+    ORDER_AMOUNT_FIELDS, REFUND_AMOUNT_FIELDS, PAYMENT_STATUS_FIELDS, CURRENCY_FIELDS, date_id,
+)
+from .query_cache import cached_query, record_change
+
+DETECTOR_NAME = 'vendor_hourly'
+
+# Weight of the newest hour in the rolling mean and variance of each metric
+EWMA_ALPHA = 0.1
+
+# Deviation, in rolling standard deviations, at which an hour is flagged
+Z_THRESHOLD = 3.0
+
+# Hours a metric must be observed before its baseline is trusted
+WARMUP_HOURS = 24
+
+# Fewer payments than this in an hour say nothing about the success rate; revenue and
+# refund volume are scored every hour, an hour without orders (refunds) counting as 0
+MIN_PAYMENTS = 5
+
+# Metric name prefixes of the per-currency amounts of a bucket
+AMOUNT_METRICS = {'revenue': ('revenue', 'orders'), 'refunded': ('refund_volume', 'refunds')}
+
+# An hour stays open until the vendor has an event this many hours later; later arrivals are counted as late
+LATENESS_HOURS = 6
+
+PROJECTION = {'_id': 0, 'event_id': 1, 'event_type': 1, 'event_time': 1, 'vendor': 1, 'payload': 1, '_loaded_at': 1}
+
+EPOCH = datetime(1970, 1, 1)
+
+# Runs of a detector are serialised, so the state each one loads is the one the previous run saved
+lock_detector_query = "SELECT pg_advisory_xact_lock(hashtext(:detector));"
+
+# Events already observed; a re-delivery re-stamps _loaded_at and is read again, but claims the same id
+claim_events_query = """
+INSERT INTO anomaly_observed_events (detector, event_id)
+SELECT :detector, UNNEST(CAST(:event_ids AS VARCHAR[]))
+ON CONFLICT DO NOTHING
+RETURNING event_id;
+"""
+
+detector_state_query = """
+SELECT state, watermark FROM anomaly_detector_state WHERE detector = :detector;
+"""
+
+save_state_query = """
+INSERT INTO anomaly_detector_state (detector, state, watermark, updated_at)
+VALUES (:detector, CAST(:state AS JSONB), :watermark, NOW())
+ON CONFLICT (detector) DO UPDATE SET
+    state = EXCLUDED.state,
+    watermark = EXCLUDED.watermark,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+insert_anomaly_query = """
+INSERT INTO anomalies (vendor_id, metric, hour_start, observed, expected, std_dev, z_score, direction, sample_size)
+VALUES (:vendor_id, :metric, :hour_start, :observed, :expected, :std_dev, :z_score, :direction, :sample_size)
+ON CONFLICT (vendor_id, metric, hour_start) DO NOTHING;
+"""
+
+recent_anomalies_query = """
+SELECT * FROM anomalies
+WHERE hour_start >= :since {vendor_filter}
+ORDER BY hour_start DESC, ABS(z_score) DESC;
+"""
+
+
+def _number(value: Any) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return number if math.isfinite(number) else 0.0
+
+
+class RollingStat:
+    """Exponentially weighted mean and variance of one metric series, updated in O(1)."""
+
+    __slots__ = ('mean', 'variance', 'count')
+
+    def __init__(self, mean: float = 0.0, variance: float = 0.0, count: int = 0):
+        self.mean = mean
+        self.variance = variance
+        self.count = count
+
+    def update(self, value: float) -> None:
+        if self.count == 0:
+            self.mean = value
+        else:
+            delta = value - self.mean
+            self.mean += EWMA_ALPHA * delta
+            self.variance = (1 - EWMA_ALPHA) * (self.variance + EWMA_ALPHA * delta * delta)
+        self.count += 1
+
+    def to_list(self) -> List[float]:
+        return [self.mean, self.variance, self.count]
+
+
+def new_bucket() -> Dict[str, Any]:
+    return {'payments': 0, 'failed_payments': 0, 'orders': 0, 'refunds': 0, 'revenue': {}, 'refunded': {}}
+
+
+class VendorHourlyDetector:
+    """
+    Rolling per-vendor, per-hour anomaly detector.
+
+    observe() adds an event to the counters of its vendor's hour in O(1). Every
+    hour of a vendor closes in turn, empty ones included: its payment success
+    rate (when enough payments were seen) and per-currency revenue and refund
+    volume are compared to the metric's EWMA baseline, flagged when more than
+    Z_THRESHOLD standard deviations away, and folded into the baseline.
+    The whole state is a small JSON document (a few numbers per vendor and metric,
+    plus the open hours), so it is saved with every run and survives restarts.
+    """
+
+    def __init__(self, state: Optional[Dict[str, Any]] = None):
+        state = state or {}
+        # (vendor, hour number) -> counters of events in that hour
+        self.buckets = {
+            (vendor, int(hour)): bucket
+            for vendor, hours in state.get('buckets', {}).items() for hour, bucket in hours.items()
+        }
+        # vendor -> metric -> rolling baseline
+        self.baselines = {
+            vendor: {metric: RollingStat(*values) for metric, values in metrics.items()}
+            for vendor, metrics in state.get('baselines', {}).items()
+        }
+        self.latest_hour: Dict[str, int] = state.get('latest_hour', {})
+        self.closed_through: Dict[str, int] = state.get('closed_through', {})
+        self.late_events = state.get('late_events', 0)
+        # vendor -> [payments, failed payments] since the first run
+        self.payment_totals: Dict[str, List[int]] = state.get('payment_totals', {})
+
+    def observe(self, event: Dict[str, Any]) -> None:
+        event_type = event.get('event_type')
+        event_time = parse_timestamp(event.get('event_time'))
+        if event_time is None:
+            return
+        vendor = event.get('vendor') or 'unknown'
+        hour = int((event_time - EPOCH).total_seconds()) // 3600
+        if hour <= self.closed_through.get(vendor, -1):
+            self.late_events += 1
+            return
+        bucket = self.buckets.get((vendor, hour))
+        if bucket is None:
+            bucket = self.buckets[(vendor, hour)] = new_bucket()
+        if hour > self.latest_hour.get(vendor, -1):
+            self.latest_hour[vendor] = hour
+
+        payload = event.get('payload') or {}
+        if event_type in PAYMENT_EVENT_TYPES:
+            failed = str(first_present(payload, PAYMENT_STATUS_FIELDS) or 'SUCCESS').upper() != 'SUCCESS'
+            bucket['payments'] += 1
+            bucket['failed_payments'] += failed
+            totals = self.payment_totals.setdefault(vendor, [0, 0])
+            totals[0] += 1
+            totals[1] += failed
+        elif event_type in ORDER_EVENT_TYPES:
+            currency = first_present(payload, CURRENCY_FIELDS) or 'UNKNOWN'
+            bucket['orders'] += 1
+            bucket['revenue'][currency] = bucket['revenue'].get(currency, 0.0) + _number(first_present(payload, ORDER_AMOUNT_FIELDS))
+        elif event_type in REFUND_EVENT_TYPES:
+            currency = first_present(payload, CURRENCY_FIELDS) or 'UNKNOWN'
+            bucket['refunds'] += 1
+            bucket['refunded'][currency] = bucket['refunded'].get(currency, 0.0) + _number(first_present(payload, REFUND_AMOUNT_FIELDS))
+
+    def bucket_metrics(self, vendor: str, bucket: Dict[str, Any]) -> Dict[str, tuple]:
+        """
+        metric -> (value, sample size) of a closed hour.
+
+        Every currency the vendor has a revenue (refund volume) baseline for is
+        scored, at 0 when the hour has none of it, so a drop to nothing is seen.
+        """
+        metrics = {}
+        if bucket['payments'] >= MIN_PAYMENTS:
+            metrics['payment_success_rate'] = (1 - bucket['failed_payments'] / bucket['payments'], bucket['payments'])
+        baselines = self.baselines.get(vendor, {})
+        for field, (prefix, count_field) in AMOUNT_METRICS.items():
+            amounts = {metric[len(prefix) + 1:]: 0.0 for metric in baselines if metric.startswith(f"{prefix}_")}
+            amounts.update(bucket[field])
+            for currency, amount in amounts.items():
+                metrics[f"{prefix}_{currency}"] = (amount, bucket[count_field])
+        return metrics
+
+    def closable_hours(self, flush: bool = False) -> List[tuple]:
+        """
+        (vendor, hour) of every hour from each vendor's last closed hour (its first
+        observed hour on the first run) through its latest hour minus LATENESS_HOURS
+        (through its latest hour when flush), in time order per vendor.
+        """
+        first_open = {}
+        for vendor, hour in self.buckets:
+            first_open[vendor] = min(hour, first_open.get(vendor, hour))
+        closable = []
+        for vendor in sorted(first_open):
+            start = self.closed_through[vendor] + 1 if vendor in self.closed_through else first_open[vendor]
+            end = self.latest_hour[vendor] - (0 if flush else LATENESS_HOURS)
+            closable.extend((vendor, hour) for hour in range(start, end + 1))
+        return closable
+
+    def close_hours(self, flush: bool = False) -> List[Dict[str, Any]]:
+        """Evaluate the closable hours, empty ones included, and return the anomalies."""
+        anomalies = []
+        for vendor, hour in self.closable_hours(flush):
+            bucket = self.buckets.pop((vendor, hour), None) or new_bucket()
+            baselines = self.baselines.setdefault(vendor, {})
+            for metric, (value, sample_size) in self.bucket_metrics(vendor, bucket).items():
+                stat = baselines.get(metric)
+                if stat is None:
+                    stat = baselines[metric] = RollingStat()
+                std_dev = math.sqrt(stat.variance)
+                if stat.count >= WARMUP_HOURS and std_dev > 0:
+                    z_score = (value - stat.mean) / std_dev
+                    if abs(z_score) >= Z_THRESHOLD:
+                        anomalies.append({
+                            'vendor_id': vendor,
+                            'metric': metric,
+                            'hour_start': EPOCH + timedelta(hours=hour),
+                            'observed': value,
+                            'expected': stat.mean,
+                            'std_dev': std_dev,
+                            'z_score': z_score,
+                            'direction': 'high' if z_score > 0 else 'low',
+                            'sample_size': sample_size,
+                        })
+                stat.update(value)
+            self.closed_through[vendor] = max(hour, self.closed_through.get(vendor, -1))
+        return anomalies
+
+    def to_state(self) -> Dict[str, Any]:
+        buckets = {}
+        for (vendor, hour), bucket in self.buckets.items():
+            buckets.setdefault(vendor, {})[str(hour)] = bucket
+        return {
+            'buckets': buckets,
+            'baselines': {vendor: {metric: stat.to_list() for metric, stat in metrics.items()}
+                          for vendor, metrics in self.baselines.items()},
+            'latest_hour': self.latest_hour,
+            'closed_through': self.closed_through,
+            'late_events': self.late_events,
+            'payment_totals': self.payment_totals,
+        }
+
+
+def load_detector(connection=None):
+    """Detector state and the _loaded_at watermark it was saved with (both empty on the first run)."""
+    if connection is None:
+        stored = execute_postgre_query(detector_state_query, {'detector': DETECTOR_NAME})
+    else:
+        stored = pd.DataFrame(connection.execute(text(detector_state_query), {'detector': DETECTOR_NAME}).mappings().all())
+    if stored is None or stored.empty:
+        return VendorHourlyDetector(), None
+    row = stored.iloc[0]
+    state = row['state'] if isinstance(row['state'], dict) else json.loads(row['state'])
+    watermark = row['watermark'].to_pydatetime() if hasattr(row['watermark'], 'to_pydatetime') else row['watermark']
+    return VendorHourlyDetector(state), watermark
+
+
+def claim_events(connection, events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The events of a chunk not observed by an earlier run, claimed for this one."""
+    event_ids = sorted({decode_event_id(event.get('event_id')) for event in events if event.get('event_id')})
+    if not event_ids:
+        return []
+    claimed = set(connection.execute(text(claim_events_query), {
+        'detector': DETECTOR_NAME,
+        'event_ids': event_ids,
+    }).scalars().all())
+    new_events = []
+    for event in events:
+        event_id = decode_event_id(event.get('event_id'))
+        # The first copy of an id within the chunk takes its claim
+        if event_id in claimed:
+            claimed.discard(event_id)
+            new_events.append(event)
+    return new_events
+
+
+def save_detector(connection, detector: VendorHourlyDetector, watermark: Optional[datetime], anomalies: List[Dict[str, Any]]) -> None:
+    """Persist new anomalies, the detector state and its watermark in the run's transaction."""
+    if anomalies:
+        connection.execute(text(insert_anomaly_query), anomalies)
+    connection.execute(text(save_state_query), {
+        'detector': DETECTOR_NAME,
+        'state': json.dumps(detector.to_state()),
+        'watermark': watermark,
+    })
+
+
+def update_anomalies(batch_size: int = 5000) -> Dict[str, Any]:
+    """
+    Feed events loaded since the last run through the detector and store the anomalies found.
+
+    The watermark is kept with the detector state in Postgres rather than in
+    pipeline_watermarks. Loading the state, claiming the event_ids read and
+    saving the state run in one transaction, so neither an interrupted run nor
+    a re-delivered event (re-stamped _loaded_at) is counted twice.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    event_types = list(ORDER_EVENT_TYPES) + list(PAYMENT_EVENT_TYPES) + list(REFUND_EVENT_TYPES)
+
+    with engine.begin() as connection:
+        connection.execute(text(lock_detector_query), {'detector': DETECTOR_NAME})
+        detector, watermark = load_detector(connection)
+        query = {'$and': [loaded_after_query(watermark), {'event_type': {'$in': event_types}}]}
+
+        new_watermark = watermark
+        observed = 0
+        skipped = 0
+        late_before = detector.late_events
+        chunk = []
+        cursor = db['events_raw'].find(query, PROJECTION).batch_size(batch_size)
+        for event in cursor:
+            new_watermark = max_loaded_at(new_watermark, event)
+            chunk.append(event)
+            if len(chunk) >= batch_size:
+                new_events = claim_events(connection, chunk)
+                for new_event in new_events:
+                    detector.observe(new_event)
+                observed += len(new_events)
+                skipped += len(chunk) - len(new_events)
+                chunk = []
+        if chunk:
+            new_events = claim_events(connection, chunk)
+            for new_event in new_events:
+                detector.observe(new_event)
+            observed += len(new_events)
+            skipped += len(chunk) - len(new_events)
+        client.close()
+
+        anomalies = detector.close_hours()
+        save_detector(connection, detector, new_watermark, anomalies)
+    # The detector state is read through load_detector, never from the result cache
+    if anomalies:
+        record_change(['anomalies'], [date_id(anomaly['hour_start']) for anomaly in anomalies], 'anomalies')
+    stats = {
+        'events_observed': observed,
+        'already_observed': skipped,
+        'anomalies': len(anomalies),
+        'open_hours': len(detector.buckets),
+        'late_events': detector.late_events - late_before,
+    }
+    logging.info(f"Anomaly detection: {stats}")
+    return stats
+
+
+def recent_anomalies(since: str, vendor: Optional[str] = None) -> pd.DataFrame:
+    """Anomalies of hours starting at or after since (YYYY-MM-DD), most recent and strongest first."""
+    params = {'since': since}
+    vendor_filter = ''
+    if vendor:
+        vendor_filter = 'AND vendor_id = :vendor'
+        params['vendor'] = vendor
+    return cached_query(
+        recent_anomalies_query.format(vendor_filter=vendor_filter), params, date_range=(int(since.replace('-', '')), None)
+    )
+
+
+def vendor_failure_rates() -> pd.DataFrame:
+    """
+    Payment failure rate of every vendor, highest first, from the detector state alone:
+    overall since the first run, and the rolling (EWMA) hourly rate where enough hours were observed.
+    """
+    detector, _ = load_detector()
+    rows = []
+    for vendor, (payments, failed) in detector.payment_totals.items():
+        stat = detector.baselines.get(vendor, {}).get('payment_success_rate')
+        rows.append({
+            'vendor_id': vendor,
+            'payments': payments,
+            'failure_rate': failed / payments if payments else None,
+            'rolling_failure_rate': 1 - stat.mean if stat is not None and stat.count else None,
+        })
+    return pd.DataFrame(rows, columns=['vendor_id', 'payments', 'failure_rate', 'rolling_failure_rate']).sort_values(
+        'failure_rate', ascending=False, ignore_index=True
+    )
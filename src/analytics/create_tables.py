@@ -54,6 +54,18 @@ CREATE TABLE IF NOT EXISTS customers (
 );
 """
 
+# create customer identity table (hashed email / phone / vendor customer id -> customer) in PostgreSQL
+create_customer_identities_table_query = """
+CREATE TABLE IF NOT EXISTS customer_identities (
+    identifier_hash BIGINT PRIMARY KEY,
+    identifier_type VARCHAR(20) NOT NULL,
+    customer_id VARCHAR NOT NULL,
+    first_seen_at TIMESTAMP DEFAULT NOW(),
+    FOREIGN KEY (customer_id) REFERENCES customers(id)
+);
+CREATE INDEX IF NOT EXISTS idx_customer_identities_customer_id ON customer_identities (customer_id);
+"""
+
 # create product dimension table in PostgreSQL
 create_product_dimension_table_query = """
 CREATE TABLE IF NOT EXISTS products (
@@ -111,10 +123,19 @@ create_shipments_table_query = """
 CREATE TABLE IF NOT EXISTS shipments(
     id VARCHAR PRIMARY KEY,
     shipment_time TIMESTAMP,
-    tracking_id VARCHAR
+    tracking_id VARCHAR,
+    latest_status VARCHAR(50),
+    latest_status_at TIMESTAMP
 );
 """
 
+# add the latest status columns to shipments tables created before they existed
+add_shipment_latest_status_query = """
+ALTER TABLE shipments
+    ADD COLUMN IF NOT EXISTS latest_status VARCHAR(50),
+    ADD COLUMN IF NOT EXISTS latest_status_at TIMESTAMP;
+"""
+
 # create shipment updates table in PostgreSQL
 create_shipment_updates_table_query = """
 CREATE TABLE IF NOT EXISTS shipment_updates(
@@ -173,6 +194,171 @@ CREATE TABLE IF NOT EXISTS payments (
 );
 """
 
+# create quarantine table for fact rows whose order reference is not (yet) known
+create_quarantined_facts_table_query = """
+CREATE TABLE IF NOT EXISTS quarantined_facts (
+    fact_table VARCHAR(50) NOT NULL,
+    row_id VARCHAR NOT NULL,
+    order_id VARCHAR,
+    row_data JSONB NOT NULL,
+    reason VARCHAR(100),
+    attempts INTEGER DEFAULT 0,
+    quarantined_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (fact_table, row_id)
+);
+CREATE INDEX IF NOT EXISTS idx_quarantined_facts_order_id ON quarantined_facts (order_id);
+"""
+
+# create daily data quality report table in PostgreSQL
+create_dq_reports_table_query = """
+CREATE TABLE IF NOT EXISTS dq_reports (
+    report_date DATE PRIMARY KEY,
+    total_events INTEGER NOT NULL,
+    duplicate_events INTEGER NOT NULL,
+    late_events INTEGER NOT NULL,
+    late_rate DECIMAL(6, 4),
+    drifted_events INTEGER NOT NULL,
+    missing_field_events INTEGER NOT NULL,
+    unknown_vendor_events INTEGER NOT NULL,
+    details JSONB,
+    generated_at TIMESTAMP NOT NULL
+);
+"""
+
+# create table of orders already counted in each time metric sketch
+create_metric_observations_table_query = """
+CREATE TABLE IF NOT EXISTS metric_observations (
+    metric VARCHAR(50) NOT NULL,
+    order_id VARCHAR NOT NULL,
+    vendor_id VARCHAR,
+    date_id INTEGER,
+    latency_seconds DOUBLE PRECISION,
+    observed_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (metric, order_id)
+);
+"""
+
+# create table of mergeable quantile sketches per metric, vendor and order creation day
+create_metric_sketches_table_query = """
+CREATE TABLE IF NOT EXISTS metric_sketches (
+    metric VARCHAR(50) NOT NULL,
+    vendor_id VARCHAR NOT NULL,
+    date_id INTEGER NOT NULL,
+    observations BIGINT NOT NULL,
+    sketch JSONB NOT NULL,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (metric, vendor_id, date_id)
+);
+CREATE INDEX IF NOT EXISTS idx_metric_sketches_metric_date ON metric_sketches (metric, date_id);
+"""
+
+# create per-SKU-per-day revenue table (order lines and refunded lines, per currency and vendor)
+create_sku_daily_revenue_table_query = """
+CREATE TABLE IF NOT EXISTS sku_daily_revenue (
+    date_id INTEGER NOT NULL,
+    sku VARCHAR NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    vendor_id VARCHAR NOT NULL,
+    gross_revenue DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    refunded_amount DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    units_sold DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    units_refunded DECIMAL(12, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (date_id, sku, currency, vendor_id)
+);
+"""
+
+# create table of order / refund events already folded into sku_daily_revenue
+create_sku_revenue_sources_table_query = """
+CREATE TABLE IF NOT EXISTS sku_revenue_sources (
+    source_key VARCHAR PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT NOW()
+);
+"""
+
+# create table of refunds kept out of sku_daily_revenue: without item detail until their order's
+# lines are loaded, or in another currency than their order
+create_parked_refunds_table_query = """
+CREATE TABLE IF NOT EXISTS parked_refunds (
+    source_key VARCHAR PRIMARY KEY,
+    order_id VARCHAR NOT NULL,
+    date_id INTEGER NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    vendor_id VARCHAR NOT NULL,
+    amount DECIMAL(16, 2) NOT NULL,
+    reason VARCHAR(50) NOT NULL,
+    parked_at TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_parked_refunds_reason ON parked_refunds (reason);
+"""
+
+# create bitemporal daily revenue table: one row per version of a (day, currency, vendor) total,
+# valid for reports made from known_from until known_to (NULL: still current)
+create_daily_revenue_history_table_query = """
+CREATE TABLE IF NOT EXISTS daily_revenue_history (
+    date_id INTEGER NOT NULL,
+    currency VARCHAR(10) NOT NULL,
+    vendor_id VARCHAR NOT NULL,
+    gross_revenue DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    refunded_amount DECIMAL(16, 2) NOT NULL DEFAULT 0,
+    orders INTEGER NOT NULL DEFAULT 0,
+    refunds INTEGER NOT NULL DEFAULT 0,
+    known_from TIMESTAMP NOT NULL,
+    known_to TIMESTAMP,
+    PRIMARY KEY (date_id, currency, vendor_id, known_from)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_daily_revenue_history_current
+    ON daily_revenue_history (date_id, currency, vendor_id) WHERE known_to IS NULL;
+CREATE INDEX IF NOT EXISTS idx_daily_revenue_history_validity
+    ON daily_revenue_history USING GIST (int4range(date_id, date_id, '[]'), tsrange(known_from, known_to));
+"""
+
+# create table of order / refund events already folded into daily_revenue_history
+create_daily_revenue_history_sources_table_query = """
+CREATE TABLE IF NOT EXISTS daily_revenue_history_sources (
+    source_key VARCHAR PRIMARY KEY,
+    known_at TIMESTAMP NOT NULL,
+    applied_at TIMESTAMP DEFAULT NOW()
+);
+"""
+
+# create anomalies table (hourly per-vendor metrics deviating from their EWMA baseline)
+create_anomalies_table_query = """
+CREATE TABLE IF NOT EXISTS anomalies (
+    vendor_id VARCHAR NOT NULL,
+    metric VARCHAR(50) NOT NULL,
+    hour_start TIMESTAMP NOT NULL,
+    observed DOUBLE PRECISION NOT NULL,
+    expected DOUBLE PRECISION NOT NULL,
+    std_dev DOUBLE PRECISION NOT NULL,
+    z_score DOUBLE PRECISION NOT NULL,
+    direction VARCHAR(10) NOT NULL,
+    sample_size INTEGER NOT NULL,
+    detected_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (vendor_id, metric, hour_start)
+);
+CREATE INDEX IF NOT EXISTS idx_anomalies_hour ON anomalies (hour_start);
+"""
+
+# create anomaly detector state table (rolling baselines and open hours, saved with the detector's watermark)
+create_anomaly_detector_state_table_query = """
+CREATE TABLE IF NOT EXISTS anomaly_detector_state (
+    detector VARCHAR(50) PRIMARY KEY,
+    state JSONB NOT NULL,
+    watermark TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+"""
+
+# create anomaly observed events table (events already counted by a detector; re-stamped deliveries are skipped)
+create_anomaly_observed_events_table_query = """
+CREATE TABLE IF NOT EXISTS anomaly_observed_events (
+    detector VARCHAR(50) NOT NULL,
+    event_id VARCHAR NOT NULL,
+    observed_at TIMESTAMP DEFAULT NOW(),
+    PRIMARY KEY (detector, event_id)
+);
+"""
+
 
 # List of all create table queries
 all_queries_to_execute = [
@@ -181,15 +367,29 @@ all_queries_to_execute = [
     create_vendor_dimension_table_query,
     create_order_timeline_table_query,
     create_customer_dimension_table_query,
+    create_customer_identities_table_query,
     create_product_dimension_table_query,
     create_orders_fact_table_query,
     create_order_items_table_query,
     create_order_updates_table_query,
     create_shipments_table_query,
+    add_shipment_latest_status_query,
     create_shipment_updates_table_query,
     create_refunds_table_query,
     create_refunded_items_table_query,
     create_payments_table_query,
+    create_quarantined_facts_table_query,
+    create_dq_reports_table_query,
+    create_metric_observations_table_query,
+    create_metric_sketches_table_query,
+    create_sku_daily_revenue_table_query,
+    create_sku_revenue_sources_table_query,
+    create_parked_refunds_table_query,
+    create_daily_revenue_history_table_query,
+    create_daily_revenue_history_sources_table_query,
+    create_anomalies_table_query,
+    create_anomaly_detector_state_table_query,
+    create_anomaly_observed_events_table_query,
 ]
 
 def create_tables_if_not_exists():
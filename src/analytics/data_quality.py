@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+from ..DB_connection import get_mongo_client, execute_postgre_query
+from ..payload_schemas import KNOWN_VENDORS, is_canonical_shape
+from ..raw_zone import duplicate_deliveries, quarantined_lines
+from .query_cache import record_change
+
+DQ_REPORTS_COLLECTION = 'dq_reports'
+REQUIRED_ENVELOPE_FIELDS = ['event_id', 'event_type', 'event_time', 'vendor', 'payload']
+
+# Live events arriving more than this long after their event_time count as late
+LATE_ARRIVAL_THRESHOLD_HOURS = 24
+
+upsert_dq_report_query = """
+INSERT INTO dq_reports (
+    report_date, total_events, duplicate_events, late_events, late_rate,
+    drifted_events, missing_field_events, unknown_vendor_events, details, generated_at
+)
+VALUES (
+    :report_date, :total_events, :duplicate_events, :late_events, :late_rate,
+    :drifted_events, :missing_field_events, :unknown_vendor_events, CAST(:details AS JSONB), :generated_at
+)
+ON CONFLICT (report_date) DO UPDATE SET
+    total_events = EXCLUDED.total_events,
+    duplicate_events = EXCLUDED.duplicate_events,
+    late_events = EXCLUDED.late_events,
+    late_rate = EXCLUDED.late_rate,
+    drifted_events = EXCLUDED.drifted_events,
+    missing_field_events = EXCLUDED.missing_field_events,
+    unknown_vendor_events = EXCLUDED.unknown_vendor_events,
+    details = EXCLUDED.details,
+    generated_at = EXCLUDED.generated_at;
+"""
+
+
+def ingested_on_day_query(report_date: str) -> Dict[str, Any]:
+    """events_raw filter for one ingested_at day, served by the ingested_at index for both stored types."""
+    start = datetime.strptime(report_date, '%Y-%m-%d')
+    end = start + timedelta(days=1)
+    return {'$or': [
+        {'ingested_at': {'$gte': start, '$lt': end}},
+        {'ingested_at': {'$gte': report_date, '$lt': end.strftime('%Y-%m-%d')}},
+    ]}
+
+
+def _as_date(field: str) -> Dict[str, Any]:
+    return {'$convert': {'input': field, 'to': 'date', 'onError': None, 'onNull': None}}
+
+
+def _is_missing(field: str) -> Dict[str, Any]:
+    return {'$cond': [{'$ifNull': [field, False]}, 0, 1]}
+
+
+def dq_pipeline(report_date: str, late_threshold_hours: int = LATE_ARRIVAL_THRESHOLD_HOURS) -> List[Dict[str, Any]]:
+    """Aggregation computing every data quality check for a day in a single $facet pass."""
+    late_threshold_ms = late_threshold_hours * 3600 * 1000
+    missing_counters = {field: {'$sum': _is_missing(f'${field}')} for field in REQUIRED_ENVELOPE_FIELDS}
+    missing_counters['order_key'] = {'$sum': _is_missing('$order_key')}
+    missing_counters['any_field'] = {'$sum': {'$cond': [
+        {'$or': [{'$eq': [_is_missing(f'${field}'), 1]} for field in REQUIRED_ENVELOPE_FIELDS + ['order_key']]}, 1, 0
+    ]}}
+
+    return [
+        {'$match': ingested_on_day_query(report_date)},
+        {'$facet': {
+            'totals': [
+                {'$group': {
+                    '_id': None,
+                    'events': {'$sum': 1},
+                    'bootstrapped': {'$sum': {'$cond': [{'$eq': ['$_bootstrapped', True]}, 1, 0]}},
+                }},
+            ],
+            # Secondary check: the same business event stored under different event_ids
+            'duplicates': [
+                {'$group': {
+                    '_id': {'vendor': '$vendor', 'event_type': '$event_type', 'order_key': '$order_key', 'event_time': '$event_time'},
+                    'copies': {'$sum': 1},
+                }},
+                {'$match': {'copies': {'$gt': 1}}},
+                {'$group': {'_id': None, 'groups': {'$sum': 1}, 'extra_events': {'$sum': {'$subtract': ['$copies', 1]}}}},
+            ],
+            # Historical bootstrap records are late by construction, so only live events are measured
+            'late_arrivals': [
+                {'$match': {'_bootstrapped': {'$ne': True}}},
+                {'$project': {'lag_ms': {'$subtract': [_as_date('$ingested_at'), _as_date('$event_time')]}}},
+                {'$group': {
+                    '_id': None,
+                    'events': {'$sum': 1},
+                    'late': {'$sum': {'$cond': [{'$gt': ['$lag_ms', late_threshold_ms]}, 1, 0]}},
+                    'max_lag_ms': {'$max': '$lag_ms'},
+                    'avg_lag_ms': {'$avg': '$lag_ms'},
+                }},
+            ],
+            'missing_fields': [
+                {'$group': {'_id': None, **missing_counters}},
+            ],
+            'unknown_vendors': [
+                {'$match': {'vendor': {'$nin': KNOWN_VENDORS}}},
+                {'$group': {'_id': '$vendor', 'count': {'$sum': 1}}},
+            ],
+            # Only the distinct payload shapes leave the server, never the events
+            'payload_shapes': [
+                {'$project': {
+                    'vendor': 1,
+                    'event_type': 1,
+                    'keys': {'$map': {'input': {'$objectToArray': {'$ifNull': ['$payload', {}]}}, 'in': '$$this.k'}},
+                }},
+                {'$group': {'_id': {'vendor': '$vendor', 'event_type': '$event_type', 'keys': '$keys'}, 'count': {'$sum': 1}}},
+            ],
+        }},
+    ]
+
+
+def _first(facet: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return facet[0] if facet else {}
+
+
+def build_report(
+    report_date: str,
+    facets: Dict[str, Any],
+    deliveries: Optional[Dict[str, int]] = None,
+    rejected_lines: int = 0,
+) -> Dict[str, Any]:
+    """
+    Turn the $facet output into a flat report with details per check.
+
+    Duplicates are the deliveries the loaders recorded for the day (repeated
+    lines and already-stored event_ids), which the event_id upsert collapses
+    before the aggregation can see them. Rejected lines never reach events_raw;
+    they are counted from the loaders' quarantine.
+    """
+    deliveries = deliveries or {'repeated': 0, 'redelivered': 0}
+    totals = _first(facets['totals'])
+    duplicates = _first(facets['duplicates'])
+    late = _first(facets['late_arrivals'])
+    missing = _first(facets['missing_fields'])
+    missing.pop('_id', None)
+
+    # Shapes with the same keys in a different order are the same variant
+    drift = {}
+    for shape in facets['payload_shapes']:
+        vendor, event_type, keys = shape['_id'].get('vendor'), shape['_id'].get('event_type'), shape['_id'].get('keys', [])
+        if is_canonical_shape(vendor, event_type, keys):
+            continue
+        variant = f"{vendor}|{event_type}|{','.join(sorted(keys))}"
+        drift[variant] = drift.get(variant, 0) + shape['count']
+
+    live_events = late.get('events', 0)
+    late_events = late.get('late', 0)
+    unknown_vendors = {str(item['_id']): item['count'] for item in facets['unknown_vendors']}
+    return {
+        'report_date': report_date,
+        'total_events': totals.get('events', 0),
+        'duplicate_events': deliveries['repeated'] + deliveries['redelivered'],
+        'late_events': late_events,
+        'late_rate': round(late_events / live_events, 4) if live_events else 0.0,
+        'drifted_events': sum(drift.values()),
+        'missing_field_events': missing.get('any_field', 0),
+        'unknown_vendor_events': sum(unknown_vendors.values()),
+        'details': {
+            'bootstrapped_events': totals.get('bootstrapped', 0),
+            'rejected_lines': rejected_lines,
+            'repeated_deliveries': deliveries['repeated'],
+            'redelivered_events': deliveries['redelivered'],
+            'cross_id_duplicates': duplicates.get('extra_events', 0),
+            'cross_id_duplicate_groups': duplicates.get('groups', 0),
+            'max_lag_hours': round((late.get('max_lag_ms') or 0) / 3600000, 2),
+            'avg_lag_hours': round((late.get('avg_lag_ms') or 0) / 3600000, 2),
+            'missing_by_field': missing,
+            'unknown_vendors': unknown_vendors,
+            'drift_variants': drift,
+        },
+        'generated_at': datetime.now(),
+    }
+
+
+def generate_dq_report(report_date: str, late_threshold_hours: int = LATE_ARRIVAL_THRESHOLD_HOURS) -> Dict[str, Any]:
+    """
+    Compute the daily data quality report for events ingested on report_date.
+
+    The checks run server-side in one aggregation; the report is stored in the
+    dq_reports collection and the dq_reports table.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    facets = next(db['events_raw'].aggregate(dq_pipeline(report_date, late_threshold_hours), allowDiskUse=True))
+    report = build_report(report_date, facets, duplicate_deliveries(db, report_date), quarantined_lines(db, report_date))
+
+    db[DQ_REPORTS_COLLECTION].update_one({'report_date': report_date}, {'$set': report}, upsert=True)
+    client.close()
+
+    execute_postgre_query(upsert_dq_report_query, {**report, 'details': json.dumps(report['details'])})
+    record_change(['dq_reports'], [int(report_date.replace('-', ''))], 'dq_report')
+    logging.info(f"Data quality report for {report_date}: {report}")
+    return report
@@ -0,0 +1,145 @@
+import logging
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Any, Iterable, Optional
+import numpy as np
+import pandas as pd
+from ..DB_connection import execute_postgre_query, bulk_insert_dataframe
+
+# Entries kept per dimension cache before the least recently used ones are evicted
+DEFAULT_CACHE_SIZE = 100_000
+
+# Natural key column of every cached dimension table
+DIMENSION_KEYS = {
+    'vendors': 'id',
+    'customers': 'id',
+    'products': 'id',
+    'address': 'id',
+    'dates': 'date_id',
+}
+
+existing_members_query = """
+SELECT {key} AS natural_key, {value} AS surrogate_key FROM {table}
+WHERE {key} = ANY(:keys);
+"""
+
+
+class LRUCache:
+    """Bounded natural key -> surrogate key mapping evicting the least recently used entries."""
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_many(self, keys: Iterable) -> Dict[Any, Any]:
+        """Cached entries among keys, marking them as recently used."""
+        found = {}
+        for key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                found[key] = self.entries[key]
+        self.hits += len(found)
+        return found
+
+    def put_many(self, mapping: Dict[Any, Any]) -> None:
+        for key, value in mapping.items():
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def date_from_id(value: int) -> date:
+    value = int(value)
+    return date(value // 10000, value // 100 % 100, value % 100)
+
+
+def date_dimension(start: date, end: date) -> pd.DataFrame:
+    """Rows of the dates dimension for every day in [start, end]."""
+    days = pd.date_range(start, end, freq='D')
+    return pd.DataFrame({
+        'date_id': days.year * 10000 + days.month * 100 + days.day,
+        'day': days.day,
+        'month': days.month,
+        'year': days.year,
+    })
+
+
+class DimensionManager:
+    """
+    In-process cache of dimension members used while loading fact batches.
+
+    Each batch only inserts the distinct members the cache has not seen, and the
+    dates dimension is pre-generated a calendar year at a time. Customer identities
+    are not cached: merges in other processes repoint them (see identity_resolution).
+    """
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE):
+        self.caches = {table: LRUCache(max_size) for table in DIMENSION_KEYS}
+        self.date_range = None
+
+    def ensure_dates(self, start: date, end: date) -> int:
+        """Make sure every day of the calendar years spanning [start, end] exists in dates."""
+        if self.date_range and self.date_range[0] <= start and end <= self.date_range[1]:
+            return 0
+        if self.date_range:
+            start, end = min(start, self.date_range[0]), max(end, self.date_range[1])
+        start, end = date(start.year, 1, 1), date(end.year, 12, 31)
+        inserted = bulk_insert_dataframe(date_dimension(start, end), 'dates')
+        self.date_range = (start, end)
+        return inserted
+
+    def ensure_dates_for(self, ids: pd.Series) -> int:
+        """ensure_dates for the range of a column of date_id values."""
+        ids = ids.dropna()
+        if ids.empty:
+            return 0
+        return self.ensure_dates(date_from_id(ids.min()), date_from_id(ids.max()))
+
+    def load_members(self, table: str, frame: pd.DataFrame) -> int:
+        """Bulk insert the members of a batch the cache has not seen yet and remember them."""
+        if frame.empty:
+            return 0
+        key = DIMENSION_KEYS[table]
+        cache = self.caches[table]
+        keys = frame[key].dropna().unique()
+        known = cache.get_many(keys)
+        new = frame[~frame[key].isin(known)]
+        cache.misses += new[key].nunique()
+        inserted = bulk_insert_dataframe(new, table)
+        cache.put_many(dict(zip(new[key], new[key])))
+        return inserted
+
+    def lookup(self, table: str, keys: Iterable, value_column: Optional[str] = None) -> Dict[Any, Any]:
+        """
+        Surrogate keys of the given natural keys, from the cache or one query for the misses.
+
+        Keys missing from the table are absent from the result.
+        """
+        cache = self.caches[table]
+        keys = pd.Series(list(keys)).dropna().unique()
+        found = cache.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        cache.misses += len(missing)
+        if missing:
+            key = DIMENSION_KEYS[table]
+            query = existing_members_query.format(key=key, value=value_column or key, table=table)
+            params = [int(value) if isinstance(value, np.integer) else value for value in missing]
+            existing = execute_postgre_query(query, {'keys': params})
+            if existing is not None and not existing.empty:
+                loaded = dict(zip(existing['natural_key'], existing['surrogate_key']))
+                cache.put_many(loaded)
+                found.update(loaded)
+        return found
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {table: {'size': len(cache), 'hits': cache.hits, 'misses': cache.misses}
+                for table, cache in self.caches.items()}
+
+    def log_stats(self) -> None:
+        logging.info(f"Dimension cache: {self.stats()}")
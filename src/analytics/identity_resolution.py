@@ -0,0 +1,270 @@
+import hashlib
+import logging
+import re
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, bulk_insert_dataframe
+
+IDENTITY_TABLE = 'customer_identities'
+
+# Identifier kinds linking customer records, in the order they are chained per record
+IDENTIFIER_KINDS = ['customer_ref', 'email', 'phone']
+
+# Country code assumed for phone numbers written in national format (0803...)
+DEFAULT_COUNTRY_CODE = '234'
+
+# Tables whose customer_id is rewritten when two known customers turn out to be the same
+CUSTOMER_REFERENCE_TABLES = [IDENTITY_TABLE, 'orders', 'payments']
+
+# Session-level, so the lock spans the separate transactions of resolving, storing and loading orders
+lock_identities_query = "SELECT pg_advisory_lock(hashtext('customer_identities'));"
+unlock_identities_query = "SELECT pg_advisory_unlock(hashtext('customer_identities'));"
+
+existing_identities_query = """
+SELECT identifier_hash, customer_id FROM customer_identities
+WHERE identifier_hash = ANY(:hashes);
+"""
+
+
+def normalise_email(value: Any) -> Optional[str]:
+    if not isinstance(value, str):
+        return None
+    email = value.strip().lower()
+    return email if '@' in email else None
+
+
+def normalise_phone(value: Any) -> Optional[str]:
+    """Digits only, in international format without the leading + or 00."""
+    if not isinstance(value, (str, int)):
+        return None
+    digits = re.sub(r'\D', '', str(value))
+    if digits.startswith('00'):
+        digits = digits[2:]
+    elif digits.startswith('0'):
+        digits = DEFAULT_COUNTRY_CODE + digits[1:]
+    return digits if len(digits) >= 7 else None
+
+
+def normalise_customer_ref(value: Any) -> Optional[str]:
+    if not isinstance(value, (str, int)):
+        return None
+    ref = str(value).strip().upper()
+    return ref or None
+
+
+NORMALISERS = {
+    'customer_ref': normalise_customer_ref,
+    'email': normalise_email,
+    'phone': normalise_phone,
+}
+
+
+def hash_identifier(kind: str, value: str) -> int:
+    """64-bit signed hash of a normalised identifier; only hashes are kept in the graph and the database."""
+    digest = hashlib.blake2b(f"{kind}:{value}".encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def surrogate_customer_id(identifier_hash: int) -> str:
+    """Stable customer surrogate id derived from the smallest identifier hash of a new cluster."""
+    return f"CUS-{identifier_hash & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def connected_components(n_nodes: int, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """
+    Union-find over edge arrays.
+
+    Roots of the two ends of every edge are hooked to the smaller one, then paths
+    are compressed, until all edges join nodes with the same root.
+    Returns the root of every node.
+    """
+    parent = np.arange(n_nodes, dtype=np.int64)
+    while True:
+        root_left, root_right = parent[left], parent[right]
+        pending = root_left != root_right
+        if not pending.any():
+            return parent
+        np.minimum.at(
+            parent,
+            np.maximum(root_left[pending], root_right[pending]),
+            np.minimum(root_left[pending], root_right[pending]),
+        )
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def identifier_frame(records: pd.DataFrame) -> pd.DataFrame:
+    """Long frame of (record, kind, identifier_hash) for every usable identifier of every record."""
+    parts = []
+    for kind in IDENTIFIER_KINDS:
+        if kind not in records:
+            continue
+        values = records[kind].dropna().map(NORMALISERS[kind]).dropna()
+        if values.empty:
+            continue
+        # Each distinct value is hashed once
+        hashes = pd.Series({value: hash_identifier(kind, value) for value in values.unique()})
+        parts.append(pd.DataFrame({
+            'record': values.index.to_numpy(dtype=np.int64),
+            'kind': kind,
+            'identifier_hash': hashes.reindex(values.to_numpy()).to_numpy(dtype=np.int64),
+        }))
+    if not parts:
+        return pd.DataFrame({'record': np.array([], dtype=np.int64), 'kind': [], 'identifier_hash': np.array([], dtype=np.int64)})
+    return pd.concat(parts, ignore_index=True).sort_values(['record', 'kind'], kind='stable', ignore_index=True)
+
+
+def load_existing_identities(hashes: np.ndarray) -> pd.DataFrame:
+    """
+    Customer currently assigned to each of the given identifiers.
+
+    Always read from Postgres, never from a cache: a merge in another process
+    repoints identifiers, so only a read under identity_resolution_lock is current.
+    """
+    if len(hashes) == 0:
+        return pd.DataFrame(columns=['identifier_hash', 'customer_id'])
+    existing = execute_postgre_query(existing_identities_query, {'hashes': [int(h) for h in hashes]})
+    if existing is None or existing.empty:
+        return pd.DataFrame(columns=['identifier_hash', 'customer_id'])
+    return existing
+
+
+def resolve_customer_identities(
+    records: pd.DataFrame,
+    existing: Optional[pd.DataFrame] = None,
+) -> Dict[str, Any]:
+    """
+    Link customer records sharing a customer reference, email or phone into customers.
+
+    Only the identifiers of this batch and the customers they already belong to are
+    loaded, so incremental runs merge into the stored graph without rebuilding it.
+
+    Args:
+        records: One row per order with order_id, customer_ref, email and phone
+        existing: Stored (identifier_hash, customer_id) pairs; looked up in Postgres when omitted
+    Returns:
+        order_customers (order_id -> customer_id), customers and identities frames to load,
+        and merges (absorbed customer_id -> surviving customer_id)
+    """
+    empty = {
+        'order_customers': pd.Series(dtype=object),
+        'customers': pd.DataFrame(columns=['id', 'name', 'email', 'address_id']),
+        'identities': pd.DataFrame(columns=['identifier_hash', 'identifier_type', 'customer_id']),
+        'merges': {},
+    }
+    records = records.reset_index(drop=True)
+    identifiers = identifier_frame(records)
+    if identifiers.empty:
+        return empty
+
+    # Nodes: distinct identifiers, then the known customers they point to
+    unique_hashes, identifier_node = np.unique(identifiers['identifier_hash'].to_numpy(), return_inverse=True)
+    if existing is None:
+        existing = load_existing_identities(unique_hashes)
+    existing = existing[existing['identifier_hash'].isin(unique_hashes)]
+    known_customers = np.array(sorted(set(existing['customer_id'])), dtype=object)
+    n_nodes = len(unique_hashes) + len(known_customers)
+
+    # Edges: consecutive identifiers of the same record, and stored identifier -> customer links
+    record_ids = identifiers['record'].to_numpy()
+    same_record = record_ids[1:] == record_ids[:-1]
+    left = [identifier_node[:-1][same_record]]
+    right = [identifier_node[1:][same_record]]
+    if len(existing):
+        left.append(np.searchsorted(unique_hashes, existing['identifier_hash'].to_numpy(dtype=np.int64)))
+        right.append(len(unique_hashes) + np.searchsorted(known_customers, existing['customer_id'].to_numpy(dtype=object)))
+    roots = connected_components(n_nodes, np.concatenate(left), np.concatenate(right))
+
+    # A cluster keeps its smallest known customer id; new clusters get one from their smallest identifier
+    cluster_ids = {}
+    merges = {}
+    for position, customer_id in enumerate(known_customers):
+        root = roots[len(unique_hashes) + position]
+        if root in cluster_ids:
+            merges[customer_id] = cluster_ids[root]
+        else:
+            cluster_ids[root] = customer_id
+    identifier_roots = roots[:len(unique_hashes)]
+    for position in np.flatnonzero(identifier_roots == np.arange(len(unique_hashes))):
+        cluster_ids.setdefault(position, surrogate_customer_id(int(unique_hashes[position])))
+    customer_of_node = pd.Series(identifier_roots).map(cluster_ids).to_numpy(dtype=object)
+
+    identifiers['customer_id'] = customer_of_node[identifier_node]
+    first = identifiers.drop_duplicates('record')
+    order_customers = pd.Series(first['customer_id'].to_numpy(), index=records.loc[first['record'], 'order_id'].to_numpy())
+
+    # A customer's email is the smallest one seen among its records
+    customers = pd.DataFrame({
+        'id': first['customer_id'].to_numpy(),
+        'name': None,
+        'email': records.loc[first['record'], 'email'].map(normalise_email).to_numpy(),
+        'address_id': None,
+    }).sort_values(['id', 'email'], na_position='last').drop_duplicates('id')
+
+    stored = set(existing['identifier_hash'])
+    identities = identifiers.drop_duplicates('identifier_hash')
+    identities = identities[~identities['identifier_hash'].isin(stored)]
+    return {
+        'order_customers': order_customers[~order_customers.index.duplicated()],
+        'customers': customers.reset_index(drop=True),
+        'identities': identities.rename(columns={'kind': 'identifier_type'})[
+            ['identifier_hash', 'identifier_type', 'customer_id']
+        ].sort_values('identifier_hash').reset_index(drop=True),
+        'merges': merges,
+    }
+
+
+@contextmanager
+def identity_resolution_lock():
+    """
+    Serialise identity resolution across processes (e.g. parallel reprocess workers).
+
+    Two writers resolving against the same stored identities would each create a
+    customer for a shared identifier, and only one of them keeps it; holding the
+    lock from reading the identities until the orders referencing them are loaded
+    merges such clusters as a serial run would.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    with engine.connect() as connection:
+        connection.execute(text(lock_identities_query))
+        try:
+            yield
+        finally:
+            connection.execute(text(unlock_identities_query))
+
+
+def apply_customer_merges(merges: Dict[str, str]) -> int:
+    """Repoint identities and facts of absorbed customers to the surviving customer in one transaction."""
+    if not merges:
+        return 0
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    by_survivor = {}
+    for absorbed, survivor in merges.items():
+        by_survivor.setdefault(survivor, []).append(absorbed)
+    with engine.begin() as connection:
+        for survivor, absorbed in sorted(by_survivor.items()):
+            for table in CUSTOMER_REFERENCE_TABLES:
+                connection.execute(
+                    text(f"UPDATE {table} SET customer_id = :survivor WHERE customer_id = ANY(:absorbed);"),
+                    {'survivor': survivor, 'absorbed': absorbed}
+                )
+    logging.info(f"Merged {len(merges)} customer(s) into {len(by_survivor)}")
+    return len(merges)
+
+
+def store_identities(resolution: Dict[str, Any]) -> Dict[str, int]:
+    """Persist new identifier -> customer links and apply merges; customers must already be loaded."""
+    return {
+        IDENTITY_TABLE: bulk_insert_dataframe(resolution['identities'], IDENTITY_TABLE),
+        'customer_merges': apply_customer_merges(resolution['merges']),
+    }
@@ -0,0 +1,349 @@
+import json
+import logging
+import math
+import os
+from typing import Dict, Any, List, Optional, Sequence
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, get_mongo_client
+from ..watermarks import get_watermark, set_watermark, loaded_after_query, max_loaded_at
+from .query_cache import cached_query, record_change
+
+WATERMARK_NAME = 'latency_metrics'
+
+# Relative error of every quantile answered from the sketches
+RELATIVE_ACCURACY = 0.01
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+# Time metrics measured from order creation: fact table, time column and row filter
+METRICS = {
+    'order_to_payment': {'table': 'payments', 'time_column': 'payment_date', 'condition': "status = 'SUCCESS'"},
+    'order_to_refund': {'table': 'refunds', 'time_column': 'refunded_at', 'condition': 'TRUE'},
+}
+
+# Raw event types whose arrival can complete an order/metric pair
+TRIGGER_EVENT_TYPES = [
+    'order_created', 'historical_order', 'payment_succeeded', 'historical_payment',
+    'refund_issued', 'historical_refund',
+]
+
+orders_by_id_query = """
+SELECT id AS order_id, vendor_id, created_at FROM orders
+WHERE id = ANY(:order_ids) AND created_at IS NOT NULL;
+"""
+
+first_event_by_order_query = """
+SELECT order_id, MIN({time_column}) AS event_at FROM {table}
+WHERE order_id = ANY(:order_ids) AND {condition}
+GROUP BY order_id;
+"""
+
+observed_orders_query = """
+SELECT order_id FROM metric_observations
+WHERE metric = :metric AND order_id = ANY(:order_ids);
+"""
+
+# Writers of the sketches run one at a time, so no merge reads a sketch another run is replacing
+lock_sketches_query = "SELECT pg_advisory_xact_lock(hashtext('metric_sketches'));"
+
+# Orders measured by this run; an order counted by an earlier or concurrent run is skipped
+claim_observations_query = """
+INSERT INTO metric_observations (metric, order_id, vendor_id, date_id, latency_seconds)
+SELECT :metric, * FROM UNNEST(
+    CAST(:order_ids AS VARCHAR[]), CAST(:vendor_ids AS VARCHAR[]),
+    CAST(:date_ids AS INTEGER[]), CAST(:latencies AS DOUBLE PRECISION[])
+)
+ON CONFLICT DO NOTHING
+RETURNING order_id;
+"""
+
+sketches_query = """
+SELECT vendor_id, date_id, sketch FROM metric_sketches
+WHERE metric = :metric AND date_id BETWEEN :start_id AND :end_id
+{vendor_filter};
+"""
+
+upsert_sketch_query = """
+INSERT INTO metric_sketches (metric, vendor_id, date_id, observations, sketch, updated_at)
+VALUES (:metric, :vendor_id, :date_id, :observations, CAST(:sketch AS JSONB), NOW())
+ON CONFLICT (metric, vendor_id, date_id) DO UPDATE SET
+    observations = EXCLUDED.observations,
+    sketch = EXCLUDED.sketch,
+    updated_at = EXCLUDED.updated_at;
+"""
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative-error guarantees (DDSketch).
+
+    Values are counted in logarithmic buckets of ratio gamma, so any quantile is
+    within RELATIVE_ACCURACY of the exact one; merging two sketches adds their buckets.
+    """
+
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add_many(self, values: Sequence[float]) -> None:
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        positive = values[values > 0]
+        self.zero_count += int(len(values) - len(positive))
+        indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indexes.tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                # Midpoint of the bucket (gamma^(i-1), gamma^i] in relative terms
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': {str(index): count for index, count in self.bins.items()},
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'QuantileSketch':
+        if isinstance(data, str):
+            data = json.loads(data)
+        sketch = cls(data['relative_accuracy'])
+        sketch.bins = {int(index): count for index, count in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.total = data['total']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        return sketch
+
+
+def sorted_merge_join(left: pd.DataFrame, right: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    Inner join of two frames with unique keys.
+
+    Both sides are sorted by key and each right key is located in the left keys by
+    binary search, so the join is O(n log n) without a nested loop or a hash table.
+    Sorting happens here because the database collation may order keys differently.
+    """
+    if left.empty or right.empty:
+        return pd.DataFrame(columns=list(left.columns) + [c for c in right.columns if c != key])
+    left = left.sort_values(key, kind='mergesort')
+    right = right.sort_values(key, kind='mergesort')
+    left_keys = left[key].to_numpy()
+    right_keys = right[key].to_numpy()
+    positions = np.searchsorted(left_keys, right_keys)
+    in_range = positions < len(left_keys)
+    matched = in_range.copy()
+    matched[in_range] = left_keys[positions[in_range]] == right_keys[in_range]
+    joined = left.iloc[positions[matched]].reset_index(drop=True)
+    for column in right.columns:
+        if column != key:
+            joined[column] = right[column].to_numpy()[matched]
+    return joined
+
+
+def measure_orders(metric: str, order_ids: List[str]) -> pd.DataFrame:
+    """Latency in seconds from creation to the first metric event of each order not measured yet."""
+    spec = METRICS[metric]
+    observed = execute_postgre_query(observed_orders_query, {'metric': metric, 'order_ids': order_ids})
+    if observed is not None and not observed.empty:
+        order_ids = sorted(set(order_ids) - set(observed['order_id']))
+    if not order_ids:
+        return pd.DataFrame(columns=['order_id', 'vendor_id', 'date_id', 'latency_seconds'])
+
+    orders = execute_postgre_query(orders_by_id_query, {'order_ids': order_ids})
+    events = execute_postgre_query(first_event_by_order_query.format(**spec), {'order_ids': order_ids})
+    pairs = sorted_merge_join(orders, events, 'order_id')
+    if pairs.empty:
+        return pd.DataFrame(columns=['order_id', 'vendor_id', 'date_id', 'latency_seconds'])
+
+    created_at = pd.to_datetime(pairs['created_at'])
+    pairs['latency_seconds'] = (pd.to_datetime(pairs['event_at']) - created_at).dt.total_seconds()
+    pairs['date_id'] = created_at.dt.year * 10000 + created_at.dt.month * 100 + created_at.dt.day
+    pairs['vendor_id'] = pairs['vendor_id'].fillna('unknown')
+    return pairs[['order_id', 'vendor_id', 'date_id', 'latency_seconds']]
+
+
+def merge_into_sketches(metric: str, observations: pd.DataFrame, connection) -> int:
+    """Add observations to the stored sketch of each (vendor, creation day) they fall in."""
+    if observations.empty:
+        return 0
+    date_ids = observations['date_id'].astype(int)
+    stored = connection.execute(
+        text(sketches_query.format(vendor_filter='')),
+        {'metric': metric, 'start_id': int(date_ids.min()), 'end_id': int(date_ids.max())}
+    ).mappings().all()
+    existing = {(row['vendor_id'], int(row['date_id'])): row['sketch'] for row in stored}
+
+    updated = 0
+    for (vendor_id, date_id), group in observations.groupby(['vendor_id', date_ids]):
+        key = (vendor_id, int(date_id))
+        sketch = QuantileSketch.from_dict(existing[key]) if key in existing else QuantileSketch()
+        sketch.add_many(group['latency_seconds'].to_numpy())
+        connection.execute(text(upsert_sketch_query), {
+            'metric': metric,
+            'vendor_id': vendor_id,
+            'date_id': int(date_id),
+            'observations': sketch.count,
+            'sketch': json.dumps(sketch.to_dict()),
+        })
+        updated += 1
+    return updated
+
+
+def apply_observations(metric: str, observations: pd.DataFrame) -> Dict[str, int]:
+    """
+    Record the measured orders and merge them into the sketches.
+
+    Claiming the observations and rewriting the sketches run in one transaction
+    under an advisory lock, so a failed run leaves neither behind and concurrent
+    runs neither count an order twice nor lose each other's sketch updates.
+    Negative latencies (an event before its order's creation, flagged by
+    order_state) are recorded but kept out of the sketches and counted instead.
+    """
+    if observations.empty:
+        return {'observations': 0, 'sketches_updated': 0, 'negative_latencies': 0}
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+
+    with engine.begin() as connection:
+        connection.execute(text(lock_sketches_query))
+        observations = observations.sort_values('order_id')
+        claimed = connection.execute(text(claim_observations_query), {
+            'metric': metric,
+            'order_ids': observations['order_id'].tolist(),
+            'vendor_ids': observations['vendor_id'].tolist(),
+            'date_ids': [int(value) for value in observations['date_id']],
+            'latencies': [float(value) for value in observations['latency_seconds']],
+        }).scalars().all()
+        observations = observations[observations['order_id'].isin(claimed)]
+        negative = observations['latency_seconds'] < 0
+        sketches = merge_into_sketches(metric, observations[~negative], connection)
+    if not observations.empty:
+        record_change(['metric_sketches', 'metric_observations'], observations['date_id'].astype(int).unique(), 'latency_sketches')
+    return {
+        'observations': int((~negative).sum()),
+        'sketches_updated': sketches,
+        'negative_latencies': int(negative.sum()),
+    }
+
+
+def update_latency_sketches(batch_size: int = 5000) -> Dict[str, int]:
+    """
+    Measure orders touched by events loaded since the last run and merge them into the sketches.
+
+    Each (metric, order) pair is measured once, from the first matching fact row;
+    metric_observations records which orders have been counted.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    watermark = get_watermark(db, WATERMARK_NAME)
+    query = {'$and': [loaded_after_query(watermark), {'event_type': {'$in': TRIGGER_EVENT_TYPES}}]}
+
+    new_watermark = watermark
+    order_ids = set()
+    for event in db['events_raw'].find(query, {'_id': 0, 'order_key': 1, '_loaded_at': 1}).batch_size(batch_size):
+        new_watermark = max_loaded_at(new_watermark, event)
+        if event.get('order_key'):
+            order_ids.add(event['order_key'])
+
+    stats = {}
+    order_ids = sorted(order_ids)
+    for metric in METRICS:
+        measured = 0
+        sketches = 0
+        negative = 0
+        for start in range(0, len(order_ids), batch_size):
+            applied = apply_observations(metric, measure_orders(metric, order_ids[start:start + batch_size]))
+            measured += applied['observations']
+            sketches += applied['sketches_updated']
+            negative += applied['negative_latencies']
+        stats[f"{metric}_observations"] = measured
+        stats[f"{metric}_sketches_updated"] = sketches
+        stats[f"{metric}_negative_latencies"] = negative
+
+    if new_watermark is not None:
+        set_watermark(db, WATERMARK_NAME, new_watermark)
+    client.close()
+    logging.info(f"Latency sketches updated: {stats}")
+    return stats
+
+
+def latency_percentiles(
+    metric: str,
+    start: str,
+    end: str,
+    vendor: Optional[str] = None,
+    quantiles: Sequence[float] = DEFAULT_QUANTILES,
+) -> Dict[str, Any]:
+    """
+    Percentiles of a time metric (seconds) over orders created between start and end (YYYY-MM-DD).
+
+    Answered by merging the stored per-vendor, per-day sketches; no fact rows are read.
+    """
+    params = {
+        'metric': metric,
+        'start_id': int(start.replace('-', '')),
+        'end_id': int(end.replace('-', '')),
+    }
+    vendor_filter = ''
+    if vendor:
+        vendor_filter = 'AND vendor_id = :vendor'
+        params['vendor'] = vendor
+    stored = cached_query(sketches_query.format(vendor_filter=vendor_filter), params, date_range=(params['start_id'], params['end_id']))
+
+    merged = QuantileSketch()
+    if stored is not None:
+        for sketch in stored['sketch']:
+            merged.merge(QuantileSketch.from_dict(sketch))
+    result = {'metric': metric, 'start': start, 'end': end, 'vendor': vendor, 'count': merged.count}
+    result['mean'] = merged.total / merged.count if merged.count else None
+    for q in quantiles:
+        result[f"p{q * 100:g}"] = merged.quantile(q)
+    return result
@@ -0,0 +1,292 @@
+import hashlib
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from pymongo import UpdateOne
+from ..DB_connection import get_mongo_client
+from ..utility import parse_timestamp, first_present, extract_order_id
+from ..raw_zone import decode_event_id
+from ..raw_snapshot import load_from_snapshot
+from ..watermarks import get_watermark, set_watermark, loaded_after_query, max_loaded_at
+from .transform import (
+    ORDER_AMOUNT_FIELDS, PAYMENT_AMOUNT_FIELDS, PAYMENT_STATUS_FIELDS, REFUND_AMOUNT_FIELDS, CURRENCY_FIELDS,
+)
+from .shipments import SHIPMENT_HISTORY_FIELDS, SHIPMENT_STATUS_FIELDS, SHIPMENT_TIME_FIELDS, SHIPMENT_RANK
+
+ORDER_STATE_COLLECTION = 'order_state'
+WATERMARK_NAME = 'order_state'
+
+# Live and historical event types folded into the same transitions
+EVENT_KIND = {
+    'order_created': 'order',
+    'historical_order': 'order',
+    'payment_succeeded': 'payment',
+    'historical_payment': 'payment',
+    'refund_issued': 'refund',
+    'historical_refund': 'refund',
+    'shipment_updated': 'shipment',
+    'historical_shipment': 'shipment',
+    'order_updated': 'update',
+}
+
+# Flags raised while folding individual events; all others are re-derived from milestones
+FOLD_FLAGS = ('duplicate_order_created', 'shipment_status_regression')
+
+# Applied events are remembered as 64-bit digests of their event_id
+EVENT_DIGEST_BYTES = 8
+
+PROJECTION = {'_id': 0, 'event_id': 1, 'event_type': 1, 'event_time': 1, 'vendor': 1, 'payload': 1, 'order_key': 1, '_loaded_at': 1}
+
+
+def new_order_state(order_id: str) -> Dict[str, Any]:
+    """Empty compact state for an order that has not been seen before."""
+    return {
+        'order_id': order_id,
+        'status': 'unknown',
+        'vendor': None,
+        'created_at': None,
+        'total_amount': None,
+        'currency': None,
+        'total_amount_at': None,
+        'total_amount_event_id': None,
+        'paid_amount': 0.0,
+        'refunded_amount': 0.0,
+        'successful_payments': 0,
+        'failed_payments': 0,
+        'refunds': 0,
+        'updates': 0,
+        'first_paid_at': None,
+        'first_refunded_at': None,
+        'first_shipped_at': None,
+        'shipment_status': None,
+        'shipment_status_at': None,
+        'last_event_time': None,
+        'event_digests': set(),
+        'flags': [],
+    }
+
+
+def _latest_shipment_update(payload: Dict[str, Any], event_time: datetime):
+    """Return (status, time) of a shipment event, reading the last entry of historical status arrays."""
+    for field in SHIPMENT_HISTORY_FIELDS:
+        history = payload.get(field)
+        if history:
+            last = history[-1]
+            return last.get('status'), parse_timestamp(last.get('time')) or event_time
+    return first_present(payload, SHIPMENT_STATUS_FIELDS), parse_timestamp(first_present(payload, SHIPMENT_TIME_FIELDS)) or event_time
+
+
+def event_digest(event_id: Any) -> str:
+    return hashlib.blake2b(str(event_id).encode('utf-8'), digest_size=EVENT_DIGEST_BYTES).hexdigest()
+
+
+def _add_flag(state: Dict[str, Any], flag: str) -> None:
+    if flag not in state['flags']:
+        state['flags'].append(flag)
+
+
+def apply_event(state: Dict[str, Any], event: Dict[str, Any]) -> bool:
+    """
+    Fold a single event into an order state.
+
+    Amounts and counters are commutative and milestones keep the earliest event_time,
+    so the result does not depend on arrival order; the order amount is that of the
+    earliest order event (ties broken by event_id). Returns False if the event was
+    already applied or is of an unknown type.
+    """
+    kind = EVENT_KIND.get(event.get('event_type'))
+    event_id = decode_event_id(event.get('event_id'))
+    digest = event_digest(event_id)
+    if kind is None or digest in state['event_digests']:
+        return False
+
+    payload = event.get('payload') or {}
+    event_time = parse_timestamp(event.get('event_time'))
+    state['event_digests'].add(digest)
+    state['vendor'] = state['vendor'] or event.get('vendor')
+    if event_time and (state['last_event_time'] is None or event_time > state['last_event_time']):
+        state['last_event_time'] = event_time
+
+    if kind == 'order':
+        if state['created_at'] is not None:
+            _add_flag(state, 'duplicate_order_created')
+        if state['created_at'] is None or (event_time and event_time < state['created_at']):
+            state['created_at'] = event_time
+        current = (state['total_amount_at'] or datetime.max, state['total_amount_event_id'] or '')
+        if state['total_amount_event_id'] is None or (event_time or datetime.max, str(event_id)) < current:
+            state['total_amount'] = first_present(payload, ORDER_AMOUNT_FIELDS)
+            state['currency'] = first_present(payload, CURRENCY_FIELDS)
+            state['total_amount_at'] = event_time
+            state['total_amount_event_id'] = str(event_id)
+
+    elif kind == 'payment':
+        status = str(first_present(payload, PAYMENT_STATUS_FIELDS) or 'SUCCESS').upper()
+        if status == 'SUCCESS':
+            state['successful_payments'] += 1
+            state['paid_amount'] += float(first_present(payload, PAYMENT_AMOUNT_FIELDS) or 0)
+            if state['first_paid_at'] is None or (event_time and event_time < state['first_paid_at']):
+                state['first_paid_at'] = event_time
+        else:
+            state['failed_payments'] += 1
+
+    elif kind == 'refund':
+        state['refunds'] += 1
+        state['refunded_amount'] += float(first_present(payload, REFUND_AMOUNT_FIELDS) or 0)
+        if state['first_refunded_at'] is None or (event_time and event_time < state['first_refunded_at']):
+            state['first_refunded_at'] = event_time
+
+    elif kind == 'shipment':
+        status, status_time = _latest_shipment_update(payload, event_time)
+        if state['first_shipped_at'] is None or (status_time and status_time < state['first_shipped_at']):
+            state['first_shipped_at'] = status_time
+        current_at = state['shipment_status_at']
+        if current_at is None or (status_time and status_time >= current_at):
+            if SHIPMENT_RANK.get(status, -1) < SHIPMENT_RANK.get(state['shipment_status'], -1):
+                _add_flag(state, 'shipment_status_regression')
+            state['shipment_status'] = status
+            state['shipment_status_at'] = status_time
+
+    else:
+        state['updates'] += 1
+
+    return True
+
+
+def derive_status(state: Dict[str, Any]) -> str:
+    """Derive the current order status from the folded facts."""
+    if state['refunds'] and state['paid_amount'] and state['refunded_amount'] >= state['paid_amount']:
+        return 'refunded'
+    if state['refunds']:
+        return 'partially_refunded'
+    if state['shipment_status'] == 'DELIVERED':
+        return 'delivered'
+    if state['shipment_status']:
+        return 'shipped'
+    if state['successful_payments']:
+        return 'paid'
+    if state['failed_payments']:
+        return 'payment_failed'
+    if state['created_at']:
+        return 'created'
+    return 'unknown'
+
+
+def check_transitions(state: Dict[str, Any]) -> None:
+    """Re-evaluate the milestone-based flags; flags raised while folding are kept."""
+    flags = [f for f in state['flags'] if f in FOLD_FLAGS]
+    created_at = state['created_at']
+    first_paid_at = state['first_paid_at']
+    if created_at is None:
+        flags.append('missing_order_created')
+    elif first_paid_at and first_paid_at < created_at:
+        flags.append('paid_before_created')
+    if not state['successful_payments']:
+        if state['refunds']:
+            flags.append('refund_without_payment')
+        if state['first_shipped_at']:
+            flags.append('shipped_without_payment')
+    elif state['refunded_amount'] > state['paid_amount']:
+        flags.append('refund_exceeds_payment')
+    if state['first_refunded_at'] and first_paid_at and state['first_refunded_at'] < first_paid_at:
+        flags.append('refunded_before_paid')
+    state['flags'] = flags
+
+
+def fold_order_events(state: Dict[str, Any], events: List[Dict[str, Any]]) -> int:
+    """Apply a list of events for one order in event_time order and refresh status and flags."""
+    ordered = sorted(events, key=lambda e: parse_timestamp(e.get('event_time')) or datetime.min)
+    applied = sum(1 for event in ordered if apply_event(state, event))
+    if applied:
+        check_transitions(state)
+        state['status'] = derive_status(state)
+    return applied
+
+
+def load_order_states(collection, order_ids: List[str], chunk_size: int = 1000) -> Dict[str, Dict[str, Any]]:
+    """Fetch persisted states for the given orders only."""
+    states = {}
+    for start in range(0, len(order_ids), chunk_size):
+        chunk = order_ids[start:start + chunk_size]
+        for doc in collection.find({'order_id': {'$in': chunk}}, {'_id': 0}):
+            # States written before digests were introduced list the applied event_ids themselves
+            doc['event_digests'] = set(doc.get('event_digests') or []) | {event_digest(e) for e in doc.pop('event_ids', [])}
+            doc = {**new_order_state(doc['order_id']), **doc}
+            states[doc['order_id']] = doc
+    return states
+
+
+def state_document(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Order state as stored: the applied event digests as a sorted list."""
+    return {**state, 'event_digests': sorted(state['event_digests'])}
+
+
+def update_order_state(batch_size: int = 1000, full_refresh: bool = False, snapshot_dir: Optional[str] = None) -> Dict[str, int]:
+    """
+    Incrementally update the order_state collection from events loaded since the last run.
+
+    Only the orders touched by new events are read, folded and written back. With
+    snapshot_dir the states are rebuilt from the Parquet raw snapshot instead of
+    events_raw, and later runs continue from the snapshot's watermark.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    events = db['events_raw']
+    states_collection = db[ORDER_STATE_COLLECTION]
+    states_collection.create_index('order_id', unique=True)
+    states_collection.create_index('status')
+    states_collection.create_index('flags')
+
+    if snapshot_dir:
+        full_refresh = True
+        watermark = None
+        source = load_from_snapshot(snapshot_dir).to_dict('records')
+        print(f"Rebuilding order state from raw snapshot {snapshot_dir}...")
+    else:
+        watermark = None if full_refresh else get_watermark(db, WATERMARK_NAME)
+        source = events.find(loaded_after_query(watermark), PROJECTION).batch_size(batch_size)
+        print(f"Updating order state from events loaded after {watermark or 'the beginning'}...")
+
+    # Group new events by order reference
+    events_by_order = defaultdict(list)
+    new_watermark = watermark
+    skipped = 0
+    for event in source:
+        new_watermark = max_loaded_at(new_watermark, event)
+        order_id = event.get('order_key') or extract_order_id(event.get('payload') or {})
+        if not order_id or event.get('event_type') not in EVENT_KIND:
+            skipped += 1
+            continue
+        events_by_order[order_id].append(event)
+
+    order_ids = list(events_by_order)
+    states = {} if full_refresh else load_order_states(states_collection, order_ids)
+
+    stats = {'events_applied': 0, 'orders_touched': 0, 'events_skipped': skipped, 'flagged_orders': 0}
+    bulk_operations = []
+    for order_id in order_ids:
+        state = states.get(order_id) or new_order_state(order_id)
+        applied = fold_order_events(state, events_by_order[order_id])
+        if not applied:
+            continue
+        stats['events_applied'] += applied
+        stats['orders_touched'] += 1
+        if state['flags']:
+            stats['flagged_orders'] += 1
+        state['updated_at'] = datetime.now()
+        bulk_operations.append(UpdateOne({'order_id': order_id}, {'$set': state_document(state), '$unset': {'event_ids': ''}}, upsert=True))
+
+        if len(bulk_operations) >= batch_size:
+            states_collection.bulk_write(bulk_operations, ordered=False)
+            bulk_operations = []
+
+    if bulk_operations:
+        states_collection.bulk_write(bulk_operations, ordered=False)
+
+    if new_watermark is not None:
+        set_watermark(db, WATERMARK_NAME, new_watermark)
+
+    logging.info(f"Order state update: {stats}")
+    client.close()
+    return stats
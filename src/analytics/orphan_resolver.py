@@ -0,0 +1,138 @@
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, bulk_insert_dataframe
+
+QUARANTINE_TABLE = 'quarantined_facts'
+
+# Fact tables whose order_id column references orders(id), with their primary key column
+ORDER_FACT_TABLES = {
+    'payments': 'id',
+    'refunds': 'id',
+    'shipment_updates': 'id',
+    'order_items': 'id',
+    'order_updates': 'id',
+}
+
+release_quarantined_query = """
+DELETE FROM quarantined_facts
+WHERE order_id = ANY(:order_ids)
+RETURNING fact_table, row_id, row_data;
+"""
+
+# Rows already parked by an earlier run count as another failed attempt
+park_quarantined_query = """
+INSERT INTO quarantined_facts AS parked (fact_table, row_id, order_id, row_data, reason)
+SELECT :fact_table, row_id, order_id, CAST(row_data AS JSONB), :reason
+FROM UNNEST(CAST(:row_ids AS VARCHAR[]), CAST(:order_ids AS VARCHAR[]), CAST(:row_data AS TEXT[]))
+    AS orphan (row_id, order_id, row_data)
+ON CONFLICT (fact_table, row_id) DO UPDATE SET attempts = parked.attempts + 1;
+"""
+
+# Parked rows whose order was loaded without releasing them (e.g. a run that died in between)
+known_quarantined_orders_query = """
+SELECT DISTINCT quarantined_facts.order_id
+FROM quarantined_facts JOIN orders ON orders.id = quarantined_facts.order_id;
+"""
+
+
+class OrderReferenceResolver:
+    """
+    In-memory hash index of known order ids used to split fact batches before loading.
+
+    Rows whose order_id is known are loaded directly; the rest are parked in the
+    quarantined_facts table and re-matched in bulk when their order lands.
+    """
+
+    def __init__(self, known_order_ids: Optional[Iterable[str]] = None):
+        self.known_order_ids = set(known_order_ids or [])
+
+    def seed_from_postgres(self) -> int:
+        """Load every existing orders.id into the index and release rows parked for any of them."""
+        existing = execute_postgre_query("SELECT id FROM orders;")
+        if existing is not None and not existing.empty:
+            self.known_order_ids.update(existing['id'])
+        stranded = execute_postgre_query(known_quarantined_orders_query)
+        if stranded is not None and not stranded.empty:
+            release_quarantined(stranded['order_id'].tolist())
+        return len(self.known_order_ids)
+
+    def add_orders(self, order_ids: Iterable[str]) -> None:
+        self.known_order_ids.update(order_ids)
+
+    def split(self, df: pd.DataFrame, order_column: str = 'order_id') -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Split a fact batch into (resolvable, orphan) rows with one hash lookup per row."""
+        if df.empty:
+            return df, df
+        mask = df[order_column].isin(self.known_order_ids)
+        return df[mask], df[~mask]
+
+    def quarantine(self, orphans: pd.DataFrame, fact_table: str, reason: str = 'unknown_order_id') -> int:
+        """Park orphan rows in the quarantine table, keyed by (fact_table, row_id)."""
+        if orphans.empty:
+            return 0
+        key_column = ORDER_FACT_TABLES[fact_table]
+        records = json.loads(orphans.to_json(orient='records', date_format='iso'))
+        parked = pd.DataFrame({
+            'row_id': orphans[key_column].astype(str).tolist(),
+            'order_id': orphans['order_id'].tolist(),
+            'row_data': [json.dumps(record) for record in records],
+        }).drop_duplicates('row_id').sort_values('row_id')
+        engine = make_sqlalchemy_db_connection()
+        if not engine:
+            raise ValueError("Database connection engine is not initialized.")
+        with engine.begin() as connection:
+            connection.execute(text(park_quarantined_query), {
+                'fact_table': fact_table,
+                'reason': reason,
+                'row_ids': parked['row_id'].tolist(),
+                'order_ids': parked['order_id'].tolist(),
+                'row_data': parked['row_data'].tolist(),
+            })
+        return len(parked)
+
+    def load_fact_batch(self, df: pd.DataFrame, fact_table: str) -> Dict[str, int]:
+        """Bulk load the resolvable part of a fact batch and quarantine the orphans."""
+        resolvable, orphans = self.split(df)
+        loaded = bulk_insert_dataframe(resolvable, fact_table)
+        quarantined = self.quarantine(orphans, fact_table)
+        if quarantined:
+            logging.info(f"{fact_table}: {quarantined} row(s) quarantined with unknown order references")
+        return {'loaded': loaded, 'quarantined': quarantined}
+
+    def on_orders_loaded(self, order_ids: Iterable[str]) -> Dict[str, int]:
+        """Register newly loaded orders and re-attempt their quarantined fact rows in bulk."""
+        new_ids = [order_id for order_id in order_ids if order_id not in self.known_order_ids]
+        self.add_orders(new_ids)
+        if not new_ids:
+            return {}
+        return release_quarantined(new_ids)
+
+
+def release_quarantined(order_ids: List[str]) -> Dict[str, int]:
+    """
+    Move quarantined rows for the given orders into their fact tables.
+
+    The delete from quarantine and the fact inserts run in one transaction, so a
+    failed load leaves the rows parked for the next attempt.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+
+    released = {}
+    with engine.begin() as connection:
+        rows = connection.execute(text(release_quarantined_query), {'order_ids': list(order_ids)}).fetchall()
+        if not rows:
+            return released
+        by_table = {}
+        for fact_table, _, row_data in rows:
+            record = row_data if isinstance(row_data, dict) else json.loads(row_data)
+            by_table.setdefault(fact_table, []).append(record)
+        for fact_table, records in by_table.items():
+            released[fact_table] = bulk_insert_dataframe(pd.DataFrame(records), fact_table, connection=connection)
+
+    logging.info(f"Released quarantined rows: {released}")
+    return released
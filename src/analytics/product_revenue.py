@@ -0,0 +1,384 @@
+import logging
+import os
+from typing import Dict, Any, List, Optional, Tuple
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, get_mongo_client
+from ..raw_zone import decode_event_id
+from ..utility import parse_timestamp, first_present, extract_order_id
+from ..watermarks import get_watermark, set_watermark, loaded_after_query, max_loaded_at
+from .transform import (
+    ORDER_EVENT_TYPES, REFUND_EVENT_TYPES, REFUND_AMOUNT_FIELDS, CURRENCY_FIELDS, date_id, extract_items,
+)
+from .query_cache import cached_query, record_change
+
+WATERMARK_NAME = 'product_revenue'
+
+REFUND_ITEM_FIELDS = ['items', 'refunded_items', 'items_refunded']
+
+DELTA_KEY = ['date_id', 'sku', 'currency', 'vendor_id']
+DELTA_COLUMNS = DELTA_KEY + ['gross_revenue', 'refunded_amount', 'units_sold', 'units_refunded']
+PARKED_COLUMNS = ['source_key', 'order_id', 'date_id', 'currency', 'vendor_id', 'amount', 'reason']
+
+# Reasons a refund is parked: released once the order's lines load, or kept flagged
+LINES_NOT_LOADED = 'order_lines_not_loaded'
+CURRENCY_MISMATCH = 'currency_mismatch'
+
+# Source events already applied; a re-delivered order or refund claims the same key and is skipped
+claim_sources_query = """
+INSERT INTO sku_revenue_sources (source_key)
+SELECT UNNEST(CAST(:source_keys AS VARCHAR[]))
+ON CONFLICT DO NOTHING
+RETURNING source_key;
+"""
+
+# One statement per batch: the deltas are passed as column arrays
+apply_deltas_query = """
+INSERT INTO sku_daily_revenue AS current (date_id, sku, currency, vendor_id, gross_revenue, refunded_amount, units_sold, units_refunded)
+SELECT * FROM UNNEST(
+    CAST(:date_id AS INTEGER[]), CAST(:sku AS VARCHAR[]), CAST(:currency AS VARCHAR[]), CAST(:vendor_id AS VARCHAR[]),
+    CAST(:gross_revenue AS DECIMAL[]), CAST(:refunded_amount AS DECIMAL[]),
+    CAST(:units_sold AS DECIMAL[]), CAST(:units_refunded AS DECIMAL[])
+)
+ON CONFLICT (date_id, sku, currency, vendor_id) DO UPDATE SET
+    gross_revenue = current.gross_revenue + EXCLUDED.gross_revenue,
+    refunded_amount = current.refunded_amount + EXCLUDED.refunded_amount,
+    units_sold = current.units_sold + EXCLUDED.units_sold,
+    units_refunded = current.units_refunded + EXCLUDED.units_refunded;
+"""
+
+# Currency and lines of the orders of refunds: lines allocate refunds without item detail
+stored_orders_query = """
+SELECT orders.id AS order_id, orders.currency, order_items.product_id AS sku, order_items.quantity, order_items.price
+FROM orders
+LEFT JOIN order_items ON order_items.order_id = orders.id AND order_items.product_id IS NOT NULL
+WHERE orders.id = ANY(:order_ids)
+ORDER BY orders.id, order_items.id;
+"""
+
+park_refunds_query = """
+INSERT INTO parked_refunds (source_key, order_id, date_id, currency, vendor_id, amount, reason)
+SELECT * FROM UNNEST(
+    CAST(:source_key AS VARCHAR[]), CAST(:order_id AS VARCHAR[]), CAST(:date_id AS INTEGER[]),
+    CAST(:currency AS VARCHAR[]), CAST(:vendor_id AS VARCHAR[]), CAST(:amount AS DECIMAL[]), CAST(:reason AS VARCHAR[])
+)
+ON CONFLICT (source_key) DO NOTHING;
+"""
+
+# Parked refunds whose order lines have loaded since; a concurrent release skips the locked rows
+releasable_refunds_query = f"""
+SELECT source_key, order_id, date_id, currency, vendor_id, amount FROM parked_refunds AS parked
+WHERE reason = '{LINES_NOT_LOADED}'
+  AND EXISTS (SELECT 1 FROM order_items WHERE order_items.order_id = parked.order_id AND order_items.product_id IS NOT NULL)
+ORDER BY source_key
+FOR UPDATE SKIP LOCKED;
+"""
+
+delete_parked_refunds_query = "DELETE FROM parked_refunds WHERE source_key = ANY(:source_keys);"
+
+flag_parked_refunds_query = f"UPDATE parked_refunds SET reason = '{CURRENCY_MISMATCH}' WHERE source_key = ANY(:source_keys);"
+
+top_k_query = """
+SELECT * FROM (
+    SELECT
+        sku,
+        currency,
+        SUM(gross_revenue) AS gross_revenue,
+        SUM(refunded_amount) AS refunded_amount,
+        SUM(gross_revenue) - SUM(refunded_amount) AS net_revenue,
+        SUM(units_sold) AS units_sold,
+        SUM(units_refunded) AS units_refunded,
+        RANK() OVER (PARTITION BY currency ORDER BY SUM(gross_revenue) - SUM(refunded_amount) DESC) AS rank
+    FROM sku_daily_revenue
+    WHERE date_id BETWEEN :start_id AND :end_id {filters}
+    GROUP BY sku, currency
+) ranked
+WHERE rank <= :k
+ORDER BY currency, rank, sku;
+"""
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def source_key(event: Dict[str, Any], order_id: str) -> str:
+    """
+    Business event an order or refund event belongs to.
+
+    Orders are keyed on their id, so an order delivered again under another
+    event_id is applied once. Refunds are keyed on their event_id like the
+    refunds table: an order can be refunded more than once in the same second.
+    """
+    if event.get('event_type') in ORDER_EVENT_TYPES:
+        return f"order:{order_id}"
+    return f"refund:{decode_event_id(event.get('event_id'))}"
+
+
+def refund_lines(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Refunded (sku, quantity, amount) lines of a refund with item detail."""
+    for field in REFUND_ITEM_FIELDS:
+        items = payload.get(field)
+        if not items:
+            continue
+        lines = []
+        for item in items:
+            sku = item.get('sku') or item.get('productSku')
+            if not sku:
+                continue
+            quantity = _number(item.get('qty') or item.get('quantity'))
+            amount = item.get('amount')
+            if amount is None:
+                amount = quantity * _number(item.get('price') or item.get('unit_price'))
+            lines.append({'sku': sku, 'quantity': quantity, 'amount': _number(amount)})
+        return lines
+    return []
+
+
+def allocate_refund(amount: float, order_lines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Spread a refund without item detail over the order's lines, pro rata by line amount.
+
+    A full refund gives back every line and unit; rounding to cents leaves the
+    remainder on the largest line so the shares add up to the refund.
+    """
+    totals = [_number(line['quantity']) * _number(line['price']) for line in order_lines]
+    order_total = sum(totals)
+    if amount <= 0 or order_total <= 0:
+        return []
+    ratio = amount / order_total
+    lines = [{'sku': line['sku'], 'quantity': _number(line['quantity']) * ratio, 'amount': round(total * ratio, 2)}
+             for line, total in zip(order_lines, totals)]
+    largest = max(range(len(lines)), key=lambda index: totals[index])
+    lines[largest]['amount'] = round(lines[largest]['amount'] + amount - sum(line['amount'] for line in lines), 2)
+    return lines
+
+
+def stored_orders(order_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Currency and loaded order_items, as (sku, quantity, price) lines, of the given stored orders."""
+    if not order_ids:
+        return {}
+    stored = execute_postgre_query(stored_orders_query, {'order_ids': order_ids})
+    orders = {}
+    if stored is not None:
+        for row in stored.itertuples():
+            order = orders.setdefault(row.order_id, {'currency': row.currency, 'lines': []})
+            if row.sku is not None:
+                order['lines'].append({'sku': row.sku, 'quantity': row.quantity, 'price': row.price})
+    return orders
+
+
+def currency_mismatch(refund_currency: Optional[str], order_currency: Optional[str]) -> bool:
+    """True when a refund and its order both name a currency and the two differ."""
+    known = [currency for currency in (refund_currency, order_currency) if currency and currency != 'UNKNOWN']
+    return len(known) == 2 and known[0] != known[1]
+
+
+def refund_rows(common: Dict[str, Any], lines: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{**common, 'sku': line['sku'], 'gross_revenue': 0.0, 'refunded_amount': line['amount'],
+             'units_sold': 0.0, 'units_refunded': line['quantity']} for line in lines]
+
+
+def revenue_lines(events: List[Dict[str, Any]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Item-level revenue (order lines) and refund (refunded lines) rows of raw events.
+
+    Each row carries the source key identifying its business event (see
+    source_key), so a source is applied once however often it is delivered.
+    Refunds without item detail are allocated across the lines of their order,
+    taken from an order event of the batch or else from order_items.
+
+    Returns:
+        (lines, parked): refunds without item detail whose order lines are not
+        loaded yet, and refunds in another currency than their order, are
+        returned as parked rows instead of lines (see release_parked_refunds)
+    """
+    rows = []
+    parked = []
+    sources = set()
+    orders = {}
+    refunds = []
+    for event in events:
+        event_type = event.get('event_type')
+        if event_type not in ORDER_EVENT_TYPES and event_type not in REFUND_EVENT_TYPES:
+            continue
+        payload = event.get('payload') or {}
+        order_id = event.get('order_key') or extract_order_id(payload)
+        event_time = parse_timestamp(event.get('event_time'))
+        if not order_id or event_time is None:
+            continue
+        common = {
+            'date_id': date_id(event_time),
+            'currency': first_present(payload, CURRENCY_FIELDS) or 'UNKNOWN',
+            'vendor_id': event.get('vendor') or 'unknown',
+        }
+        key = source_key(event, order_id)
+        # Later deliveries of a source already in this batch are skipped like those of earlier batches
+        if key in sources:
+            continue
+        sources.add(key)
+        if event_type in ORDER_EVENT_TYPES:
+            items = [item for item in extract_items(payload) if item['sku']]
+            orders.setdefault(order_id, {'currency': common['currency'], 'lines': items})
+            for item in items:
+                quantity = _number(item['quantity'])
+                rows.append({**common, 'source_key': key, 'sku': item['sku'],
+                             'gross_revenue': quantity * _number(item['price']), 'refunded_amount': 0.0,
+                             'units_sold': quantity, 'units_refunded': 0.0})
+        else:
+            amount = _number(first_present(payload, REFUND_AMOUNT_FIELDS))
+            refunds.append((order_id, amount, refund_lines(payload), {**common, 'source_key': key}))
+
+    missing = sorted({refund[0] for refund in refunds if refund[0] not in orders})
+    orders.update(stored_orders(missing))
+    for order_id, amount, lines, common in refunds:
+        order = orders.get(order_id)
+        if order and currency_mismatch(common['currency'], order['currency']):
+            parked.append({**common, 'order_id': order_id, 'amount': amount, 'reason': CURRENCY_MISMATCH})
+            continue
+        if not lines and amount > 0:
+            if not order or not order['lines']:
+                parked.append({**common, 'order_id': order_id, 'amount': amount, 'reason': LINES_NOT_LOADED})
+                continue
+            lines = allocate_refund(amount, order['lines'])
+        rows.extend(refund_rows(common, lines))
+    return pd.DataFrame(rows, columns=['source_key'] + DELTA_COLUMNS), pd.DataFrame(parked, columns=PARKED_COLUMNS)
+
+
+def _apply_deltas(connection, lines: pd.DataFrame) -> pd.DataFrame:
+    """Sum lines into per-(day, SKU, currency, vendor) deltas and add them to sku_daily_revenue."""
+    # Sorted keys keep concurrent runs from deadlocking on the same rows
+    deltas = lines.groupby(DELTA_KEY, as_index=False)[DELTA_COLUMNS[len(DELTA_KEY):]].sum().sort_values(DELTA_KEY)
+    connection.execute(text(apply_deltas_query), {column: deltas[column].tolist() for column in DELTA_COLUMNS})
+    return deltas
+
+
+def apply_revenue_deltas(lines: pd.DataFrame, parked: Optional[pd.DataFrame] = None) -> Dict[str, int]:
+    """
+    Add the lines of not-yet-applied source events to the per-SKU-per-day table.
+
+    Claiming the sources, applying the summed deltas and parking the refunds that
+    cannot be applied yet run in one transaction, so a failed or concurrent run
+    never counts an order or a refund twice.
+    """
+    stats = {'sources_applied': 0, 'delta_rows': 0, 'refunds_parked': 0}
+    parked = parked if parked is not None else pd.DataFrame(columns=PARKED_COLUMNS)
+    source_keys = sorted(set(lines['source_key']) | set(parked['source_key']))
+    if not source_keys:
+        return stats
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+
+    with engine.begin() as connection:
+        claimed = connection.execute(text(claim_sources_query), {'source_keys': source_keys}).scalars().all()
+        new_lines = lines[lines['source_key'].isin(claimed)]
+        new_parked = parked[parked['source_key'].isin(claimed)]
+        if not new_parked.empty:
+            connection.execute(text(park_refunds_query), {column: new_parked[column].tolist() for column in PARKED_COLUMNS})
+        deltas = _apply_deltas(connection, new_lines) if not new_lines.empty else None
+    stats.update(sources_applied=len(claimed), refunds_parked=len(new_parked))
+    if deltas is not None:
+        stats['delta_rows'] = len(deltas)
+        record_change(['sku_daily_revenue', 'sku_revenue_sources'], deltas['date_id'], 'product_revenue')
+    return stats
+
+
+def release_parked_refunds() -> Dict[str, int]:
+    """
+    Allocate the parked refunds whose order lines have loaded since they were parked.
+
+    A refund whose order turns out to be in another currency stays parked, flagged
+    as a currency mismatch. Reading, allocating and releasing run in one transaction.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+
+    stats = {'refunds_released': 0, 'currency_mismatches': 0}
+    with engine.begin() as connection:
+        releasable = connection.execute(text(releasable_refunds_query)).mappings().all()
+        if not releasable:
+            return stats
+        orders = stored_orders(sorted({refund['order_id'] for refund in releasable}))
+        rows = []
+        released = []
+        mismatched = []
+        for refund in releasable:
+            order = orders.get(refund['order_id'], {'currency': None, 'lines': []})
+            if currency_mismatch(refund['currency'], order['currency']):
+                mismatched.append(refund['source_key'])
+                continue
+            common = {column: refund[column] for column in ('source_key', 'date_id', 'currency', 'vendor_id')}
+            rows.extend(refund_rows(common, allocate_refund(_number(refund['amount']), order['lines'])))
+            released.append(refund['source_key'])
+        if mismatched:
+            connection.execute(text(flag_parked_refunds_query), {'source_keys': mismatched})
+        if released:
+            connection.execute(text(delete_parked_refunds_query), {'source_keys': released})
+        deltas = _apply_deltas(connection, pd.DataFrame(rows, columns=['source_key'] + DELTA_COLUMNS)) if rows else None
+    stats.update(refunds_released=len(released), currency_mismatches=len(mismatched))
+    if deltas is not None:
+        record_change(['sku_daily_revenue'], deltas['date_id'], 'product_revenue')
+    return stats
+
+
+def update_product_revenue(batch_size: int = 5000) -> Dict[str, int]:
+    """Fold order and refund events loaded since the last run into sku_daily_revenue."""
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    watermark = get_watermark(db, WATERMARK_NAME)
+    query = {'$and': [
+        loaded_after_query(watermark),
+        {'event_type': {'$in': list(ORDER_EVENT_TYPES) + list(REFUND_EVENT_TYPES)}},
+    ]}
+
+    totals = {'sources_applied': 0, 'delta_rows': 0, 'refunds_parked': 0}
+    new_watermark = watermark
+    chunk = []
+    cursor = db['events_raw'].find(query, {'_id': 0}).batch_size(1000)
+    for event in cursor:
+        new_watermark = max_loaded_at(new_watermark, event)
+        chunk.append(event)
+        if len(chunk) >= batch_size:
+            for key, count in apply_revenue_deltas(*revenue_lines(chunk)).items():
+                totals[key] += count
+            chunk = []
+    if chunk:
+        for key, count in apply_revenue_deltas(*revenue_lines(chunk)).items():
+            totals[key] += count
+    # Refunds parked by this or earlier runs whose orders the transform has loaded since
+    totals.update(release_parked_refunds())
+
+    if new_watermark is not None:
+        set_watermark(db, WATERMARK_NAME, new_watermark)
+    client.close()
+    logging.info(f"Product revenue deltas: {totals}")
+    return totals
+
+
+def top_products(
+    start: str,
+    end: str,
+    k: int = 10,
+    currency: Optional[str] = None,
+    vendor: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Top k SKUs by net revenue (order lines minus refunded lines) between start and end (YYYY-MM-DD).
+
+    Answered from the pre-aggregated sku_daily_revenue rows; amounts are never
+    summed across currencies, so SKUs are ranked within each currency.
+    """
+    filters = ''
+    params = {'start_id': int(start.replace('-', '')), 'end_id': int(end.replace('-', '')), 'k': k}
+    if currency:
+        filters += ' AND currency = :currency'
+        params['currency'] = currency
+    if vendor:
+        filters += ' AND vendor_id = :vendor'
+        params['vendor'] = vendor
+    return cached_query(top_k_query.format(filters=filters), params, date_range=(params['start_id'], params['end_id']))
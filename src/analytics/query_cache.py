@@ -0,0 +1,274 @@
+"""
+Result cache for the analytics read path (top products, latency percentiles, anomalies).
+
+Results are keyed by the whitespace-normalised SQL and its parameters and kept in
+memory under a byte budget with LRU eviction; evicted results can spill to Parquet.
+Every load records the tables and date_ids it changed in a change log next to the
+pipeline watermarks. Before serving a read, the cache applies the changes recorded
+since its last check (at most once per max_staleness seconds, so repeated reads in
+between need no round trip at all) and drops only the results they affect.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+import pandas as pd
+from pymongo import ReturnDocument
+from config import configs
+from ..DB_connection import execute_postgre_query, get_mongo_client
+from ..watermarks import WATERMARK_COLLECTION
+
+CHANGE_LOG_COLLECTION = 'analytics_changes'
+
+# Document of the watermark collection allocating change sequence numbers
+CHANGE_SEQUENCE_ID = 'analytics_changes_seq'
+
+# Change records expire after this long; a cache idle for longer starts over
+CHANGE_LOG_RETENTION_SECONDS = 7 * 24 * 3600
+
+# Sequence numbers re-read on every check, so a change whose number was allocated
+# before a later one's but inserted after it is still applied
+REREAD_WINDOW = 32
+
+DEFAULT_MAX_BYTES = int(configs['QUERY_CACHE_MAX_MB']) * 2**20
+DEFAULT_MAX_SPILL_BYTES = 512 * 2**20
+
+# Longest time a cached result may be served without checking the change log
+DEFAULT_MAX_STALENESS_SECONDS = 2.0
+
+TABLE_PATTERN = re.compile(r'\b(?:from|join)\s+(?:[a-z_][a-z0-9_]*\.)?([a-z_][a-z0-9_]*)', re.IGNORECASE)
+
+# (first, last) date_id (YYYYMMDD) a result depends on; None at either end is open
+DateRange = Tuple[Optional[int], Optional[int]]
+
+
+def record_change(tables: Optional[Iterable[str]], date_ids: Optional[Iterable[int]] = None, job: Optional[str] = None) -> None:
+    """
+    Log that a committed load changed tables (None: every table), limited to the
+    given date_ids or on any date when None.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    db[CHANGE_LOG_COLLECTION].create_index('recorded_at', expireAfterSeconds=CHANGE_LOG_RETENTION_SECONDS)
+    sequence = db[WATERMARK_COLLECTION].find_one_and_update(
+        {'_id': CHANGE_SEQUENCE_ID}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER
+    )['seq']
+    db[CHANGE_LOG_COLLECTION].insert_one({
+        '_id': sequence,
+        'tables': sorted(set(tables)) if tables is not None else None,
+        'date_ids': sorted({int(date_id) for date_id in date_ids}) if date_ids is not None else None,
+        'job': job,
+        'recorded_at': datetime.now(),
+    })
+    client.close()
+
+
+def normalise_query(query: str) -> str:
+    return ' '.join(query.split()).rstrip(';').strip()
+
+
+def cache_key(query: str, params: Optional[Dict[str, Any]]) -> str:
+    frozen = json.dumps([normalise_query(query), sorted((params or {}).items())], default=str)
+    return hashlib.sha1(frozen.encode('utf-8')).hexdigest()
+
+
+def query_tables(query: str) -> frozenset:
+    """Tables a SELECT reads (FROM and JOIN targets, without schema)."""
+    return frozenset(name.lower() for name in TABLE_PATTERN.findall(query))
+
+
+def affects(entry: Dict[str, Any], tables: Optional[List[str]], date_ids: Optional[List[int]]) -> bool:
+    if tables is not None and not entry['tables'] & set(tables):
+        return False
+    if date_ids is None or entry['date_range'] is None:
+        return True
+    start, end = entry['date_range']
+    return any((start is None or date_id >= start) and (end is None or date_id <= end) for date_id in date_ids)
+
+
+class QueryResultCache:
+    """Size-bounded LRU of query results, invalidated from the analytics change log."""
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        spill_dir: Optional[str] = None,
+        max_spill_bytes: int = DEFAULT_MAX_SPILL_BYTES,
+        max_staleness: float = DEFAULT_MAX_STALENESS_SECONDS,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.max_staleness = max_staleness
+        # key -> {'frame', 'tables', 'date_range', 'nbytes'}; spilled entries hold 'path' instead of 'frame'
+        self.entries: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.spilled: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.bytes = 0
+        self.spill_bytes = 0
+        self.last_sequence = None
+        self.applied = set()
+        self.checked_at = None
+        self.spill_dir_ready = False
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'spill_hits': 0, 'misses': 0, 'evictions': 0, 'spills': 0, 'invalidated': 0}
+
+    def query(
+        self,
+        query: str,
+        params: Optional[Dict[str, Any]] = None,
+        tables: Optional[Iterable[str]] = None,
+        date_range: Optional[DateRange] = None,
+    ) -> Optional[pd.DataFrame]:
+        """
+        Result of a SELECT, from the cache when no change since it was read touches its
+        tables (default: those named in the query) within date_range (default: any date).
+        """
+        if self.max_bytes <= 0:
+            return execute_postgre_query(query, params)
+        self.refresh()
+        key = cache_key(query, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry['frame'].copy()
+            spilled = self.spilled.pop(key, None)
+            if spilled is not None:
+                self.spill_bytes -= spilled['nbytes']
+        if spilled is not None:
+            frame = pd.read_parquet(spilled['path'])
+            os.remove(spilled['path'])
+            self.stats['spill_hits'] += 1
+            self.store(key, frame, spilled['tables'], spilled['date_range'])
+            return frame.copy()
+
+        self.stats['misses'] += 1
+        sequence = self.last_sequence
+        frame = execute_postgre_query(query, params)
+        if frame is not None:
+            self.store(key, frame, frozenset(tables) if tables is not None else query_tables(query), date_range, sequence)
+            frame = frame.copy()
+        return frame
+
+    def store(self, key: str, frame: pd.DataFrame, tables: frozenset, date_range: Optional[DateRange], sequence: Optional[int] = None) -> None:
+        nbytes = int(frame.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            # Another thread applied changes while the query ran; the result may predate them
+            if sequence is not None and sequence != self.last_sequence:
+                return
+            replaced = self.entries.pop(key, None)
+            if replaced is not None:
+                self.bytes -= replaced['nbytes']
+            self.entries[key] = {'frame': frame, 'tables': tables, 'date_range': date_range, 'nbytes': nbytes}
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted['nbytes']
+                self.stats['evictions'] += 1
+                if self.spill_dir:
+                    self.spill(evicted_key, evicted)
+
+    def spill(self, key: str, entry: Dict[str, Any]) -> None:
+        """Write an evicted result to Parquet, dropping the oldest spilled results beyond the disk budget."""
+        if not self.spill_dir_ready:
+            # Files left by an earlier process are not indexed and cannot be validated
+            os.makedirs(self.spill_dir, exist_ok=True)
+            for name in os.listdir(self.spill_dir):
+                if name.endswith('.parquet'):
+                    os.remove(os.path.join(self.spill_dir, name))
+            self.spill_dir_ready = True
+        path = os.path.join(self.spill_dir, f"{key}.parquet")
+        try:
+            entry['frame'].to_parquet(path, index=False)
+        except (ImportError, ValueError, TypeError) as e:
+            # No Parquet engine, or columns Arrow cannot represent (e.g. mixed JSON objects)
+            logging.debug(f"Query result not spilled: {e}")
+            return
+        nbytes = os.path.getsize(path)
+        self.spilled[key] = {'path': path, 'tables': entry['tables'], 'date_range': entry['date_range'], 'nbytes': nbytes}
+        self.spill_bytes += nbytes
+        self.stats['spills'] += 1
+        while self.spill_bytes > self.max_spill_bytes:
+            _, dropped = self.spilled.popitem(last=False)
+            self.spill_bytes -= dropped['nbytes']
+            os.remove(dropped['path'])
+
+    def refresh(self, force: bool = False) -> None:
+        """Apply the changes recorded since the last check to the cached results."""
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.max_staleness:
+            return
+        if self.checked_at is not None and now - self.checked_at > CHANGE_LOG_RETENTION_SECONDS:
+            self.clear()
+        self.checked_at = now
+
+        client = get_mongo_client()
+        changes = client[os.getenv('MONGO_DB')][CHANGE_LOG_COLLECTION]
+        with self.lock:
+            if self.last_sequence is None:
+                # Results cached from now on include every change recorded so far
+                latest = changes.find_one(sort=[('_id', -1)])
+                self.last_sequence = latest['_id'] if latest else 0
+                self.applied = {change['_id'] for change in changes.find({'_id': {'$gt': self.last_sequence - REREAD_WINDOW}}, {'_id': 1})}
+            else:
+                for change in changes.find({'_id': {'$gt': self.last_sequence - REREAD_WINDOW}}).sort('_id', 1):
+                    if change['_id'] in self.applied:
+                        continue
+                    self.applied.add(change['_id'])
+                    self.invalidate(change['tables'], change['date_ids'])
+                    self.last_sequence = max(self.last_sequence, change['_id'])
+                self.applied = {sequence for sequence in self.applied if sequence > self.last_sequence - REREAD_WINDOW}
+        client.close()
+
+    def invalidate(self, tables: Optional[List[str]], date_ids: Optional[List[int]] = None) -> int:
+        """Drop the results that depend on tables (None: all) within date_ids (None: any date)."""
+        dropped = 0
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if affects(entry, tables, date_ids):
+                    del self.entries[key]
+                    self.bytes -= entry['nbytes']
+                    dropped += 1
+            for key, entry in list(self.spilled.items()):
+                if affects(entry, tables, date_ids):
+                    del self.spilled[key]
+                    self.spill_bytes -= entry['nbytes']
+                    os.remove(entry['path'])
+                    dropped += 1
+        self.stats['invalidated'] += dropped
+        return dropped
+
+    def clear(self) -> None:
+        self.invalidate(None)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'spilled_entries': len(self.spilled),
+            'spilled_bytes': self.spill_bytes,
+        }
+
+
+# Shared by the read functions of this process
+QUERY_CACHE = QueryResultCache(spill_dir=configs['QUERY_CACHE_SPILL_DIR'])
+
+
+def cached_query(
+    query: str,
+    params: Optional[Dict[str, Any]] = None,
+    tables: Optional[Iterable[str]] = None,
+    date_range: Optional[DateRange] = None,
+) -> Optional[pd.DataFrame]:
+    """execute_postgre_query for analytics reads, served from the process-wide result cache."""
+    return QUERY_CACHE.query(query, params, tables, date_range)
@@ -0,0 +1,299 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List, Optional
+from sqlalchemy import text
+from .. import DB_connection
+from ..DB_connection import get_mongo_client, make_sqlalchemy_db_connection, execute_postgre_query
+from ..raw_snapshot import load_from_snapshot
+from ..watermarks import reset_watermark
+from . import latency_metrics, product_revenue, revenue_history
+from .create_tables import create_tables_if_not_exists
+from .orphan_resolver import OrderReferenceResolver
+from .transform import FACT_TABLES, normalise_events, load_normalised, transform_lock
+from .query_cache import record_change
+
+LIVE_SCHEMA = 'public'
+SHADOW_SCHEMA = 'analytics_next'
+PREVIOUS_SCHEMA = 'analytics_prev'
+
+# Tables moved by the swap, children after parents
+SWAPPED_TABLES = [
+    'dates', 'address', 'vendors', 'order_timeline', 'customers', 'customer_identities', 'products', 'orders',
+    'order_items', 'order_updates', 'shipments', 'shipment_updates', 'refunds',
+    'refund_items', 'payments', 'quarantined_facts',
+]
+
+# Tables the incremental jobs derive from events_raw and the model, with the tables recording
+# which sources they already applied. They are swapped in empty, so their next runs rebuild
+# them from the beginning instead of adding to totals computed against the replaced model.
+DERIVED_TABLES = [
+    'metric_observations', 'metric_sketches',
+    'sku_daily_revenue', 'sku_revenue_sources', 'parked_refunds',
+    'daily_revenue_history', 'daily_revenue_history_sources',
+    # The detector's watermark is saved with its state
+    'anomalies', 'anomaly_detector_state', 'anomaly_observed_events',
+]
+
+# Watermarks of the jobs rebuilding DERIVED_TABLES, reset once the empty tables are live
+DERIVED_WATERMARKS = [latency_metrics.WATERMARK_NAME, product_revenue.WATERMARK_NAME, revenue_history.WATERMARK_NAME]
+
+# Fact tables partitioned by event time; rows outside the reprocessed range are carried over
+TIME_COLUMNS = {
+    'orders': 'created_at',
+    'payments': 'payment_date',
+    'refunds': 'refunded_at',
+    'order_updates': 'updated_at',
+    'shipment_updates': 'updated_at',
+}
+
+# Child tables carried over with their parent rows: (table, foreign key, parent table)
+CHILD_TABLES = [('order_items', 'order_id', 'orders'), ('refund_items', 'refund_id', 'refunds')]
+
+# Tables referencing orders, carried over once the rebuilt orders exist
+ORDER_CHILD_TABLES = [
+    'order_items', 'order_updates', 'shipment_updates', 'refunds', 'refund_items', 'payments',
+]
+
+# Key column used for the per-table checksum
+CHECKSUM_KEYS = {
+    'dates': 'date_id',
+    'customer_identities': "identifier_hash || ':' || customer_id",
+    'quarantined_facts': "fact_table || ':' || row_id",
+}
+
+table_fingerprint_query = """
+SELECT COUNT(*) AS row_count, COALESCE(MD5(STRING_AGG(({key})::text, ',' ORDER BY ({key})::text)), '') AS checksum
+FROM {schema}.{table};
+"""
+
+
+def daterange(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+def day_events_query(day: date) -> Dict[str, Any]:
+    """events_raw filter for one event_time day; live events loaded before compaction hold ISO strings."""
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    return {'$or': [
+        {'event_time': {'$gte': start, '$lt': end}},
+        {'event_time': {'$gte': start.strftime('%Y-%m-%d'), '$lt': end.strftime('%Y-%m-%d')}},
+    ]}
+
+
+def read_day_events(day: date, snapshot_dir: Optional[str] = None) -> List[Dict[str, Any]]:
+    if snapshot_dir:
+        iso_day = day.isoformat()
+        return load_from_snapshot(snapshot_dir, start_date=iso_day, end_date=iso_day).to_dict('records')
+    client = get_mongo_client()
+    collection = client[os.getenv('MONGO_DB')]['events_raw']
+    events = list(collection.find(day_events_query(day), {'_id': 0}))
+    client.close()
+    return events
+
+
+def _process_day(day: date, phase: str, snapshot_dir: Optional[str]) -> Dict[str, int]:
+    """
+    Worker: normalise one day of raw events and bulk load it into the shadow schema.
+
+    Phase 'orders' loads dimensions, orders and shipments; phase 'facts' loads the order
+    facts once every day's orders exist, so cross-day references resolve.
+    """
+    DB_connection.use_schema(SHADOW_SCHEMA)
+    frames = normalise_events(read_day_events(day, snapshot_dir))
+    if phase == 'orders':
+        for table in FACT_TABLES:
+            frames[table] = frames[table].iloc[0:0]
+        resolver = OrderReferenceResolver()
+    else:
+        # Shipments were upserted with the orders; their updates load with the other facts
+        for table in ('orders', 'shipments'):
+            frames[table] = frames[table].iloc[0:0]
+        frames['customer_records'] = frames['customer_records'].iloc[0:0]
+        resolver = OrderReferenceResolver()
+        resolver.seed_from_postgres()
+    return load_normalised(frames, resolver)
+
+
+def prepare_shadow_schema() -> None:
+    """Recreate the shadow schema with the current table definitions."""
+    execute_postgre_query(f"DROP SCHEMA IF EXISTS {SHADOW_SCHEMA} CASCADE;")
+    execute_postgre_query(f"CREATE SCHEMA {SHADOW_SCHEMA};")
+    DB_connection.use_schema(SHADOW_SCHEMA)
+    try:
+        create_tables_if_not_exists()
+    finally:
+        DB_connection.use_schema(None)
+
+
+def carry_over_outside_range(start: date, end: date, tables: List[str]) -> None:
+    """
+    Copy live rows that fall outside [start, end] into the shadow schema.
+
+    Dimension tables are copied whole; facts only keep rows whose parent order
+    exists in the shadow, so carried rows never violate foreign keys. Child rows
+    follow their parent's time, so those of rebuilt parents are not carried.
+    """
+    lower = datetime.combine(start, datetime.min.time())
+    upper = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    children = {child: (column, parent) for child, column, parent in CHILD_TABLES}
+    for table in tables:
+        source = f"{LIVE_SCHEMA}.{table}"
+        target = f"{SHADOW_SCHEMA}.{table}"
+        if table in TIME_COLUMNS:
+            condition = f"({TIME_COLUMNS[table]} < :lower OR {TIME_COLUMNS[table]} >= :upper)"
+            if table != 'orders':
+                condition += f" AND order_id IN (SELECT id FROM {SHADOW_SCHEMA}.orders)"
+        elif table in children:
+            # Only children of parents outside the range; those of rebuilt parents are rebuilt too
+            column, parent = children[table]
+            parent_time = TIME_COLUMNS[parent]
+            condition = (
+                f"{column} IN (SELECT id FROM {LIVE_SCHEMA}.{parent}"
+                f" WHERE {parent_time} < :lower OR {parent_time} >= :upper)"
+                f" AND {column} IN (SELECT id FROM {SHADOW_SCHEMA}.{parent})"
+            )
+        else:
+            condition = "TRUE"
+        execute_postgre_query(
+            f"INSERT INTO {target} SELECT * FROM {source} WHERE {condition} ON CONFLICT DO NOTHING;",
+            {'lower': lower, 'upper': upper}
+        )
+
+
+def table_fingerprints(schema: str) -> Dict[str, Dict[str, Any]]:
+    """Row count and an MD5 over the sorted keys of every swapped table in a schema."""
+    fingerprints = {}
+    for table in SWAPPED_TABLES:
+        exists = execute_postgre_query(
+            "SELECT to_regclass(:name) IS NOT NULL AS present;", {'name': f"{schema}.{table}"}
+        )
+        if not bool(exists['present'].iloc[0]):
+            fingerprints[table] = {'row_count': 0, 'checksum': ''}
+            continue
+        key = CHECKSUM_KEYS.get(table, 'id')
+        result = execute_postgre_query(table_fingerprint_query.format(key=key, schema=schema, table=table))
+        fingerprints[table] = {'row_count': int(result['row_count'].iloc[0]), 'checksum': result['checksum'].iloc[0]}
+    return fingerprints
+
+
+def validate_shadow(max_row_loss: float = 0.0) -> Dict[str, Any]:
+    """
+    Compare the shadow schema against the live one.
+
+    A table that lost more than max_row_loss of its live rows makes the shadow
+    invalid. Tables whose checksums differ are listed under 'changed'; the swap
+    only replaces them when the changes are accepted.
+    """
+    live = table_fingerprints(LIVE_SCHEMA)
+    shadow = table_fingerprints(SHADOW_SCHEMA)
+    report = {'tables': {}, 'blocking': [], 'changed': []}
+    for table in SWAPPED_TABLES:
+        live_rows, shadow_rows = live[table]['row_count'], shadow[table]['row_count']
+        report['tables'][table] = {
+            'live_rows': live_rows,
+            'shadow_rows': shadow_rows,
+            'changed': live[table]['checksum'] != shadow[table]['checksum'],
+        }
+        if report['tables'][table]['changed']:
+            report['changed'].append(table)
+        # Quarantine is expected to shrink as orphans resolve
+        if table != 'quarantined_facts' and live_rows and shadow_rows < live_rows * (1 - max_row_loss):
+            report['blocking'].append(table)
+    report['valid'] = not report['blocking']
+    return report
+
+
+def swap_schemas() -> None:
+    """
+    Atomically move the shadow tables into the live schema.
+
+    Live tables are moved aside into analytics_prev (kept for rollback) in the same
+    transaction, so readers see either the old or the new model, never a mix. The
+    derived tables are replaced by empty ones and their jobs' watermarks reset.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {PREVIOUS_SCHEMA} CASCADE;"))
+        connection.execute(text(f"CREATE SCHEMA {PREVIOUS_SCHEMA};"))
+        for table in SWAPPED_TABLES + DERIVED_TABLES:
+            connection.execute(text(f"ALTER TABLE IF EXISTS {LIVE_SCHEMA}.{table} SET SCHEMA {PREVIOUS_SCHEMA};"))
+            connection.execute(text(f"ALTER TABLE {SHADOW_SCHEMA}.{table} SET SCHEMA {LIVE_SCHEMA};"))
+        connection.execute(text(f"DROP SCHEMA {SHADOW_SCHEMA} CASCADE;"))
+    # After the commit: a job run in between claims its sources in the empty tables, and
+    # its full rebuild skips them
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    for job_name in DERIVED_WATERMARKS:
+        reset_watermark(db, job_name)
+    client.close()
+    record_change(SWAPPED_TABLES + DERIVED_TABLES, None, 'reprocess')
+
+
+def run_phase(days: List[date], phase: str, workers: int, snapshot_dir: Optional[str]) -> Dict[str, int]:
+    totals = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_process_day, day, phase, snapshot_dir) for day in days]
+        for future in futures:
+            for table, count in future.result().items():
+                totals[table] = totals.get(table, 0) + count
+    return totals
+
+
+def reprocess(
+    start: str,
+    end: str,
+    workers: Optional[int] = None,
+    snapshot_dir: Optional[str] = None,
+    max_row_loss: float = 0.0,
+    swap: bool = True,
+    accept_changes: bool = False,
+) -> Dict[str, Any]:
+    """
+    Rebuild the Postgres model from raw events for an event_time date range.
+
+    Args:
+        start: First day to rebuild (YYYY-MM-DD)
+        end: Last day to rebuild (YYYY-MM-DD)
+        workers: Size of the process pool (defaults to the number of CPUs)
+        snapshot_dir: Read from the Parquet raw snapshot instead of events_raw
+        max_row_loss: Tolerated fraction of rows lost per table before the swap is refused
+        swap: Set to False to build and validate the shadow schema only
+        accept_changes: Swap even when table checksums differ from the live ones
+    Returns:
+        Load totals and the validation report
+    """
+    days = daterange(date.fromisoformat(start), date.fromisoformat(end))
+    workers = workers or os.cpu_count()
+    print(f"Reprocessing {len(days)} day(s) into {SHADOW_SCHEMA} with {workers} worker(s)...")
+
+    prepare_shadow_schema()
+    # Live transforms wait from the carry-over until the swap; the workers only take the
+    # identity lock, which live writers take inside the transform lock
+    with transform_lock():
+        # Parents first: dimensions and orders outside the range, then the rebuilt orders
+        carry_over_outside_range(days[0], days[-1], [t for t in SWAPPED_TABLES if t not in ORDER_CHILD_TABLES])
+        loaded = run_phase(days, 'orders', workers, snapshot_dir)
+        carry_over_outside_range(days[0], days[-1], ORDER_CHILD_TABLES)
+        facts = run_phase(days, 'facts', workers, snapshot_dir)
+        for table, count in facts.items():
+            loaded[table] = loaded.get(table, 0) + count
+
+        report = validate_shadow(max_row_loss)
+        logging.info(f"Shadow validation: {report}")
+        swapped = False
+        if not report['valid']:
+            print(f"Shadow schema kept for inspection; tables losing rows: {report['blocking']}")
+        elif report['changed'] and not accept_changes:
+            print(f"Shadow schema kept for review; tables with changed contents: {report['changed']} "
+                  f"(rerun with --accept-changes to swap them in)")
+        elif swap:
+            swap_schemas()
+            swapped = True
+            print(f"Swapped {SHADOW_SCHEMA} into {LIVE_SCHEMA}; previous tables kept in {PREVIOUS_SCHEMA}")
+
+    return {'loaded': loaded, 'validation': report, 'swapped': swapped}
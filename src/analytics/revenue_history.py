@@ -0,0 +1,382 @@
+"""
+Bitemporal daily revenue: what each day's revenue looked like at every reporting time.
+
+Every (event day, currency, vendor) total is stored as a series of versions, each
+valid for reports made from known_from until known_to (NULL: the current one). An
+event changes the totals of the day of its event_time from its ingested_at on, so
+a refund ingested days after its order restates a day that was already reported.
+Incremental runs only append versions for the days their events changed; "as
+reported at X" and restatement queries are range lookups on the version table.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Union
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import make_sqlalchemy_db_connection, get_mongo_client
+from ..utility import parse_timestamp, first_present, extract_order_id
+from ..watermarks import WATERMARK_FIELD, get_watermark, set_watermark, loaded_after_query, max_loaded_at
+from .transform import (
+    ORDER_EVENT_TYPES, REFUND_EVENT_TYPES, ORDER_AMOUNT_FIELDS, REFUND_AMOUNT_FIELDS, CURRENCY_FIELDS, date_id,
+)
+from .product_revenue import source_key
+from .query_cache import cached_query, record_change
+
+WATERMARK_NAME = 'revenue_history'
+
+HISTORY_TABLES = ['daily_revenue_history', 'daily_revenue_history_sources']
+
+VERSION_KEY = ['date_id', 'currency', 'vendor_id']
+MEASURES = ['gross_revenue', 'refunded_amount', 'orders', 'refunds']
+VERSION_COLUMNS = VERSION_KEY + MEASURES + ['known_from', 'known_to']
+
+PROJECTION = {
+    '_id': 0, 'event_id': 1, 'event_type': 1, 'event_time': 1, 'ingested_at': 1, 'vendor': 1,
+    'payload': 1, 'order_key': 1, '_bootstrapped': 1, WATERMARK_FIELD: 1,
+}
+
+# Writers of the version table run one at a time (batch job and change stream sync)
+lock_history_query = "SELECT pg_advisory_xact_lock(hashtext('daily_revenue_history'));"
+
+# Source events already applied; a re-delivered order or refund claims the same key and is skipped
+claim_sources_query = """
+INSERT INTO daily_revenue_history_sources (source_key, known_at)
+SELECT * FROM UNNEST(CAST(:source_keys AS VARCHAR[]), CAST(:known_at AS TIMESTAMP[]))
+ON CONFLICT DO NOTHING
+RETURNING source_key;
+"""
+
+# Versions of the changed days still valid at or after the earliest new knowledge time of each
+affected_versions_query = """
+SELECT h.date_id, h.currency, h.vendor_id, h.gross_revenue, h.refunded_amount, h.orders, h.refunds,
+       h.known_from, h.known_to
+FROM daily_revenue_history h
+JOIN UNNEST(
+    CAST(:date_id AS INTEGER[]), CAST(:currency AS VARCHAR[]), CAST(:vendor_id AS VARCHAR[]), CAST(:since AS TIMESTAMP[])
+) AS changed (date_id, currency, vendor_id, since)
+    ON h.date_id = changed.date_id AND h.currency = changed.currency AND h.vendor_id = changed.vendor_id
+WHERE h.known_to IS NULL OR h.known_to > changed.since;
+"""
+
+delete_versions_query = """
+DELETE FROM daily_revenue_history h
+USING UNNEST(
+    CAST(:date_id AS INTEGER[]), CAST(:currency AS VARCHAR[]), CAST(:vendor_id AS VARCHAR[]), CAST(:known_from AS TIMESTAMP[])
+) AS replaced (date_id, currency, vendor_id, known_from)
+WHERE h.date_id = replaced.date_id AND h.currency = replaced.currency
+  AND h.vendor_id = replaced.vendor_id AND h.known_from = replaced.known_from;
+"""
+
+insert_versions_query = """
+INSERT INTO daily_revenue_history (date_id, currency, vendor_id, gross_revenue, refunded_amount, orders, refunds, known_from, known_to)
+SELECT * FROM UNNEST(
+    CAST(:date_id AS INTEGER[]), CAST(:currency AS VARCHAR[]), CAST(:vendor_id AS VARCHAR[]),
+    CAST(:gross_revenue AS DECIMAL[]), CAST(:refunded_amount AS DECIMAL[]),
+    CAST(:orders AS INTEGER[]), CAST(:refunds AS INTEGER[]),
+    CAST(:known_from AS TIMESTAMP[]), CAST(:known_to AS TIMESTAMP[])
+);
+"""
+
+# Day totals as reported at one instant; the range expressions match the GiST index
+as_reported_query = """
+SELECT date_id, currency,
+       SUM(gross_revenue) AS gross_revenue,
+       SUM(refunded_amount) AS refunded_amount,
+       SUM(gross_revenue - refunded_amount) AS net_revenue,
+       SUM(orders) AS orders,
+       SUM(refunds) AS refunds
+FROM daily_revenue_history
+WHERE int4range(date_id, date_id, '[]') && int4range(:start_id, :end_id, '[]')
+  AND tsrange(known_from, known_to) @> CAST(:as_of AS TIMESTAMP){filters}
+GROUP BY date_id, currency
+ORDER BY date_id, currency;
+"""
+
+# Versions of a day that replace an earlier version and are known after the day's report
+# (report_lag_days after the day began) are restatements; a first version only reports the day
+restatements_query = """
+SELECT date_id, currency,
+       MIN(known_from) AS first_known_at,
+       MAX(known_from) AS last_known_at,
+       COUNT(*) FILTER (WHERE restated) AS restatements,
+       COUNT(*) FILTER (WHERE restated AND refund_change <> 0) AS refund_restatements,
+       COALESCE(SUM(gross_change) FILTER (WHERE restated), 0) AS gross_restated,
+       COALESCE(SUM(refund_change) FILTER (WHERE restated), 0) AS refunds_restated,
+       MAX(CAST(known_from AS DATE) - event_date) AS max_lag_days
+FROM (
+    SELECT date_id, currency, known_from, event_date, gross_change, refund_change,
+           has_prior AND known_from >= event_date + :report_lag_days AS restated
+    FROM (
+        SELECT date_id, currency, known_from,
+               TO_DATE(CAST(date_id AS VARCHAR), 'YYYYMMDD') AS event_date,
+               LAG(known_from) OVER vendor_day IS NOT NULL AS has_prior,
+               gross_revenue - COALESCE(LAG(gross_revenue) OVER vendor_day, 0) AS gross_change,
+               refunded_amount - COALESCE(LAG(refunded_amount) OVER vendor_day, 0) AS refund_change
+        FROM daily_revenue_history
+        WHERE date_id BETWEEN :start_id AND :end_id{filters}
+        WINDOW vendor_day AS (PARTITION BY date_id, currency, vendor_id ORDER BY known_from)
+    ) AS changes
+) AS versions
+GROUP BY date_id, currency
+ORDER BY date_id, currency;
+"""
+
+
+def history_lines(events: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    One row per order or refund event: the day and amounts it adds and when it became known.
+
+    Events count from their ingested_at (the load time where it is missing or
+    unreadable). Bootstrapped events are stamped with the time of the bootstrap
+    load, so historical exports count from their event_time instead: they were
+    known when they happened, not restated when loaded. Source keys are those of product_revenue.source_key, so a source
+    is applied once however often it is delivered.
+    """
+    rows = []
+    sources = set()
+    for event in events:
+        event_type = event.get('event_type')
+        if event_type not in ORDER_EVENT_TYPES and event_type not in REFUND_EVENT_TYPES:
+            continue
+        payload = event.get('payload') or {}
+        order_id = event.get('order_key') or extract_order_id(payload)
+        event_time = parse_timestamp(event.get('event_time'))
+        if event.get('_bootstrapped'):
+            known_at = event_time
+        else:
+            known_at = parse_timestamp(event.get('ingested_at')) or parse_timestamp(event.get(WATERMARK_FIELD))
+        if not order_id or event_time is None or known_at is None:
+            continue
+        is_order = event_type in ORDER_EVENT_TYPES
+        key = source_key(event, order_id)
+        if key in sources:
+            continue
+        sources.add(key)
+        amount = first_present(payload, ORDER_AMOUNT_FIELDS if is_order else REFUND_AMOUNT_FIELDS)
+        rows.append({
+            'source_key': key,
+            'date_id': date_id(event_time),
+            'currency': first_present(payload, CURRENCY_FIELDS) or 'UNKNOWN',
+            'vendor_id': event.get('vendor') or 'unknown',
+            'known_at': known_at,
+            'amount': amount,
+            'orders': int(is_order),
+            'refunds': int(not is_order),
+        })
+    lines = pd.DataFrame(rows, columns=['source_key'] + VERSION_KEY + ['known_at', 'amount', 'orders', 'refunds'])
+    amounts = pd.to_numeric(lines['amount'], errors='coerce').fillna(0.0)
+    lines['gross_revenue'] = amounts.where(lines['orders'] == 1, 0.0)
+    lines['refunded_amount'] = amounts.where(lines['refunds'] == 1, 0.0)
+    return lines.drop(columns='amount')
+
+
+def build_versions(existing: pd.DataFrame, deltas: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replacement versions of the changed days.
+
+    deltas holds the summed measures per key and known_at; existing holds the stored
+    versions of those keys still valid at or after their earliest known_at. Every
+    version from that time on gains the deltas known by its start, and each new
+    knowledge time starts a version of its own. Only the version current at that
+    time is cut short, so a run in knowledge order only closes the current version
+    and appends; a late-loaded event with an earlier ingested_at also restates the
+    versions between.
+    """
+    # Stored rows and new lines are aligned on common key and time types for the (asof) merges
+    key_types = {'date_id': 'int64', 'currency': 'str', 'vendor_id': 'str'}
+    deltas = deltas.astype({**key_types, 'known_at': 'datetime64[us]'})
+    existing = existing.astype({**key_types, 'known_from': 'datetime64[us]', 'known_to': 'datetime64[us]',
+                                **{column: 'float64' for column in MEASURES}})
+    deltas = deltas.sort_values(VERSION_KEY + ['known_at'], ignore_index=True)
+    since = deltas.groupby(VERSION_KEY, as_index=False)['known_at'].min().rename(columns={'known_at': 'since'})
+    existing = existing.merge(since, on=VERSION_KEY)
+
+    # The version current when the earliest new event became known ends there
+    cut = existing[existing['known_from'] < existing['since']].assign(known_to=lambda frame: frame['since'])
+
+    points = pd.concat([
+        existing.loc[existing['known_from'] >= existing['since'], VERSION_KEY + ['known_from']],
+        deltas[VERSION_KEY + ['known_at']].rename(columns={'known_at': 'known_from'}),
+    ]).drop_duplicates().sort_values('known_from', ignore_index=True)
+    stored = existing.sort_values('known_from')[VERSION_KEY + MEASURES + ['known_from']]
+    added = deltas.assign(**{column: deltas.groupby(VERSION_KEY)[column].cumsum() for column in MEASURES})
+    before = pd.merge_asof(points, stored, on='known_from', by=VERSION_KEY)
+    new = pd.merge_asof(points, added[VERSION_KEY + MEASURES + ['known_at']].sort_values('known_at'),
+                        left_on='known_from', right_on='known_at', by=VERSION_KEY)
+    versions = points.copy()
+    for column in MEASURES:
+        versions[column] = before[column].fillna(0.0) + new[column].fillna(0.0)
+    versions = versions.sort_values(VERSION_KEY + ['known_from'], ignore_index=True)
+    versions['known_to'] = versions.groupby(VERSION_KEY)['known_from'].shift(-1)
+
+    versions = pd.concat([cut[VERSION_COLUMNS], versions[VERSION_COLUMNS]], ignore_index=True)
+    versions[['gross_revenue', 'refunded_amount']] = versions[['gross_revenue', 'refunded_amount']].round(2)
+    versions[['orders', 'refunds']] = versions[['orders', 'refunds']].astype(int)
+    return versions.sort_values(VERSION_KEY + ['known_from'], ignore_index=True)
+
+
+def _timestamps(values: pd.Series) -> List[Optional[datetime]]:
+    return [None if pd.isna(value) else pd.Timestamp(value).to_pydatetime() for value in values]
+
+
+def apply_revenue_versions(lines: pd.DataFrame) -> Dict[str, int]:
+    """
+    Add the not-yet-applied source events to the version history of their days.
+
+    Claiming the sources, reading the affected versions and replacing them run in
+    one transaction, so a failed or concurrent run never counts an event twice.
+    """
+    if lines.empty:
+        return {'sources_applied': 0, 'days_changed': 0, 'versions_written': 0}
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+
+    with engine.begin() as connection:
+        connection.execute(text(lock_history_query))
+        lines = lines.sort_values('source_key')
+        claimed = connection.execute(text(claim_sources_query), {
+            'source_keys': lines['source_key'].tolist(),
+            'known_at': _timestamps(lines['known_at']),
+        }).scalars().all()
+        new_lines = lines[lines['source_key'].isin(claimed)]
+        if new_lines.empty:
+            return {'sources_applied': 0, 'days_changed': 0, 'versions_written': 0}
+        deltas = new_lines.groupby(VERSION_KEY + ['known_at'], as_index=False)[MEASURES].sum()
+
+        since = deltas.groupby(VERSION_KEY, as_index=False)['known_at'].min()
+        existing = pd.DataFrame(connection.execute(text(affected_versions_query), {
+            'date_id': since['date_id'].tolist(),
+            'currency': since['currency'].tolist(),
+            'vendor_id': since['vendor_id'].tolist(),
+            'since': _timestamps(since['known_at']),
+        }).mappings().all(), columns=VERSION_COLUMNS)
+        versions = build_versions(existing, deltas)
+
+        if not existing.empty:
+            connection.execute(text(delete_versions_query), {
+                'date_id': existing['date_id'].tolist(),
+                'currency': existing['currency'].tolist(),
+                'vendor_id': existing['vendor_id'].tolist(),
+                'known_from': _timestamps(existing['known_from']),
+            })
+        connection.execute(text(insert_versions_query), {
+            **{column: versions[column].tolist() for column in VERSION_KEY + MEASURES},
+            'known_from': _timestamps(versions['known_from']),
+            'known_to': _timestamps(versions['known_to']),
+        })
+    record_change(HISTORY_TABLES, since['date_id'], 'revenue_history')
+    return {'sources_applied': len(claimed), 'days_changed': len(since), 'versions_written': len(versions)}
+
+
+def update_revenue_history(batch_size: int = 5000) -> Dict[str, int]:
+    """Fold order and refund events loaded since the last run into daily_revenue_history."""
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    watermark = get_watermark(db, WATERMARK_NAME)
+    query = {'$and': [
+        loaded_after_query(watermark),
+        {'event_type': {'$in': list(ORDER_EVENT_TYPES) + list(REFUND_EVENT_TYPES)}},
+    ]}
+
+    totals = {'sources_applied': 0, 'days_changed': 0, 'versions_written': 0}
+    new_watermark = watermark
+    chunk = []
+    cursor = db['events_raw'].find(query, PROJECTION).batch_size(1000)
+    for event in cursor:
+        new_watermark = max_loaded_at(new_watermark, event)
+        chunk.append(event)
+        if len(chunk) >= batch_size:
+            for key, count in apply_revenue_versions(history_lines(chunk)).items():
+                totals[key] += count
+            chunk = []
+    if chunk:
+        for key, count in apply_revenue_versions(history_lines(chunk)).items():
+            totals[key] += count
+
+    if new_watermark is not None:
+        set_watermark(db, WATERMARK_NAME, new_watermark)
+    client.close()
+    logging.info(f"Revenue history versions: {totals}")
+    return totals
+
+
+def _filters(params: Dict[str, Any], currency: Optional[str], vendor: Optional[str]) -> str:
+    filters = ''
+    if currency:
+        filters += ' AND currency = :currency'
+        params['currency'] = currency
+    if vendor:
+        filters += ' AND vendor_id = :vendor'
+        params['vendor'] = vendor
+    return filters
+
+
+def revenue_as_reported(
+    as_of: Union[str, datetime],
+    start: str,
+    end: str,
+    currency: Optional[str] = None,
+    vendor: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Daily revenue between start and end (YYYY-MM-DD) as it was known at as_of.
+
+    as_of is a timestamp, or a YYYY-MM-DD day meaning the end of that day. Days
+    with nothing known yet at as_of are absent.
+    """
+    if isinstance(as_of, str) and len(as_of) == 10:
+        as_of = datetime.strptime(as_of, '%Y-%m-%d') + timedelta(days=1) - timedelta(microseconds=1)
+    else:
+        as_of = parse_timestamp(as_of)
+    if as_of is None:
+        raise ValueError("as_of must be a timestamp or a YYYY-MM-DD day")
+    params = {'start_id': int(start.replace('-', '')), 'end_id': int(end.replace('-', '')), 'as_of': as_of}
+    filters = _filters(params, currency, vendor)
+    return cached_query(as_reported_query.format(filters=filters), params, date_range=(params['start_id'], params['end_id']))
+
+
+def revenue_restatements(
+    start: str,
+    end: str,
+    currency: Optional[str] = None,
+    vendor: Optional[str] = None,
+    report_lag_days: int = 1,
+) -> pd.DataFrame:
+    """
+    Per day and currency between start and end (YYYY-MM-DD): how often and by how much
+    the vendor totals changed after the day was reported (report_lag_days after it
+    began; 1 is the end-of-day report), how many of those changes came with refunds,
+    and the latest change in days after the event day.
+    """
+    params = {
+        'start_id': int(start.replace('-', '')), 'end_id': int(end.replace('-', '')),
+        'report_lag_days': int(report_lag_days),
+    }
+    filters = _filters(params, currency, vendor)
+    return cached_query(restatements_query.format(filters=filters), params, date_range=(params['start_id'], params['end_id']))
+
+
+def restatement_summary(
+    start: str,
+    end: str,
+    currency: Optional[str] = None,
+    vendor: Optional[str] = None,
+    report_lag_days: int = 1,
+) -> Dict[str, Any]:
+    """Share of days restated after their report, and of days restated by late refunds."""
+    days = revenue_restatements(start, end, currency, vendor, report_lag_days)
+    if days is None or days.empty:
+        return {'days': 0, 'restated_days': 0, 'restated_share': 0.0, 'refund_restated_days': 0,
+                'refund_restated_share': 0.0, 'max_lag_days': None}
+    restated = days[days['restatements'] > 0]
+    refund_restated = days[days['refund_restatements'] > 0]
+    return {
+        'days': len(days),
+        'restated_days': len(restated),
+        'restated_share': round(len(restated) / len(days), 4),
+        'refund_restated_days': len(refund_restated),
+        'refund_restated_share': round(len(refund_restated) / len(days), 4),
+        'max_lag_days': int(restated['max_lag_days'].max()) if not restated.empty else 0,
+    }
@@ -1,9 +1,47 @@
 from src.analytics.create_tables import create_tables_if_not_exists
+from src.analytics.latency_metrics import update_latency_sketches
+from src.analytics.product_revenue import update_product_revenue
+from src.analytics.revenue_history import update_revenue_history
+from src.analytics.order_state import update_order_state
+from src.analytics.anomalies import update_anomalies
+from src.analytics.transform import transform_new_events
+from src.profiling import profile_stage
 
-def run_analytics():
+def run_analytics(snapshot_dir=None):
     try:
         # Create necessary tables if they do not exist
-        create_tables_if_not_exists()
+        with profile_stage('create_tables'):
+            create_tables_if_not_exists()
+
+        # Normalise newly loaded events into the Postgres model
+        with profile_stage('transform'):
+            transform_stats = transform_new_events(snapshot_dir=snapshot_dir)
+        print(f"Transform Stats: {transform_stats}")
+
+        # Merge order-to-payment / order-to-refund latencies into the per-day sketches
+        with profile_stage('latency_sketches'):
+            latency_stats = update_latency_sketches()
+        print(f"Latency Sketch Stats: {latency_stats}")
+
+        # Add new order lines and refunded lines to the per-SKU-per-day revenue table
+        with profile_stage('product_revenue'):
+            revenue_stats = update_product_revenue()
+        print(f"Product Revenue Stats: {revenue_stats}")
+
+        # Append new versions of the daily revenue totals changed by newly loaded orders and refunds
+        with profile_stage('revenue_history'):
+            history_stats = update_revenue_history()
+        print(f"Revenue History Stats: {history_stats}")
+
+        # Roll new payment, order and refund events into the hourly per-vendor baselines and flag deviations
+        with profile_stage('anomalies'):
+            anomaly_stats = update_anomalies()
+        print(f"Anomaly Stats: {anomaly_stats}")
+
+        # Fold newly ingested events into the per-order state
+        with profile_stage('order_state'):
+            order_state_stats = update_order_state(snapshot_dir=snapshot_dir)
+        print(f"Order State Stats: {order_state_stats}")
     
     except Exception as e:
-        print(f"An error occurred while running analytics: {e}")
\ No newline at end of file
+        print(f"An error occurred while running analytics: {e}")
@@ -0,0 +1,118 @@
+import logging
+from typing import Dict, Any, List
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import make_sqlalchemy_db_connection
+from ..utility import first_present
+
+SHIPMENT_EVENT_TYPES = ('shipment_updated', 'historical_shipment')
+
+# Historical shipments carry their whole status history in one of these arrays
+SHIPMENT_HISTORY_FIELDS = ['updates', 'status_history', 'timeline']
+SHIPMENT_STATUS_FIELDS = ['status', 'shipment_status', 'state']
+SHIPMENT_TIME_FIELDS = ['updateTime', 'update_time', 'time', 'ts']
+TRACKING_FIELDS = ['tracking', 'tracking_code']
+
+# Statuses at the same timestamp are ordered by progress
+SHIPMENT_RANK = {'CREATED': 0, 'PICKED_UP': 1, 'IN_TRANSIT': 2, 'DELIVERED': 3}
+
+SHIPMENT_COLUMNS = ['id', 'shipment_time', 'tracking_id', 'latest_status', 'latest_status_at']
+SHIPMENT_UPDATE_COLUMNS = ['id', 'status', 'shipment_id', 'updated_at', 'order_id']
+
+# Shipments seen again keep their first time and move to a later status only
+upsert_shipments_query = """
+INSERT INTO shipments AS current (id, shipment_time, tracking_id, latest_status, latest_status_at)
+SELECT * FROM UNNEST(
+    CAST(:id AS VARCHAR[]), CAST(:shipment_time AS TIMESTAMP[]), CAST(:tracking_id AS VARCHAR[]),
+    CAST(:latest_status AS VARCHAR[]), CAST(:latest_status_at AS TIMESTAMP[])
+)
+ON CONFLICT (id) DO UPDATE SET
+    shipment_time = LEAST(current.shipment_time, EXCLUDED.shipment_time),
+    latest_status = CASE
+        WHEN current.latest_status_at IS NULL OR EXCLUDED.latest_status_at >= current.latest_status_at
+        THEN EXCLUDED.latest_status ELSE current.latest_status END,
+    latest_status_at = GREATEST(current.latest_status_at, EXCLUDED.latest_status_at);
+"""
+
+
+def parse_timestamps(values: pd.Series) -> pd.Series:
+    """Vectorised parse_timestamp: ISO-like strings and Unix epochs to naive UTC datetimes (NaT if unparseable)."""
+    epochs = pd.to_numeric(values, errors='coerce')
+    strings = values.where(epochs.isna() & values.map(lambda value: isinstance(value, str)))
+    parsed = pd.to_datetime(strings, format='mixed', utc=True, errors='coerce')
+    if epochs.notna().any():
+        parsed = parsed.where(epochs.isna(), pd.to_datetime(epochs, unit='s', utc=True, errors='coerce'))
+    return parsed.dt.tz_localize(None)
+
+
+def explode_shipment_updates(shipment_events: List[Dict[str, Any]]) -> Dict[str, pd.DataFrame]:
+    """
+    Flatten shipment events into shipment_updates rows and one shipments row per tracking id.
+
+    Each event is a dict with order_id, event_time and payload. Historical status arrays
+    are exploded in one pass; a live event contributes its single update. Identical
+    (tracking, status, time) updates are kept once, and a single sort yields both the
+    first update time and the latest status of every shipment.
+    """
+    if not shipment_events:
+        return {
+            'shipments': pd.DataFrame(columns=SHIPMENT_COLUMNS),
+            'shipment_updates': pd.DataFrame(columns=SHIPMENT_UPDATE_COLUMNS),
+        }
+
+    records = []
+    for event in shipment_events:
+        payload = event['payload']
+        history = next((payload[field] for field in SHIPMENT_HISTORY_FIELDS if payload.get(field)), None)
+        if history is None:
+            history = [{'status': first_present(payload, SHIPMENT_STATUS_FIELDS), 'time': first_present(payload, SHIPMENT_TIME_FIELDS)}]
+        records.append((event['order_id'], first_present(payload, TRACKING_FIELDS), event['event_time'], history))
+
+    updates = pd.DataFrame(records, columns=['order_id', 'shipment_id', 'event_time', 'history'])
+    updates = updates[updates['shipment_id'].notna()].explode('history', ignore_index=True)
+    updates = updates[updates['history'].map(lambda entry: isinstance(entry, dict))]
+    entries = pd.DataFrame(updates['history'].tolist(), index=updates.index, columns=['status', 'time'])
+    updates = updates.assign(
+        shipment_id=updates['shipment_id'].astype(str),
+        status=entries['status'].astype('string').str.upper(),
+        updated_at=parse_timestamps(entries['time']),
+    )
+    updates = updates[updates['status'].notna()]
+    # Updates without a readable time fall back to the time of their event
+    updates['updated_at'] = updates['updated_at'].fillna(pd.to_datetime(updates['event_time']))
+    updates = updates.drop_duplicates(['shipment_id', 'status', 'updated_at'])
+
+    updates['rank'] = updates['status'].map(SHIPMENT_RANK).fillna(-1)
+    updates = updates.sort_values(['shipment_id', 'updated_at', 'rank'], ignore_index=True)
+    updates['id'] = updates['shipment_id'] + ':' + updates['status'] + ':' + updates['updated_at'].dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+    first = updates.drop_duplicates('shipment_id', keep='first')
+    latest = updates.drop_duplicates('shipment_id', keep='last')
+    shipments = pd.DataFrame({
+        'id': first['shipment_id'].to_numpy(),
+        'shipment_time': first['updated_at'].to_numpy(),
+        'tracking_id': first['shipment_id'].to_numpy(),
+        'latest_status': latest['status'].to_numpy(),
+        'latest_status_at': latest['updated_at'].to_numpy(),
+    })
+    return {'shipments': shipments, 'shipment_updates': updates[SHIPMENT_UPDATE_COLUMNS]}
+
+
+def upsert_shipments(shipments: pd.DataFrame) -> int:
+    """Insert new shipments and advance the latest status of known ones."""
+    if shipments.empty:
+        return 0
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    shipments = shipments.sort_values('id')
+    with engine.begin() as connection:
+        connection.execute(text(upsert_shipments_query), {
+            'id': shipments['id'].tolist(),
+            'shipment_time': shipments['shipment_time'].dt.to_pydatetime().tolist(),
+            'tracking_id': shipments['tracking_id'].tolist(),
+            'latest_status': shipments['latest_status'].tolist(),
+            'latest_status_at': shipments['latest_status_at'].dt.to_pydatetime().tolist(),
+        })
+    logging.info(f"Upserted {len(shipments)} shipment(s)")
+    return len(shipments)
@@ -0,0 +1,192 @@
+"""
+Near-real-time sync of events_raw to Postgres through a MongoDB change stream.
+
+Change streams need a replica set; a local single-node one is enough:
+
+    mongod --replSet rs0 --dbpath <dir>
+    mongosh --eval "rs.initiate()"
+
+and MONGO_URI pointing at it with ?replicaSet=rs0 (or directConnection=true).
+"""
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from pymongo.errors import OperationFailure
+from ..DB_connection import get_mongo_client
+from ..watermarks import WATERMARK_COLLECTION, WATERMARK_FIELD
+from .orphan_resolver import OrderReferenceResolver
+from .dimensions import DimensionManager
+from .latency_metrics import QuantileSketch
+from .product_revenue import apply_revenue_deltas, release_parked_refunds, revenue_lines, update_product_revenue
+from .revenue_history import apply_revenue_versions, history_lines, update_revenue_history
+from .transform import normalise_events, load_normalised, transform_lock, transform_new_events
+
+# Document of the watermark collection holding the resume token of the stream
+SYNC_JOB_NAME = 'change_stream_sync'
+
+DEFAULT_BATCH_SIZE = 500
+
+# Longest time a change waits in a partial micro-batch before it is loaded
+DEFAULT_MAX_WAIT_SECONDS = 1.0
+
+# Server error codes: change streams on a standalone server, resume point no longer in the oplog
+NOT_A_REPLICA_SET = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# New documents, and re-deliveries: the loaders re-stamp _loaded_at on every upsert,
+# while derived-key backfills leave it untouched and are not synced
+CHANGE_STREAM_PIPELINE = [
+    {'$match': {'$or': [
+        {'operationType': {'$in': ['insert', 'replace']}},
+        {'operationType': 'update', f"updateDescription.updatedFields.{WATERMARK_FIELD}": {'$exists': True}},
+    ]}},
+]
+
+
+def get_resume_token(db) -> Optional[Dict[str, Any]]:
+    doc = db[WATERMARK_COLLECTION].find_one({'_id': SYNC_JOB_NAME})
+    return doc.get('resume_token') if doc else None
+
+
+def set_resume_token(db, token: Dict[str, Any]) -> None:
+    """Persist the position of the stream after its changes have been committed to Postgres."""
+    db[WATERMARK_COLLECTION].update_one(
+        {'_id': SYNC_JOB_NAME},
+        {'$set': {'resume_token': token, 'updated_at': datetime.now()}},
+        upsert=True
+    )
+
+
+class ChangeStreamSync:
+    """
+    Micro-batching consumer of the events_raw change stream.
+
+    Each batch is normalised and bulk loaded into the fact tables, the per-SKU
+    revenue deltas and the daily revenue versions, and only then is the resume
+    token persisted. A restart replays at most the last uncommitted batch, which
+    the idempotent loads (ON CONFLICT DO NOTHING, claimed revenue source keys)
+    apply once.
+
+    Freshness is the time from an event being loaded into events_raw to its batch
+    being committed to Postgres, in seconds.
+    """
+
+    def __init__(self, db, batch_size: int = DEFAULT_BATCH_SIZE, max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.resolver = OrderReferenceResolver()
+        self.resolver.seed_from_postgres()
+        self.dimensions = DimensionManager()
+        self.freshness = QuantileSketch()
+        self.stats = {'batches': 0, 'events': 0, 'sources_applied': 0}
+
+    def open_stream(self):
+        """
+        Resume after the persisted token; without one (or once it has left the oplog)
+        start from now and catch up on earlier events with the batch jobs.
+        """
+        token = get_resume_token(self.db)
+        collection = self.db['events_raw']
+        options = {'full_document': 'updateLookup', 'max_await_time_ms': int(self.max_wait_seconds * 1000)}
+        try:
+            if token is not None:
+                try:
+                    return collection.watch(CHANGE_STREAM_PIPELINE, resume_after=token, **options)
+                except OperationFailure as e:
+                    if e.code != CHANGE_STREAM_HISTORY_LOST:
+                        raise
+                    logging.warning("Resume token is no longer in the oplog; catching up from the watermarks")
+            # Opened before catching up, so nothing written in between is missed
+            stream = collection.watch(CHANGE_STREAM_PIPELINE, **options)
+        except OperationFailure as e:
+            if e.code == NOT_A_REPLICA_SET:
+                raise ValueError("Change streams need MongoDB to run as a replica set (mongod --replSet rs0)") from e
+            raise
+        self.catch_up()
+        return stream
+
+    def catch_up(self) -> None:
+        transform_stats = transform_new_events()
+        revenue_stats = update_product_revenue()
+        history_stats = update_revenue_history()
+        logging.info(f"Sync catch-up: transform {transform_stats}, revenue {revenue_stats}, revenue history {history_stats}")
+
+    def next_batch(self, stream) -> List[Dict[str, Any]]:
+        """Changed documents until the batch is full or the oldest one has waited max_wait_seconds."""
+        events = []
+        deadline = None
+        while len(events) < self.batch_size:
+            change = stream.try_next()
+            if change is None:
+                # An idle stream returns empty so the caller can persist the post-batch token
+                if deadline is None or time.monotonic() >= deadline:
+                    break
+                continue
+            # Documents deleted before the lookup have no full document
+            if change.get('fullDocument'):
+                document = dict(change['fullDocument'])
+                document.pop('_id', None)
+                events.append(document)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait_seconds
+        return events
+
+    def apply_batch(self, events: List[Dict[str, Any]]) -> Dict[str, int]:
+        # Waits while a reprocess rebuilds the model and its derived tables
+        with transform_lock():
+            stats = load_normalised(normalise_events(events), self.resolver, self.dimensions)
+            stats.update(apply_revenue_deltas(*revenue_lines(events)))
+            stats.update(release_parked_refunds())
+            stats['revenue_versions'] = apply_revenue_versions(history_lines(events))['versions_written']
+        committed_at = datetime.utcnow()  # _loaded_at is stamped by the server in UTC
+        lags = [(committed_at - event[WATERMARK_FIELD]).total_seconds()
+                for event in events if isinstance(event.get(WATERMARK_FIELD), datetime)]
+        self.freshness.add_many(lags)
+        self.stats['batches'] += 1
+        self.stats['events'] += len(events)
+        self.stats['sources_applied'] += stats['sources_applied']
+        if lags:
+            logging.info(f"Synced {len(events)} event(s); freshness max {max(lags):.2f}s")
+        return stats
+
+    def freshness_summary(self) -> Dict[str, Any]:
+        return {
+            'freshness_p50_seconds': self.freshness.quantile(0.5),
+            'freshness_p99_seconds': self.freshness.quantile(0.99),
+            'freshness_max_seconds': self.freshness.max,
+        }
+
+    def run(self, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        """Consume the stream until interrupted (or max_batches batches have been loaded)."""
+        stream = self.open_stream()
+        try:
+            with stream:
+                while max_batches is None or self.stats['batches'] < max_batches:
+                    events = self.next_batch(stream)
+                    if events:
+                        self.apply_batch(events)
+                    if stream.resume_token is not None:
+                        set_resume_token(self.db, stream.resume_token)
+        except KeyboardInterrupt:
+            logging.info("Change stream sync interrupted")
+        summary = {**self.stats, **self.freshness_summary()}
+        self.dimensions.log_stats()
+        logging.info(f"Change stream sync: {summary}")
+        return summary
+
+
+def run_change_stream_sync(
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    max_wait_seconds: float = DEFAULT_MAX_WAIT_SECONDS,
+    max_batches: Optional[int] = None,
+) -> Dict[str, Any]:
+    """Run the sync worker against events_raw of the configured database."""
+    client = get_mongo_client()
+    try:
+        db = client[os.getenv('MONGO_DB')]
+        return ChangeStreamSync(db, batch_size, max_wait_seconds).run(max_batches)
+    finally:
+        client.close()
@@ -0,0 +1,331 @@
+import logging
+import os
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Dict, Any, List, Iterable, Optional
+import pandas as pd
+from sqlalchemy import text
+from ..DB_connection import execute_postgre_query, make_sqlalchemy_db_connection, bulk_insert_dataframe, get_mongo_client
+from ..utility import parse_timestamp, first_present, extract_order_id
+from ..raw_zone import decode_event_id
+from ..raw_snapshot import load_from_snapshot
+from ..watermarks import get_watermark, set_watermark, loaded_after_query, max_loaded_at
+from .orphan_resolver import OrderReferenceResolver
+from .identity_resolution import identity_resolution_lock, resolve_customer_identities, store_identities
+from .dimensions import DimensionManager
+from .query_cache import record_change
+from .shipments import SHIPMENT_EVENT_TYPES, explode_shipment_updates, upsert_shipments
+
+WATERMARK_NAME = 'transform'
+
+lock_transform_query = "SELECT pg_advisory_lock(hashtext('transform'));"
+unlock_transform_query = "SELECT pg_advisory_unlock(hashtext('transform'));"
+
+# Placeholder member for facts whose customer cannot be determined
+UNKNOWN_CUSTOMER_ID = 'UNKNOWN'
+
+ORDER_EVENT_TYPES = ('order_created', 'historical_order')
+PAYMENT_EVENT_TYPES = ('payment_succeeded', 'historical_payment')
+REFUND_EVENT_TYPES = ('refund_issued', 'historical_refund')
+ORDER_UPDATE_EVENT_TYPES = ('order_updated',)
+
+CUSTOMER_ID_FIELDS = ['customerId', 'cust_id']
+EMAIL_FIELDS = ['buyerEmail', 'email']
+PHONE_FIELDS = ['buyerPhone', 'phone']
+ORDER_AMOUNT_FIELDS = ['total', 'totalAmount', 'amount']
+PAYMENT_AMOUNT_FIELDS = ['amount', 'amountPaid', 'amount_paid', 'amt']
+PAYMENT_STATUS_FIELDS = ['status', 'payment_status', 'state', 'payment_state']
+PAYMENT_METHOD_FIELDS = ['method', 'channel', 'paymentMethod']
+REFUND_AMOUNT_FIELDS = ['amount', 'refundAmount', 'amt']
+REFUND_REASON_FIELDS = ['reason', 'refund_reason']
+CURRENCY_FIELDS = ['currency', 'currencyCode', 'ccy']
+ORDER_ITEM_FIELDS = ['items', 'line_items']
+
+# Load order respecting the foreign keys in create_tables.py (dates are pre-generated)
+DIMENSION_TABLES = ['vendors', 'customers', 'products']
+FACT_TABLES = ['order_items', 'payments', 'refunds', 'order_updates', 'shipment_updates']
+
+# Tables a load of normalised frames can change, for query-result cache invalidation
+LOADED_TABLES = ['dates', 'vendors', 'customers', 'customer_identities', 'products', 'orders', 'shipments'] + FACT_TABLES + ['quarantined_facts']
+
+TABLE_COLUMNS = {
+    'vendors': ['id', 'name'],
+    'dates': ['date_id', 'day', 'month', 'year'],
+    'customers': ['id', 'name', 'email', 'address_id'],
+    'products': ['id', 'name', 'price'],
+    'orders': ['id', 'customer_id', 'total_amount', 'payment_timeline', 'created_at', 'currency', 'address_id', 'vendor_id'],
+    'order_items': ['id', 'order_id', 'product_id', 'quantity', 'price'],
+    'payments': ['id', 'amount', 'currency', 'payment_date', 'customer_id', 'order_id', 'status', 'vendor_id', 'payment_method'],
+    'refunds': ['id', 'order_id', 'refunded_at', 'refund_amount', 'currency', 'refund_reason'],
+    'order_updates': ['id', 'order_id', 'updated_at', 'change', 'notes'],
+}
+
+# Customer identifiers of each order, resolved into customers at load time
+CUSTOMER_RECORD_COLUMNS = ['order_id', 'customer_ref', 'email', 'phone']
+
+
+def date_id(value: datetime) -> int:
+    """Surrogate key of the dates dimension (YYYYMMDD)."""
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def extract_customer(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the raw customer reference, email and phone of an order payload, across vendors."""
+    customer = payload.get('customer') or payload.get('buyer') or {}
+    return {
+        'customer_ref': customer.get('id') or first_present(payload, CUSTOMER_ID_FIELDS),
+        'email': customer.get('email') or first_present(payload, EMAIL_FIELDS),
+        'phone': customer.get('phone') or first_present(payload, PHONE_FIELDS),
+    }
+
+
+def extract_items(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return order line items as (sku, quantity, price) dicts."""
+    items = []
+    for field in ORDER_ITEM_FIELDS:
+        for item in payload.get(field) or []:
+            items.append({
+                'sku': item.get('sku') or item.get('productSku'),
+                'quantity': item.get('qty') or item.get('quantity'),
+                'price': item.get('price') or item.get('unit_price'),
+            })
+        if items:
+            break
+    return items
+
+
+def normalise_events(events: Iterable[Dict[str, Any]]) -> Dict[str, pd.DataFrame]:
+    """
+    Normalise raw events (from events_raw or the Parquet snapshot) into table-shaped frames.
+
+    Args:
+        events: Raw event documents with event_id, event_type, event_time, vendor and payload
+    Returns:
+        Dictionary of table name to DataFrame with the columns of TABLE_COLUMNS, plus the
+        customer_records frame consumed by identity resolution
+    """
+    rows = {table: [] for table in TABLE_COLUMNS}
+    customer_records = []
+    shipment_events = []
+    vendors = set()
+    date_ids = {}
+
+    for event in events:
+        event_type = event.get('event_type')
+        payload = event.get('payload') or {}
+        order_id = event.get('order_key') or extract_order_id(payload)
+        event_time = parse_timestamp(event.get('event_time'))
+        vendor = event.get('vendor')
+        if not order_id or event_time is None:
+            continue
+
+        if vendor:
+            vendors.add(vendor)
+        date_ids.setdefault(date_id(event_time), event_time)
+
+        if event_type in ORDER_EVENT_TYPES:
+            customer_records.append({'order_id': order_id, **extract_customer(payload)})
+            rows['orders'].append({
+                'id': order_id,
+                'customer_id': None,
+                'total_amount': first_present(payload, ORDER_AMOUNT_FIELDS),
+                'payment_timeline': None,
+                'created_at': event_time,
+                'currency': first_present(payload, CURRENCY_FIELDS),
+                'address_id': None,
+                'vendor_id': vendor,
+            })
+            for position, item in enumerate(extract_items(payload)):
+                if not item['sku']:
+                    continue
+                rows['products'].append({'id': item['sku'], 'name': None, 'price': item['price']})
+                rows['order_items'].append({
+                    'id': f"{order_id}:{position}",
+                    'order_id': order_id,
+                    'product_id': item['sku'],
+                    'quantity': item['quantity'],
+                    'price': item['price'],
+                })
+
+        elif event_type in PAYMENT_EVENT_TYPES:
+            rows['payments'].append({
+                'id': decode_event_id(event['event_id']),
+                'amount': first_present(payload, PAYMENT_AMOUNT_FIELDS),
+                'currency': first_present(payload, CURRENCY_FIELDS),
+                'payment_date': event_time,
+                'customer_id': None,
+                'order_id': order_id,
+                'status': str(first_present(payload, PAYMENT_STATUS_FIELDS) or 'SUCCESS').upper(),
+                'vendor_id': vendor,
+                'payment_method': first_present(payload, PAYMENT_METHOD_FIELDS),
+            })
+
+        elif event_type in REFUND_EVENT_TYPES:
+            rows['refunds'].append({
+                'id': decode_event_id(event['event_id']),
+                'order_id': order_id,
+                'refunded_at': event_time,
+                'refund_amount': first_present(payload, REFUND_AMOUNT_FIELDS),
+                'currency': first_present(payload, CURRENCY_FIELDS),
+                'refund_reason': first_present(payload, REFUND_REASON_FIELDS),
+            })
+
+        elif event_type in ORDER_UPDATE_EVENT_TYPES:
+            rows['order_updates'].append({
+                'id': decode_event_id(event['event_id']),
+                'order_id': order_id,
+                'updated_at': event_time,
+                'change': payload.get('change') or payload.get('change_type'),
+                'notes': payload.get('notes') or payload.get('note'),
+            })
+
+        elif event_type in SHIPMENT_EVENT_TYPES:
+            # Status histories are exploded in bulk once the batch is collected
+            shipment_events.append({'order_id': order_id, 'event_time': event_time, 'payload': payload})
+
+    rows['vendors'] = [{'id': vendor, 'name': vendor} for vendor in sorted(vendors)]
+    rows['dates'] = [{'date_id': key, 'day': value.day, 'month': value.month, 'year': value.year}
+                     for key, value in date_ids.items()]
+
+    frames = {}
+    for table, columns in TABLE_COLUMNS.items():
+        df = pd.DataFrame(rows[table], columns=columns)
+        # The first occurrence of a natural key wins, matching ON CONFLICT DO NOTHING
+        key = 'date_id' if table == 'dates' else 'id'
+        # Sorted keys keep concurrent loaders from deadlocking on the same rows
+        frames[table] = df.drop_duplicates(key).sort_values(key)
+    frames.update(explode_shipment_updates(shipment_events))
+    # Customers are not known per row; identity resolution fills them and orders.customer_id
+    frames['customer_records'] = pd.DataFrame(customer_records, columns=CUSTOMER_RECORD_COLUMNS).drop_duplicates('order_id')
+    return frames
+
+
+def fill_payment_customers(payments: pd.DataFrame, orders: pd.DataFrame) -> pd.DataFrame:
+    """Take each payment's customer from its order (batch first, then the database)."""
+    if payments.empty:
+        return payments
+    customers = dict(zip(orders['id'], orders['customer_id']))
+    missing = [order_id for order_id in payments['order_id'].unique() if order_id not in customers]
+    if missing:
+        existing = execute_postgre_query(
+            "SELECT id, customer_id FROM orders WHERE id = ANY(:order_ids);", {'order_ids': missing}
+        )
+        if existing is not None and not existing.empty:
+            customers.update(zip(existing['id'], existing['customer_id']))
+    payments = payments.copy()
+    payments['customer_id'] = payments['order_id'].map(customers).fillna(UNKNOWN_CUSTOMER_ID)
+    return payments
+
+
+def load_normalised(
+    frames: Dict[str, pd.DataFrame],
+    resolver: Optional[OrderReferenceResolver] = None,
+    dimensions: Optional[DimensionManager] = None,
+) -> Dict[str, int]:
+    """
+    Bulk load normalised frames in foreign-key order.
+
+    Only dimension members the dimension cache has not seen are inserted; order facts
+    go through the orphan resolver so rows referencing unknown orders are quarantined
+    instead of failing.
+    """
+    if resolver is None:
+        resolver = OrderReferenceResolver()
+        resolver.seed_from_postgres()
+    if dimensions is None:
+        dimensions = DimensionManager()
+
+    stats = {'dates': dimensions.ensure_dates_for(frames['dates']['date_id'])}
+    # Orders must be stored before another writer may merge the customers they reference
+    with identity_resolution_lock():
+        identities = resolve_customer_identities(frames['customer_records'])
+        orders = frames['orders'].copy()
+        orders['customer_id'] = orders['id'].map(identities['order_customers']).fillna(UNKNOWN_CUSTOMER_ID)
+        unknown = pd.DataFrame([{'id': UNKNOWN_CUSTOMER_ID, 'name': None, 'email': None, 'address_id': None}])
+        frames = {**frames, 'orders': orders, 'customers': pd.concat([unknown, identities['customers']], ignore_index=True)}
+
+        for table in DIMENSION_TABLES:
+            stats[table] = dimensions.load_members(table, frames[table])
+        stats.update(store_identities(identities))
+
+        stats['orders'] = bulk_insert_dataframe(frames['orders'], 'orders')
+    released = resolver.on_orders_loaded(frames['orders']['id'])
+
+    frames['payments'] = fill_payment_customers(frames['payments'], frames['orders'])
+    # Shipments do not reference orders; their updates do and go through the resolver
+    stats['shipments'] = upsert_shipments(frames['shipments'])
+    for table in FACT_TABLES:
+        result = resolver.load_fact_batch(frames[table], table)
+        stats[table] = result['loaded'] + released.get(table, 0)
+        stats[f"{table}_quarantined"] = result['quarantined']
+
+    if any(stats.values()):
+        # Facts released from quarantine can belong to any earlier date
+        record_change(LOADED_TABLES, None if any(released.values()) else frames['dates']['date_id'], 'transform')
+    logging.info(f"Loaded normalised frames: {stats}")
+    return stats
+
+
+@contextmanager
+def transform_lock():
+    """
+    Serialise writers of the live Postgres model across processes.
+
+    Incremental transforms and change stream batches hold it while they load; a
+    reprocess holds it from copying the live rows until its swap, so nothing
+    written to the live tables in between is left behind in analytics_prev.
+    """
+    engine = make_sqlalchemy_db_connection()
+    if not engine:
+        raise ValueError("Database connection engine is not initialized.")
+    with engine.connect() as connection:
+        connection.execute(text(lock_transform_query))
+        try:
+            yield
+        finally:
+            connection.execute(text(unlock_transform_query))
+
+
+def transform_new_events(batch_size: int = 5000, snapshot_dir: Optional[str] = None) -> Dict[str, int]:
+    """
+    Normalise and load events_raw documents loaded since the last transform run.
+
+    With snapshot_dir the same events are read from the Parquet raw snapshot instead
+    of events_raw, and the watermark advances to the last snapshot load time.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    # Waits while a reprocess rebuilds the model, so no load lands in tables being replaced
+    with transform_lock():
+        watermark = get_watermark(db, WATERMARK_NAME)
+        if snapshot_dir:
+            source = load_from_snapshot(snapshot_dir, loaded_after=watermark).to_dict('records')
+            print(f"Transforming events loaded after {watermark or 'the beginning'} from raw snapshot {snapshot_dir}...")
+        else:
+            source = db['events_raw'].find(loaded_after_query(watermark), {'_id': 0}).batch_size(1000)
+            print(f"Transforming events loaded after {watermark or 'the beginning'}...")
+
+        resolver = OrderReferenceResolver()
+        resolver.seed_from_postgres()
+        dimensions = DimensionManager()
+
+        totals = {}
+        new_watermark = watermark
+        chunk = []
+        for event in source:
+            new_watermark = max_loaded_at(new_watermark, event)
+            chunk.append(event)
+            if len(chunk) >= batch_size:
+                for table, count in load_normalised(normalise_events(chunk), resolver, dimensions).items():
+                    totals[table] = totals.get(table, 0) + count
+                chunk = []
+
+        if chunk:
+            for table, count in load_normalised(normalise_events(chunk), resolver, dimensions).items():
+                totals[table] = totals.get(table, 0) + count
+
+        if new_watermark is not None:
+            set_watermark(db, WATERMARK_NAME, new_watermark)
+    client.close()
+    dimensions.log_stats()
+    return totals
@@ -4,11 +4,15 @@ import hashlib
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any
-from pymongo import UpdateOne
+from typing import Dict, Any, List, Optional
+from pymongo import ASCENDING, UpdateOne
 import os
 from src.DB_connection import get_mongo_client
-from src.utility import load_json_file
+from src.utility import load_json_file, parse_timestamp
+from src.raw_zone import ensure_events_raw_collection, derive_query_keys, encode_event_id, ingest_date, record_deliveries
+from src.schema_registry import REGISTRY
+from src.profiling import profile_stage
+from src.watermarks import LOADED_AT_STAMP
 load_dotenv()
 
 # Configure logging
@@ -17,14 +21,20 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-# Event type mapping for historical files
-EVENT_TYPE_MAPPING = {
-    'orders_2023.json': 'historical_order',
-    'payments_2023.json': 'historical_payment',
-    'refunds_2023.json': 'historical_refund',
-    'shipments_2023.json': 'historical_shipment'
+# Event type of a historical export, by the entity prefix of its file name
+# (orders_2023.json, payments_2024_vendor_d.jsonl, ...)
+FILE_EVENT_TYPES = {
+    'orders': 'historical_order',
+    'payments': 'historical_payment',
+    'refunds': 'historical_refund',
+    'shipments': 'historical_shipment'
 }
 
+BOOTSTRAP_FILE_SUFFIXES = ('.json', '.jsonl')
+
+# One document per bootstrap source file, keyed by file name
+MANIFEST_COLLECTION = 'bootstrap_manifest'
+
 # Function to generate deterministic event_id
 def generate_event_id(event_type: str, payload: Dict[str, Any]) -> str:
     
@@ -62,17 +72,21 @@ def extract_event_time(payload: Dict[str, Any], event_type: str) -> datetime:
     
     if 'historical_order' in event_type:
         timestamp_str = payload.get('created_at') or payload.get('created')
+        # Handle Unix timestamp nested in the order object for vendor_c
+        order = payload.get('order')
+        if isinstance(order, dict) and isinstance(order.get('ts'), (int, float)):
+            return parse_timestamp(order['ts'])
     
     elif 'historical_payment' in event_type:
         timestamp_str = payload.get('paidAt') or payload.get('paid_at')
         # Handle Unix timestamp for vendor_c
-        if isinstance(payload.get('ts'), (int, float)):
-            return datetime.fromtimestamp(payload['ts'])
+        if isinstance(payload.get('timestamp'), (int, float)):
+            return parse_timestamp(payload['timestamp'])
     
     elif 'historical_refund' in event_type:
         timestamp_str = payload.get('refundedAt') or payload.get('refunded_at')
         if isinstance(payload.get('ts'), (int, float)):
-            return datetime.fromtimestamp(payload['ts'])
+            return parse_timestamp(payload['ts'])
     
     elif 'historical_shipment' in event_type:
         # Get latest update time from shipment history
@@ -85,21 +99,9 @@ def extract_event_time(payload: Dict[str, Any], event_type: str) -> datetime:
     
     # Parse timestamp string
     if timestamp_str:
-        # Try multiple datetime formats
-        formats = [
-            '%Y-%m-%dT%H:%M:%S',
-            '%Y-%m-%dT%H:%M:%SZ',
-            '%Y-%m-%dT%H:%M:%S.%f',
-            '%Y/%m/%d %H:%M:%S',
-            '%Y-%m-%d %H:%M:%S',
-            '%Y-%m-%d %H:%M',
-        ]
-        
-        for fmt in formats:
-            try:
-                return datetime.strptime(timestamp_str, fmt)
-            except (ValueError, TypeError):
-                continue
+        parsed = parse_timestamp(timestamp_str)
+        if parsed:
+            return parsed
     
     # Fallback: use a default date in 2023 if parsing fails
     return datetime(2023, 1, 1, 0, 0, 0)
@@ -145,8 +147,14 @@ def detect_vendor(payload: Dict[str, Any], event_type: str) -> str:
 # Function to wrap payload as event
 def wrap_as_event(payload: Dict[str, Any], event_type: str) -> Dict[str, Any]:
     
-    vendor = detect_vendor(payload, event_type)
-    event_time = extract_event_time(payload, event_type)
+    # Known shapes are dispatched by fingerprint; unseen ones fall back to the field checks
+    variant = REGISTRY.dispatch(event_type, payload)
+    if variant is not None:
+        vendor = variant.vendor
+        event_time = parse_timestamp(REGISTRY.extract(variant, payload, 'event_time')) or extract_event_time(payload, event_type)
+    else:
+        vendor = detect_vendor(payload, event_type)
+        event_time = extract_event_time(payload, event_type)
     event_id = generate_event_id(event_type, payload)
     
     return {
@@ -155,13 +163,204 @@ def wrap_as_event(payload: Dict[str, Any], event_type: str) -> Dict[str, Any]:
         'event_time': event_time,
         'vendor': vendor,
         'payload': payload,
+        **derive_query_keys(payload),
         'ingested_at': datetime.now(datetime.now().astimezone().tzinfo),
         '_bootstrapped': True  # Flag to identify historical data
     }
     
 
-def bootstrap_load(bootstrap_dir, batch_size=500):
+def event_type_for_file(path: Path) -> Optional[str]:
+    return FILE_EVENT_TYPES.get(path.stem.split('_')[0].lower())
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def discover_bootstrap_files(bootstrap_dir) -> List[Dict[str, Any]]:
+    """Historical export files of the bootstrap directory whose event type can be told from their name."""
+    files = []
+    for path in sorted(Path(bootstrap_dir).iterdir()):
+        if not path.is_file() or path.suffix not in BOOTSTRAP_FILE_SUFFIXES:
+            continue
+        event_type = event_type_for_file(path)
+        if event_type is None:
+            logging.warning(f"Skipping {path.name}: no event type for its name prefix")
+            continue
+        stat = path.stat()
+        files.append({
+            'file_name': path.name,
+            'path': str(path),
+            'event_type': event_type,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        })
+    return files
+
+
+def ensure_manifest_indexes(db) -> None:
+    db[MANIFEST_COLLECTION].create_index([('status', ASCENDING)])
+
+
+def file_in_events_raw(collection, file_info: Dict[str, Any], batch_size: int = 1000) -> Optional[int]:
+    """Record count of a bootstrap file when every one of its events is already in events_raw, else None."""
+    records = load_json_file(file_info['path'])
+    event_ids = sorted({encode_event_id(generate_event_id(file_info['event_type'], record)) for record in records})
+    for start in range(0, len(event_ids), batch_size):
+        chunk = event_ids[start:start + batch_size]
+        if collection.count_documents({'event_id': {'$in': chunk}, '_bootstrapped': True}) < len(chunk):
+            return None
+    return len(records)
+
+
+def seed_manifest(db, files: List[Dict[str, Any]]) -> int:
+    """
+    Record the files already in events_raw as loaded when there is no manifest yet.
+
+    Raw zones bootstrapped before the manifest existed would otherwise reload
+    every file and re-stamp _loaded_at on all of history. A file counts as loaded
+    when each of its records has a bootstrapped event; the others stay pending.
+    """
+    if MANIFEST_COLLECTION in db.list_collection_names():
+        return 0
+    collection = db['events_raw']
+    if collection.find_one({'_bootstrapped': True}, {'_id': 1}) is None:
+        return 0
+    seeded = 0
+    for file_info in files:
+        record_count = file_in_events_raw(collection, file_info)
+        if record_count is None:
+            continue
+        file_info['sha256'] = file_sha256(Path(file_info['path']))
+        update_manifest(db, file_info, 'loaded', record_count=record_count, seeded_at=datetime.now())
+        seeded += 1
+    if seeded:
+        logging.info(f"Seeded the bootstrap manifest with {seeded} file(s) already in events_raw")
+    return seeded
+
+
+def pending_bootstrap_files(db, files: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Files not loaded yet or changed since they were loaded.
+
+    Size and modification time are compared first; a file is only hashed when
+    they differ, so an unchanged directory is checked without reading any file.
+    """
+    manifest = {doc['_id']: doc for doc in db[MANIFEST_COLLECTION].find({'_id': {'$in': [f['file_name'] for f in files]}})}
+    pending = []
+    for file_info in files:
+        entry = manifest.get(file_info['file_name'])
+        if entry is None or entry.get('status') != 'loaded' or entry.get('size') != file_info['size']:
+            pending.append(file_info)
+        elif entry.get('mtime') != file_info['mtime']:
+            file_info['sha256'] = file_sha256(Path(file_info['path']))
+            if file_info['sha256'] != entry.get('sha256'):
+                pending.append(file_info)
+            else:
+                # Touched but identical: remember the new time so it is not hashed again
+                db[MANIFEST_COLLECTION].update_one({'_id': file_info['file_name']}, {'$set': {'mtime': file_info['mtime']}})
+    return pending
+
+
+def update_manifest(db, file_info: Dict[str, Any], status: str, **fields) -> None:
+    db[MANIFEST_COLLECTION].update_one(
+        {'_id': file_info['file_name']},
+        {'$set': {
+            'path': file_info['path'],
+            'event_type': file_info['event_type'],
+            'size': file_info['size'],
+            'mtime': file_info['mtime'],
+            'sha256': file_info.get('sha256'),
+            'status': status,
+            'updated_at': datetime.now(),
+            **fields,
+        }},
+        upsert=True
+    )
+
+
+def load_bootstrap_file(collection, file_info: Dict[str, Any], batch_size: int) -> Dict[str, Any]:
+    """Upsert the records of one historical file as events."""
+    file_name = file_info['file_name']
+    event_type = file_info['event_type']
+    
+    # Load records from file
+    with profile_stage('read_file'):
+        records = load_json_file(file_info['path'])
+    print(f"  Loaded {len(records)} records")
+    
+    # Wrap records as events and prepare bulk operations
+    bulk_operations = []
+    seen_event_ids = set()  # Track event_ids in current file
+    stats = {'records': len(records), 'inserted': 0, 'collisions': 0, 'file_collisions': 0, 'collision_details': [],
+             'matched': 0, 'ingest_date': None}
+    
+    for record in records:
+        event_doc = wrap_as_event(record, event_type)
+        event_id = event_doc['event_id']
+        
+        # Check for duplicate within current file
+        if event_id in seen_event_ids:
+            stats['file_collisions'] += 1
+            logging.warning(f"Duplicate event_id within {file_name}: {event_id}")
+            stats['collision_details'].append({
+                'file': file_name,
+                'event_id': event_id,
+                'event_type': event_type
+            })
+        
+        seen_event_ids.add(event_id)
+        event_doc['event_id'] = encode_event_id(event_id)
+        # Every record of a file is stamped with the load time
+        stats['ingest_date'] = stats['ingest_date'] or ingest_date(event_doc)
+        
+        # Use UpdateOne with upsert to handle duplicates; a reload keeps the first ingestion time
+        ingested_at = event_doc.pop('ingested_at')
+        bulk_operations.append(
+            UpdateOne(
+                {'event_id': event_doc['event_id']},
+                # The server stamps the load time used as the incremental extraction watermark
+                {'$set': event_doc, '$setOnInsert': {'ingested_at': ingested_at}, **LOADED_AT_STAMP},
+                upsert=True
+            )
+        )
+        
+        # Execute batch when batch_size reached
+        if len(bulk_operations) >= batch_size:
+            with profile_stage('bulk_write'):
+                result = collection.bulk_write(bulk_operations, ordered=False)
+            stats['inserted'] += result.upserted_count + result.modified_count
+            stats['matched'] += result.matched_count
+            # Track collisions (modified_count means event_id already existed)
+            if result.modified_count > 0:
+                stats['collisions'] += result.modified_count
+                logging.info(f"Batch: {result.modified_count} event_id collisions (overwrites)")
+            bulk_operations = []
     
+    # Insert remaining records
+    if bulk_operations:
+        with profile_stage('bulk_write'):
+            result = collection.bulk_write(bulk_operations, ordered=False)
+        stats['inserted'] += result.upserted_count + result.modified_count
+        stats['matched'] += result.matched_count
+        if result.modified_count > 0:
+            stats['collisions'] += result.modified_count
+            logging.info(f"Final batch: {result.modified_count} event_id collisions (overwrites)")
+    
+    return stats
+
+
+def bootstrap_load(bootstrap_dir, batch_size=500, force=False):
+    """
+    Load the historical files of bootstrap_dir that are new or changed since their last load.
+
+    Each file's size, hash, record count and load status are kept in the bootstrap
+    manifest; force reloads every discovered file.
+    """
     bootstrap_path = Path(bootstrap_dir)
     
     if not bootstrap_path.exists():
@@ -171,103 +370,78 @@ def bootstrap_load(bootstrap_dir, batch_size=500):
     client = get_mongo_client()
     db_name = os.getenv('MONGO_DB')
     db = client[db_name]
-    collection = db['events_raw']
     
-    # Create multiple indexes for performance on upserts and queries
-    collection.create_index('event_id', unique=True)
-    collection.create_index('event_type')
-    collection.create_index('event_time')
-    collection.create_index('ingested_at')
+    # Ensure events_raw (with the configured block compressor), its managed indexes and the manifest index exist
+    collection = ensure_events_raw_collection(db)
+    files = discover_bootstrap_files(bootstrap_path)
+    seed_manifest(db, files)
+    ensure_manifest_indexes(db)
+    
+    pending = files if force else pending_bootstrap_files(db, files)
     
     print(f"Loading historical data from {bootstrap_dir}...")
-    print(f"Target: MongoDB collection '{db_name}.events_raw'\n")
+    print(f"Target: MongoDB collection '{db_name}.events_raw'")
+    print(f"Files: {len(pending)} new or changed, {len(files) - len(pending)} already loaded\n")
     
     total_processed = 0
     total_inserted = 0
     total_collisions = 0
     collision_details = []
     
-    # Process each historical file by looping through the mapping
-    for file_name, event_type in EVENT_TYPE_MAPPING.items():
-        file_path = f"{bootstrap_path}/{file_name}"
-        
-        if not Path(file_path).exists():
-            print(f"Skipping {file_name} (not found)")
-            continue
-        
+    for file_info in pending:
+        file_name = file_info['file_name']
         print(f"Processing {file_name}...")
+        file_info.setdefault('sha256', file_sha256(Path(file_info['path'])))
+        update_manifest(db, file_info, 'loading', started_at=datetime.now())
         
-        # Load records from file
-        records = load_json_file(file_path)
-        print(f"  Loaded {len(records)} records")
-        
-        # Wrap records as events and prepare bulk operations
-        bulk_operations = []
-        seen_event_ids = set()  # Track event_ids in current file
-        file_collisions = 0
-        
-        for record in records:
-            event_doc = wrap_as_event(record, event_type)
-            event_id = event_doc['event_id']
-            
-            # Check for duplicate within current file
-            if event_id in seen_event_ids:
-                file_collisions += 1
-                logging.warning(f"Duplicate event_id within {file_name}: {event_id}")
-                collision_details.append({
-                    'file': file_name,
-                    'event_id': event_id,
-                    'event_type': event_type
-                })
-            
-            seen_event_ids.add(event_id)
-            
-            # Use UpdateOne with upsert to handle duplicates
-            bulk_operations.append(
-                UpdateOne(
-                    {'event_id': event_doc['event_id']},
-                    {'$set': event_doc},
-                    upsert=True
-                )
-            )
-            
-            # Execute batch when batch_size reached
-            if len(bulk_operations) >= batch_size:
-                result = collection.bulk_write(bulk_operations, ordered=False)
-                total_inserted += result.upserted_count + result.modified_count
-                # Track collisions (modified_count means event_id already existed)
-                if result.modified_count > 0:
-                    total_collisions += result.modified_count
-                    logging.info(f"Batch: {result.modified_count} event_id collisions (overwrites)")
-                bulk_operations = []
+        try:
+            file_stats = load_bootstrap_file(collection, file_info, batch_size)
+        except Exception as e:
+            update_manifest(db, file_info, 'failed', error=str(e))
+            raise
         
-        # Insert remaining records
-        if bulk_operations:
-            result = collection.bulk_write(bulk_operations, ordered=False)
-            total_inserted += result.upserted_count + result.modified_count
-            if result.modified_count > 0:
-                total_collisions += result.modified_count
-                logging.info(f"Final batch: {result.modified_count} event_id collisions (overwrites)")
-        
-        total_processed += len(records)
-        if file_collisions > 0:
-            print(f" --- Found {file_collisions} duplicate event_ids within {file_name} ---")
+        if file_stats['ingest_date']:
+            # Repeated records are upserted again and match their first copy
+            repeated = file_stats['file_collisions']
+            record_deliveries(db, file_name, {file_stats['ingest_date']: {
+                'written': file_stats['records'] - repeated,
+                'repeated': repeated,
+                'matched': max(0, file_stats['matched'] - repeated),
+            }})
+        update_manifest(
+            db, file_info, 'loaded',
+            record_count=file_stats['records'],
+            inserted=file_stats['inserted'],
+            collisions=file_stats['collisions'],
+            loaded_at=datetime.now()
+        )
+        total_processed += file_stats['records']
+        total_inserted += file_stats['inserted']
+        total_collisions += file_stats['collisions']
+        collision_details.extend(file_stats['collision_details'])
+        if file_stats['file_collisions'] > 0:
+            print(f" --- Found {file_stats['file_collisions']} duplicate event_ids within {file_name} ---")
         print(f"  ✓ Completed {file_name}\n")
     
     print(f"\n{'='*60}")
     print("Bootstrap Load Summary:")
+    print(f"  Files loaded: {len(pending)} (skipped unchanged: {len(files) - len(pending)})")
     print(f"  Total records processed: {total_processed:,}")
-    print(f"  Total events in MongoDB: {collection.count_documents({}):,}")
+    print(f"  Total events in MongoDB: {collection.estimated_document_count():,}")
     print(f"  Total duplicate event_ids: {total_collisions:,}")
     if collision_details:
         print(f"  Collision details: {len(collision_details)} duplicate(s) within files")
         logging.info(f"Full collision list: {collision_details[:10]}...")  # Log first 10
     print(f"{'='*60}\n")
     
+    # Record payload fingerprint counts for drift reporting
+    REGISTRY.flush_counts(db)
     client.close()
     
     
     return {
+        'files_loaded': len(pending),
+        'files_skipped': len(files) - len(pending),
         'total_processed': total_processed,
         'total_inserted': total_inserted,
         'total_collisions': total_collisions,
@@ -275,15 +449,14 @@ def bootstrap_load(bootstrap_dir, batch_size=500):
     }
     
 
-def check_bootstrap_loaded() -> bool:
-    
-    # Check if bootstrap data has been loaded by verifying any document with _bootstrapped = True
+def find_pending_bootstrap_files(bootstrap_dir) -> List[Dict[str, Any]]:
+    """Bootstrap files that a bootstrap_load would (re)load now."""
+    if not Path(bootstrap_dir).exists():
+        return []
     client = get_mongo_client()
-    db_name = os.getenv('MONGO_DB')
-    db = client[db_name]
-    collection = db['events_raw']
-    
-    count = collection.count_documents({'_bootstrapped': True})
+    db = client[os.getenv('MONGO_DB')]
+    files = discover_bootstrap_files(bootstrap_dir)
+    seed_manifest(db, files)
+    pending = pending_bootstrap_files(db, files)
     client.close()
-    
-    return count > 0
\ No newline at end of file
+    return pending
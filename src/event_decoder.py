@@ -0,0 +1,325 @@
+"""
+Typed decoding and validation of live event JSONL files in a single pass.
+
+Uses msgspec when installed, otherwise orjson or the standard json module with
+the same record definitions checked in Python.
+
+Usage:
+  python -m src.event_decoder data/live_events/2026-01-19/events.jsonl
+"""
+import argparse
+import json
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+LIVE_EVENT_TYPES = {'order_created', 'payment_succeeded', 'refund_issued', 'shipment_updated', 'order_updated'}
+
+# Field type codes used by the record definitions below
+FIELD_TYPES = {
+    'str': str,
+    'num': float,
+    'int': int,
+    'obj': dict,
+    'list': list,
+}
+_PYTHON_TYPES = {'str': str, 'num': (int, float), 'int': int, 'obj': dict, 'list': list}
+
+# Record definition of every vendor payload: required fields, optional fields (drift
+# variants and nullable values) and groups of which at least one must be present.
+PAYLOAD_SPECS: Dict[Tuple[str, str], Dict[str, Any]] = {
+    ('vendor_a', 'order_created'): {
+        'required': {'orderRef': 'str', 'created': 'str', 'currency': 'str', 'items': 'list'},
+        'optional': {'customer': 'obj', 'buyer': 'obj', 'total': 'num', 'totalAmount': 'num', 'region': 'str'},
+        'one_of': [('total', 'totalAmount'), ('customer', 'buyer')],
+    },
+    ('vendor_a', 'payment_succeeded'): {
+        'required': {'orderRef': 'str', 'paidAt': 'str', 'amount': 'num', 'currency': 'str', 'method': 'str', 'txRef': 'str'},
+        'optional': {'status': 'str', 'payment_status': 'str'},
+        'one_of': [('status', 'payment_status')],
+    },
+    ('vendor_a', 'refund_issued'): {
+        'required': {'orderRef': 'str', 'refundedAt': 'str', 'amount': 'num', 'currency': 'str', 'reason': 'str'},
+        'optional': {'items': 'list', 'refunded_items': 'list'},
+        'one_of': [],
+    },
+    ('vendor_a', 'shipment_updated'): {
+        'required': {'orderRef': 'str', 'tracking': 'str', 'status': 'str'},
+        'optional': {'updateTime': 'str', 'update_time': 'str'},
+        'one_of': [('updateTime', 'update_time')],
+    },
+    ('vendor_a', 'order_updated'): {
+        'required': {'orderRef': 'str', 'change': 'str'},
+        'optional': {'updatedAt': 'str', 'updated_at': 'str', 'notes': 'str'},
+        'one_of': [('updatedAt', 'updated_at')],
+    },
+    ('vendor_b', 'order_created'): {
+        'required': {'order_id': 'str', 'created_at': 'str', 'totalAmount': 'num', 'line_items': 'list'},
+        'optional': {'buyerEmail': 'str', 'currencyCode': 'str', 'currency': 'str', 'state': 'str'},
+        'one_of': [('currencyCode', 'currency')],
+    },
+    ('vendor_b', 'payment_succeeded'): {
+        'required': {'order_id': 'str', 'paid_at': 'str', 'payment_status': 'str', 'currencyCode': 'str', 'channel': 'str', 'transaction_id': 'str'},
+        'optional': {'amountPaid': 'num', 'amount_paid': 'num'},
+        'one_of': [('amountPaid', 'amount_paid')],
+    },
+    ('vendor_b', 'refund_issued'): {
+        'required': {'order_id': 'str', 'refunded_at': 'str', 'refundAmount': 'num', 'currencyCode': 'str'},
+        'optional': {'refund_reason': 'str', 'reason': 'str', 'refunded_items': 'list'},
+        'one_of': [('refund_reason', 'reason')],
+    },
+    ('vendor_b', 'shipment_updated'): {
+        'required': {'order_id': 'str', 'tracking_code': 'str', 'time': 'str'},
+        'optional': {'shipment_status': 'str', 'status': 'str'},
+        'one_of': [('shipment_status', 'status')],
+    },
+    ('vendor_b', 'order_updated'): {
+        'required': {'order_id': 'str', 'updated_at': 'str'},
+        'optional': {'change_type': 'str', 'change': 'str'},
+        'one_of': [('change_type', 'change')],
+    },
+    ('vendor_c', 'order_created'): {
+        'required': {'order': 'obj', 'amount': 'num', 'ccy': 'str', 'items': 'list'},
+        'optional': {'email': 'str', 'geo': 'obj'},
+        'one_of': [],
+    },
+    ('vendor_c', 'payment_succeeded'): {
+        'required': {'order': 'str', 'timestamp': 'int', 'amt': 'num', 'ccy': 'str', 'paymentMethod': 'str', 'txn': 'str'},
+        'optional': {'state': 'str', 'payment_state': 'str'},
+        'one_of': [('state', 'payment_state')],
+    },
+    ('vendor_c', 'refund_issued'): {
+        'required': {'order': 'str', 'ts': 'int', 'amt': 'num', 'ccy': 'str', 'reason': 'str'},
+        'optional': {'items_refunded': 'list', 'items': 'list'},
+        'one_of': [],
+    },
+    ('vendor_c', 'shipment_updated'): {
+        'required': {'order': 'obj', 'tracking': 'str', 'ts': 'int'},
+        'optional': {'state': 'str', 'status': 'str'},
+        'one_of': [('state', 'status')],
+    },
+    ('vendor_c', 'order_updated'): {
+        'required': {'order': 'str', 'ts': 'int', 'change': 'str'},
+        'optional': {'notes': 'str', 'note': 'str'},
+        'one_of': [],
+    },
+}
+
+
+class EventDecodeError(ValueError):
+    """Raised for a line that is not a valid live event; the message gives the precise reason."""
+
+
+# RFC3339 timestamps as written by the generator; validated but kept as strings
+RFC3339_PATTERN = r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})?$'
+_RFC3339_RE = re.compile(RFC3339_PATTERN)
+
+
+def _build_msgspec_types():
+    """Compile the envelope record and one record per vendor payload variant."""
+    from typing import Annotated
+    Timestamp = Annotated[str, msgspec.Meta(pattern=RFC3339_PATTERN)]
+
+    class Envelope(msgspec.Struct):
+        event_id: str
+        event_type: str
+        event_time: Timestamp
+        vendor: str
+        payload: Dict[str, Any]
+        ingested_at: Optional[Timestamp] = None
+
+    # (record, one_of groups) per vendor payload variant, so validation is a single lookup
+    payload_records = {}
+    for (vendor, event_type), spec in PAYLOAD_SPECS.items():
+        fields = [(name, FIELD_TYPES[code]) for name, code in spec['required'].items()]
+        fields += [(name, Optional[FIELD_TYPES[code]], None) for name, code in spec['optional'].items()]
+        record_type = msgspec.defstruct(f"{vendor}_{event_type}", fields)
+        payload_records[(vendor, event_type)] = (record_type, spec['one_of'])
+    return msgspec.json.Decoder(Envelope), payload_records
+
+
+if msgspec is not None:
+    _ENVELOPE_DECODER, _PAYLOAD_RECORDS = _build_msgspec_types()
+
+
+def _validate_envelope(envelope) -> Dict[str, Any]:
+    """Validate the payload of a decoded envelope against its vendor record and return the event dict."""
+    event_type = envelope.event_type
+    if event_type not in LIVE_EVENT_TYPES:
+        raise EventDecodeError(f"Unknown event_type `{event_type}` - at `$.event_type`")
+    payload = envelope.payload
+    # Unknown vendors are landed unvalidated and surface in the data quality report
+    variant = _PAYLOAD_RECORDS.get((envelope.vendor, event_type))
+    if variant is not None:
+        record_type, one_of = variant
+        try:
+            msgspec.convert(payload, record_type)
+        except msgspec.ValidationError as e:
+            raise EventDecodeError(str(e).replace('`$', '`$.payload')) from e
+        for group in one_of:
+            if all(payload.get(name) is None for name in group):
+                raise EventDecodeError(f"Missing one of {' / '.join(group)} - at `$.payload`")
+    event = {
+        'event_id': envelope.event_id,
+        'event_type': event_type,
+        'event_time': envelope.event_time,
+        'vendor': envelope.vendor,
+        'payload': payload,
+    }
+    if envelope.ingested_at is not None:
+        event['ingested_at'] = envelope.ingested_at
+    return event
+
+
+def _decode_msgspec(line: bytes) -> Dict[str, Any]:
+    try:
+        envelope = _ENVELOPE_DECODER.decode(line)
+    except msgspec.DecodeError as e:
+        raise EventDecodeError(str(e)) from e
+    return _validate_envelope(envelope)
+
+
+def _decode_msgspec_file(data: bytes) -> Optional[List[Dict[str, Any]]]:
+    """Decode a whole JSONL buffer in one call; None if any line is invalid."""
+    try:
+        return [_validate_envelope(envelope) for envelope in _ENVELOPE_DECODER.decode_lines(data)]
+    except (msgspec.DecodeError, EventDecodeError):
+        return None
+
+
+def _check_type(value: Any, code: str, path: str) -> None:
+    if not isinstance(value, _PYTHON_TYPES[code]) or isinstance(value, bool):
+        raise EventDecodeError(f"Expected `{code}`, got `{type(value).__name__}` - at `{path}`")
+
+
+def _decode_python(line: bytes) -> Dict[str, Any]:
+    try:
+        event = _json_loads(line)
+    except ValueError as e:
+        raise EventDecodeError(f"Invalid JSON: {e}") from e
+    if not isinstance(event, dict):
+        raise EventDecodeError(f"Expected `object`, got `{type(event).__name__}` - at `$`")
+    for field in ('event_id', 'event_type', 'event_time', 'vendor', 'payload'):
+        if field not in event:
+            raise EventDecodeError(f"Object missing required field `{field}`")
+    for field in ('event_id', 'event_type', 'event_time', 'vendor'):
+        _check_type(event[field], 'str', f'$.{field}')
+    _check_type(event['payload'], 'obj', '$.payload')
+    if event['event_type'] not in LIVE_EVENT_TYPES:
+        raise EventDecodeError(f"Unknown event_type `{event['event_type']}` - at `$.event_type`")
+    # Same pattern as the msgspec Timestamp, so validity does not depend on the backend
+    for field in ('event_time', 'ingested_at'):
+        if field in event and event[field] is not None:
+            _check_type(event[field], 'str', f'$.{field}')
+            if not _RFC3339_RE.match(event[field]):
+                raise EventDecodeError(f"Invalid RFC3339 encoded datetime - at `$.{field}`")
+
+    spec = PAYLOAD_SPECS.get((event['vendor'], event['event_type']))
+    if spec is not None:
+        payload = event['payload']
+        for name, code in spec['required'].items():
+            if name not in payload:
+                raise EventDecodeError(f"Object missing required field `{name}` - at `$.payload`")
+            _check_type(payload[name], code, f'$.payload.{name}')
+        for name, code in spec['optional'].items():
+            if payload.get(name) is not None:
+                _check_type(payload[name], code, f'$.payload.{name}')
+        for group in spec['one_of']:
+            if all(payload.get(name) is None for name in group):
+                raise EventDecodeError(f"Missing one of {' / '.join(group)} - at `$.payload`")
+    return event
+
+
+decode_event = _decode_msgspec if msgspec is not None else _decode_python
+
+
+def decode_events_file(file_path: Path) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Decode and validate a live events JSONL file.
+
+    Returns:
+        (events, errors) where errors hold the line number, reason and raw bytes of each invalid line
+    """
+    with open(file_path, 'rb') as f:
+        return decode_events_data(f.read(), file_path)
+
+
+def decode_events_data(data: bytes, source: Any = '<data>') -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """decode_events_file for JSONL bytes already in memory (e.g. the newly appended part of a file)."""
+    # Fast path: every line valid, decoded by msgspec in a single call
+    if msgspec is not None:
+        events = _decode_msgspec_file(data)
+        if events is not None:
+            return events, []
+
+    # Line by line, to report the position and reason of each invalid line
+    events = []
+    errors = []
+    for line_number, line in enumerate(data.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(decode_event(line))
+        except EventDecodeError as e:
+            errors.append({'line': line_number, 'reason': str(e), 'raw': line})
+            logging.warning(f"Invalid event at {source}:{line_number}: {e}")
+    return events, errors
+
+
+def benchmark(file_path: Path, repeat: int = 5) -> Dict[str, float]:
+    """Compare events/sec of the typed decoder with json.loads + key check and with the same checks in Python."""
+    from src.utility import load_json_file
+
+    def legacy():
+        required = ('event_id', 'event_type', 'event_time', 'vendor', 'payload')
+        return [event for event in load_json_file(file_path) if all(field in event for field in required)]
+
+    def python_validated():
+        with open(file_path, 'rb') as f:
+            return [_decode_python(line) for line in f if line.strip()]
+
+    def typed():
+        return decode_events_file(file_path)[0]
+
+    results = {}
+    for name, run in (('json_loads', legacy), ('python_validated', python_validated), ('typed_decoder', typed)):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            count = len(run())
+            best = min(best, time.perf_counter() - start)
+        results[f"{name}_events_per_sec"] = round(count / best)
+    results['speedup'] = round(results['typed_decoder_events_per_sec'] / results['json_loads_events_per_sec'], 2)
+    results['backend'] = 'msgspec' if msgspec is not None else _json_loads.__module__
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate a live events file and benchmark decoding throughput.')
+    parser.add_argument('file', type=Path, help='Path to an events.jsonl file')
+    parser.add_argument('--repeat', type=int, default=5, help='Benchmark repetitions (best run is kept)')
+    args = parser.parse_args()
+
+    events, errors = decode_events_file(args.file)
+    print(f"Valid events: {len(events):,}  Invalid lines: {len(errors):,}")
+    for error in errors[:20]:
+        print(f"  line {error['line']}: {error['reason']}")
+    print(benchmark(args.file, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -162,6 +162,53 @@ def vendor_payload(event_type, vendor, order_id, dt, base_amount, schema_drift=F
                 payload["note"] = payload.pop("notes")
     return payload
 
+def generate_event(day_start, day_end, order_pool, new_orders, dup_rate, late_rate, schema_drift_rate, ingested_at=None):
+    """One random event (and its duplicate, when one is drawn); new_orders is consumed by order_created events."""
+    event_types = ["order_created","payment_succeeded","refund_issued","shipment_updated","order_updated"]
+    day = day_start.date()
+    vendor = random.choice(VENDORS)
+    et = random.choices(event_types, weights=[0.20, 0.33, 0.12, 0.25, 0.10])[0]
+
+    if et == "order_created" and new_orders:
+        order_id = new_orders.pop(0)
+    else:
+        if random.random() < 0.03:
+            order_id = f"ORD-UNKNOWN-{random.randint(1000,9999)}"
+        else:
+            order_id = random.choice(order_pool) if order_pool else f"ORD-{day.strftime('%y%m%d')}-00001"
+
+    if ingested_at is None:
+        ingested_at = rand_dt(day_start, day_end)
+
+    if random.random() < late_rate:
+        lag_days = random.randint(1, 7)
+        event_time = ingested_at - datetime.timedelta(days=lag_days, hours=random.randint(1, 18))
+    else:
+        event_time = ingested_at - datetime.timedelta(minutes=random.randint(0, 120))
+
+    schema_drift = random.random() < schema_drift_rate
+    base_amount = random.choice([5000,9000,12000,18000,25000,40000,65000])
+
+    payload = vendor_payload(et, vendor, order_id, event_time, base_amount, schema_drift=schema_drift)
+
+    event_id = stable_id(vendor, et, order_id, iso(event_time), json.dumps(payload, sort_keys=True))
+    doc = {
+        "event_id": event_id,
+        "event_type": et,
+        "event_time": iso(event_time),
+        "vendor": vendor,
+        "payload": payload,
+        "ingested_at": iso(ingested_at)
+    }
+    generated = [doc]
+
+    if random.random() < dup_rate:
+        dup = dict(doc)
+        if random.random() < 0.5:
+            dup["ingested_at"] = iso(ingested_at + datetime.timedelta(minutes=random.randint(1, 180)))
+        generated.append(dup)
+    return generated
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--out", required=True, help="Output root directory (e.g., data/live_events)")
@@ -191,50 +238,10 @@ def main():
     new_orders = [f"ORD-{day.strftime('%y%m%d')}-{i:05d}" for i in range(1, int(args.events*0.15)+1)]
     order_pool.extend(new_orders)
 
-    event_types = ["order_created","payment_succeeded","refund_issued","shipment_updated","order_updated"]
-
     generated = []
     for _ in range(args.events):
-        vendor = random.choice(VENDORS)
-        et = random.choices(event_types, weights=[0.20, 0.33, 0.12, 0.25, 0.10])[0]
-
-        if et == "order_created" and new_orders:
-            order_id = new_orders.pop(0)
-        else:
-            if random.random() < 0.03:
-                order_id = f"ORD-UNKNOWN-{random.randint(1000,9999)}"
-            else:
-                order_id = random.choice(order_pool) if order_pool else f"ORD-{day.strftime('%y%m%d')}-00001"
-
-        ingested_at = rand_dt(day_start, day_end)
-
-        if random.random() < args.late_rate:
-            lag_days = random.randint(1, 7)
-            event_time = ingested_at - datetime.timedelta(days=lag_days, hours=random.randint(1, 18))
-        else:
-            event_time = ingested_at - datetime.timedelta(minutes=random.randint(0, 120))
-
-        schema_drift = random.random() < args.schema_drift_rate
-        base_amount = random.choice([5000,9000,12000,18000,25000,40000,65000])
-
-        payload = vendor_payload(et, vendor, order_id, event_time, base_amount, schema_drift=schema_drift)
-
-        event_id = stable_id(vendor, et, order_id, iso(event_time), json.dumps(payload, sort_keys=True))
-        doc = {
-            "event_id": event_id,
-            "event_type": et,
-            "event_time": iso(event_time),
-            "vendor": vendor,
-            "payload": payload,
-            "ingested_at": iso(ingested_at)
-        }
-        generated.append(doc)
-
-        if random.random() < args.dup_rate:
-            dup = dict(doc)
-            if random.random() < 0.5:
-                dup["ingested_at"] = iso(ingested_at + datetime.timedelta(minutes=random.randint(1, 180)))
-            generated.append(dup)
+        generated.extend(generate_event(day_start, day_end, order_pool, new_orders,
+                                        args.dup_rate, args.late_rate, args.schema_drift_rate))
 
     with out_path.open("w", encoding="utf-8") as f:
         for d in generated:
@@ -1,6 +1,14 @@
-from src.utility import load_json_file
+from src.event_decoder import decode_events_file
+from src.raw_zone import (
+    ensure_events_raw_collection, derive_query_keys, encode_event_id, normalise_envelope_times,
+    ingest_date, record_deliveries, quarantine_lines,
+)
+from src.schema_registry import REGISTRY
+from src.profiling import profile_stage
+from src.watermarks import LOADED_AT_STAMP
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
+from collections import defaultdict
 from datetime import datetime
 from src.DB_connection import get_mongo_client
 from pymongo import UpdateOne
@@ -16,13 +24,12 @@ logging.basicConfig(
 )
 
 
-def extract_live_events(file_path: Path) -> List[Dict[str, Any]]:
-    """Extract live events from JSONL file."""
+def extract_live_events(file_path: Path) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Extract live events from JSONL file, decoding and validating each line in one pass."""
     if not file_path.exists():
         raise FileNotFoundError(f"Live event file not found: {file_path}")
     
-    events = load_json_file(file_path)
-    return events if events else []
+    return decode_events_file(file_path)
 
 
 def validate_event_structure(event: Dict[str, Any]) -> bool:
@@ -37,8 +44,13 @@ def validate_event_structure(event: Dict[str, Any]) -> bool:
     return True
 
 
-def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000) -> Dict[str, int]:
-    
+def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000, source: Optional[str] = None) -> Dict[str, int]:
+    """
+    Upsert events into events_raw by event_id.
+
+    With source (the delivered file), the duplicate deliveries of the load are
+    recorded per ingest date for the data quality report.
+    """
     if not events:
         logging.warning("No events to load")
         return {'inserted': 0, 'updated': 0, 'skipped': 0, 'duplicates': 0}
@@ -47,13 +59,8 @@ def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000) -
     client = get_mongo_client()
     db_name = os.getenv('MONGO_DB')
     db = client[db_name]
-    collection = db['events_raw']
-    
-    # Ensure indexes exist
-    collection.create_index('event_id', unique=True)
-    collection.create_index('event_type')
-    collection.create_index('event_time')
-    collection.create_index('ingested_at')
+    # Ensure events_raw (with the configured block compressor) and its managed indexes exist
+    collection = ensure_events_raw_collection(db)
     
     stats = {
         'inserted': 0,
@@ -62,8 +69,25 @@ def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000) -
         'duplicates': 0
     }
     
-    bulk_operations = []
+    # Pending upserts and delivery counts per ingest date, so matches are attributed to their day
+    bulk_operations = defaultdict(list)
+    deliveries = defaultdict(lambda: {'written': 0, 'repeated': 0, 'matched': 0})
     seen_event_ids = set()
+
+    def write_batch(day: Optional[str], final: bool = False) -> None:
+        try:
+            with profile_stage('bulk_write'):
+                result = collection.bulk_write(bulk_operations[day], ordered=False)
+            stats['inserted'] += result.upserted_count
+            stats['updated'] += result.modified_count
+            deliveries[day]['written'] += result.upserted_count + result.matched_count
+            deliveries[day]['matched'] += result.matched_count
+
+            if result.modified_count > 0:
+                logging.info(f"{'Final batch' if final else 'Batch'}: {result.upserted_count} new, {result.modified_count} updated")
+        except Exception as e:
+            logging.error(f"{'Final batch' if final else 'Batch'} write error: {e}")
+        bulk_operations[day] = []
     
     for event in events:
         # Validate event structure
@@ -76,6 +100,7 @@ def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000) -
         # Check for duplicates within the batch
         if event_id in seen_event_ids:
             stats['duplicates'] += 1
+            deliveries[ingest_date(event)]['repeated'] += 1
             logging.warning(f"Duplicate event_id in batch: {event_id}")
             continue
         
@@ -85,46 +110,43 @@ def load_events_to_mongo(events: List[Dict[str, Any]], batch_size: int = 1000) -
         if 'ingested_at' not in event:
             event['ingested_at'] = datetime.now()
         
+        # Store the id in the configured form and the envelope timestamps as dates
+        event['event_id'] = encode_event_id(event_id)
+        normalise_envelope_times(event)
+        
+        # Derive canonical top-level query keys from the vendor payload
+        event.update(derive_query_keys(event['payload'] or {}))
+        
+        # Count the payload fingerprint; unseen shapes are reported as drift
+        REGISTRY.dispatch(event['event_type'], event['payload'] or {}, event.get('vendor'))
+        
         # Add _bootstrapped flag (false for live events)
         if '_bootstrapped' not in event:
             event['_bootstrapped'] = False
         
         # Prepare upsert operation
-        bulk_operations.append(
+        day = ingest_date(event)
+        bulk_operations[day].append(
             UpdateOne(
-                {'event_id': event_id},
-                {'$set': event},
+                {'event_id': event['event_id']},
+                # The server stamps the load time used as the incremental extraction watermark
+                {'$set': event, **LOADED_AT_STAMP},
                 upsert=True
             )
         )
         
         # Execute batch when batch_size reached
-        if len(bulk_operations) >= batch_size:
-            try:
-                result = collection.bulk_write(bulk_operations, ordered=False)
-                stats['inserted'] += result.upserted_count
-                stats['updated'] += result.modified_count
-                
-                if result.modified_count > 0:
-                    logging.info(f"Batch: {result.upserted_count} new, {result.modified_count} updated")
-                
-                bulk_operations = []
-            except Exception as e:
-                logging.error(f"Batch write error: {e}")
-                bulk_operations = []
+        if len(bulk_operations[day]) >= batch_size:
+            write_batch(day)
     
     # Insert remaining records
-    if bulk_operations:
-        try:
-            result = collection.bulk_write(bulk_operations, ordered=False)
-            stats['inserted'] += result.upserted_count
-            stats['updated'] += result.modified_count
-            
-            if result.modified_count > 0:
-                logging.info(f"Final batch: {result.upserted_count} new, {result.modified_count} updated")
-        except Exception as e:
-            logging.error(f"Final batch write error: {e}")
+    for day, operations in list(bulk_operations.items()):
+        if operations:
+            write_batch(day, final=True)
     
+    if source:
+        record_deliveries(db, source, {day: counts for day, counts in deliveries.items() if day})
+    REGISTRY.flush_counts(db)
     client.close()
     return stats
 
@@ -138,16 +160,26 @@ def live_event_loader(file_path: Path, batch_size: int = 1000) -> Dict[str, int]
     print(f"Loading live events from {file_path}...")
     
     # Extract events from file
-    events = extract_live_events(file_path)
-    print(f"Extracted {len(events)} events from file")
+    with profile_stage('decode_file'):
+        events, invalid_lines = extract_live_events(file_path)
+    print(f"Extracted {len(events)} events from file ({len(invalid_lines)} invalid lines)")
     
     # Load to MongoDB
-    stats = load_events_to_mongo(events, batch_size)
+    with profile_stage('load_to_mongo'):
+        stats = load_events_to_mongo(events, batch_size, source=str(file_path))
+    stats['skipped'] += len(invalid_lines)
+    stats['invalid_lines'] = invalid_lines
+    
+    # Keep the rejected lines, with their reason and raw bytes, for the data quality report
+    if invalid_lines:
+        client = get_mongo_client()
+        stats['quarantined'] = quarantine_lines(client[os.getenv('MONGO_DB')], str(file_path), invalid_lines)
+        client.close()
     
     # Print summary
     print(f"\n{'='*60}")
     print("Live Event Load Summary:")
-    print(f"  Total events processed: {len(events):,}")
+    print(f"  Total events processed: {len(events) + len(invalid_lines):,}")
     print(f"  New events inserted: {stats['inserted']:,}")
     print(f"  Existing events updated: {stats['updated']:,}")
     print(f"  Invalid/skipped events: {stats['skipped']:,}")
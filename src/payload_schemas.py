@@ -0,0 +1,90 @@
+from typing import Dict, FrozenSet, Tuple
+
+KNOWN_VENDORS = ['vendor_a', 'vendor_b', 'vendor_c']
+
+# Payload key sets of every vendor/event type as originally specified (before schema drift)
+CANONICAL_PAYLOAD_KEYS: Dict[Tuple[str, str], FrozenSet[str]] = {
+    ('vendor_a', 'order_created'): frozenset({'orderRef', 'created', 'customer', 'total', 'currency', 'region', 'items'}),
+    ('vendor_a', 'payment_succeeded'): frozenset({'orderRef', 'paidAt', 'status', 'amount', 'currency', 'method', 'txRef'}),
+    ('vendor_a', 'refund_issued'): frozenset({'orderRef', 'refundedAt', 'amount', 'currency', 'reason', 'items'}),
+    ('vendor_a', 'shipment_updated'): frozenset({'orderRef', 'tracking', 'status', 'updateTime'}),
+    ('vendor_a', 'order_updated'): frozenset({'orderRef', 'updatedAt', 'change', 'notes'}),
+    ('vendor_b', 'order_created'): frozenset({'order_id', 'created_at', 'buyerEmail', 'totalAmount', 'currencyCode', 'state', 'line_items'}),
+    ('vendor_b', 'payment_succeeded'): frozenset({'order_id', 'paid_at', 'payment_status', 'amountPaid', 'currencyCode', 'channel', 'transaction_id'}),
+    ('vendor_b', 'refund_issued'): frozenset({'order_id', 'refunded_at', 'refundAmount', 'currencyCode', 'refund_reason', 'refunded_items'}),
+    ('vendor_b', 'shipment_updated'): frozenset({'order_id', 'tracking_code', 'shipment_status', 'time'}),
+    ('vendor_b', 'order_updated'): frozenset({'order_id', 'updated_at', 'change_type'}),
+    ('vendor_c', 'order_created'): frozenset({'order', 'email', 'amount', 'ccy', 'geo', 'items'}),
+    ('vendor_c', 'payment_succeeded'): frozenset({'order', 'timestamp', 'state', 'amt', 'ccy', 'paymentMethod', 'txn'}),
+    ('vendor_c', 'refund_issued'): frozenset({'order', 'ts', 'amt', 'ccy', 'reason', 'items_refunded'}),
+    ('vendor_c', 'shipment_updated'): frozenset({'order', 'tracking', 'state', 'ts'}),
+    ('vendor_c', 'order_updated'): frozenset({'order', 'ts', 'change', 'notes'}),
+    ('vendor_a', 'historical_order'): frozenset({'orderRef', 'created', 'customer', 'total', 'currency', 'region', 'items', 'shippingAddress'}),
+    ('vendor_b', 'historical_order'): frozenset({'order_id', 'created_at', 'buyerEmail', 'buyerPhone', 'customerId', 'line_items', 'totalAmount', 'currencyCode', 'state', 'address'}),
+    ('vendor_c', 'historical_order'): frozenset({'order', 'email', 'phone', 'cust_id', 'amount', 'ccy', 'geo', 'items', 'shipping'}),
+    ('vendor_a', 'historical_payment'): frozenset({'orderRef', 'paidAt', 'status', 'amount', 'currency', 'method', 'txRef'}),
+    ('vendor_b', 'historical_payment'): frozenset({'order_id', 'paid_at', 'payment_status', 'amountPaid', 'currencyCode', 'channel', 'transaction_id'}),
+    ('vendor_c', 'historical_payment'): frozenset({'order', 'timestamp', 'state', 'amt', 'ccy', 'paymentMethod', 'txn'}),
+    ('vendor_a', 'historical_refund'): frozenset({'orderRef', 'refundedAt', 'amount', 'currency', 'reason', 'items'}),
+    ('vendor_b', 'historical_refund'): frozenset({'order_id', 'refunded_at', 'refundAmount', 'currencyCode', 'refund_reason', 'refunded_items'}),
+    ('vendor_c', 'historical_refund'): frozenset({'order', 'ts', 'amt', 'ccy', 'reason', 'items_refunded'}),
+    ('vendor_a', 'historical_shipment'): frozenset({'orderRef', 'carrier', 'tracking', 'updates'}),
+    ('vendor_b', 'historical_shipment'): frozenset({'order_id', 'logistics_partner', 'tracking_code', 'status_history'}),
+    ('vendor_c', 'historical_shipment'): frozenset({'order', 'carrier', 'tracking', 'timeline'}),
+}
+
+
+def is_canonical_shape(vendor: str, event_type: str, keys) -> bool:
+    """True if a payload's key set matches the canonical shape of its vendor and event type."""
+    return CANONICAL_PAYLOAD_KEYS.get((vendor, event_type)) == frozenset(keys)
+
+
+# Field renames of the schema drift variants the generator emits, applied on top of the canonical keys
+DRIFT_RENAMES: Dict[Tuple[str, str], Dict[str, str]] = {
+    ('vendor_a', 'order_created'): {'total': 'totalAmount', 'customer': 'buyer'},
+    ('vendor_a', 'payment_succeeded'): {'status': 'payment_status'},
+    ('vendor_a', 'refund_issued'): {'items': 'refunded_items'},
+    ('vendor_a', 'shipment_updated'): {'updateTime': 'update_time'},
+    ('vendor_a', 'order_updated'): {'updatedAt': 'updated_at'},
+    ('vendor_b', 'order_created'): {'currencyCode': 'currency'},
+    ('vendor_b', 'payment_succeeded'): {'amountPaid': 'amount_paid'},
+    ('vendor_b', 'refund_issued'): {'refund_reason': 'reason'},
+    ('vendor_b', 'shipment_updated'): {'shipment_status': 'status'},
+    ('vendor_b', 'order_updated'): {'change_type': 'change'},
+    ('vendor_c', 'payment_succeeded'): {'state': 'payment_state'},
+    ('vendor_c', 'refund_issued'): {'items_refunded': 'items'},
+    ('vendor_c', 'shipment_updated'): {'state': 'status'},
+    ('vendor_c', 'order_updated'): {'notes': 'note'},
+}
+
+# Extraction plan of every canonical shape: payload path of each common field
+# (a path is a tuple of keys and list positions, e.g. ('updates', -1, 'time'))
+EXTRACTION_PLANS: Dict[Tuple[str, str], Dict[str, Tuple]] = {
+    ('vendor_a', 'order_created'): {'order_id': ('orderRef',), 'event_time': ('created',), 'amount': ('total',), 'currency': ('currency',)},
+    ('vendor_a', 'payment_succeeded'): {'order_id': ('orderRef',), 'event_time': ('paidAt',), 'amount': ('amount',), 'currency': ('currency',)},
+    ('vendor_a', 'refund_issued'): {'order_id': ('orderRef',), 'event_time': ('refundedAt',), 'amount': ('amount',), 'currency': ('currency',)},
+    ('vendor_a', 'shipment_updated'): {'order_id': ('orderRef',), 'event_time': ('updateTime',)},
+    ('vendor_a', 'order_updated'): {'order_id': ('orderRef',), 'event_time': ('updatedAt',)},
+    ('vendor_b', 'order_created'): {'order_id': ('order_id',), 'event_time': ('created_at',), 'amount': ('totalAmount',), 'currency': ('currencyCode',)},
+    ('vendor_b', 'payment_succeeded'): {'order_id': ('order_id',), 'event_time': ('paid_at',), 'amount': ('amountPaid',), 'currency': ('currencyCode',)},
+    ('vendor_b', 'refund_issued'): {'order_id': ('order_id',), 'event_time': ('refunded_at',), 'amount': ('refundAmount',), 'currency': ('currencyCode',)},
+    ('vendor_b', 'shipment_updated'): {'order_id': ('order_id',), 'event_time': ('time',)},
+    ('vendor_b', 'order_updated'): {'order_id': ('order_id',), 'event_time': ('updated_at',)},
+    ('vendor_c', 'order_created'): {'order_id': ('order', 'id'), 'event_time': ('order', 'ts'), 'amount': ('amount',), 'currency': ('ccy',)},
+    ('vendor_c', 'payment_succeeded'): {'order_id': ('order',), 'event_time': ('timestamp',), 'amount': ('amt',), 'currency': ('ccy',)},
+    ('vendor_c', 'refund_issued'): {'order_id': ('order',), 'event_time': ('ts',), 'amount': ('amt',), 'currency': ('ccy',)},
+    ('vendor_c', 'shipment_updated'): {'order_id': ('order', 'id'), 'event_time': ('ts',)},
+    ('vendor_c', 'order_updated'): {'order_id': ('order',), 'event_time': ('ts',)},
+    ('vendor_a', 'historical_order'): {'order_id': ('orderRef',), 'event_time': ('created',), 'amount': ('total',), 'currency': ('currency',)},
+    ('vendor_b', 'historical_order'): {'order_id': ('order_id',), 'event_time': ('created_at',), 'amount': ('totalAmount',), 'currency': ('currencyCode',)},
+    ('vendor_c', 'historical_order'): {'order_id': ('order', 'id'), 'event_time': ('order', 'ts'), 'amount': ('amount',), 'currency': ('ccy',)},
+    ('vendor_a', 'historical_payment'): {'order_id': ('orderRef',), 'event_time': ('paidAt',), 'amount': ('amount',), 'currency': ('currency',)},
+    ('vendor_b', 'historical_payment'): {'order_id': ('order_id',), 'event_time': ('paid_at',), 'amount': ('amountPaid',), 'currency': ('currencyCode',)},
+    ('vendor_c', 'historical_payment'): {'order_id': ('order',), 'event_time': ('timestamp',), 'amount': ('amt',), 'currency': ('ccy',)},
+    ('vendor_a', 'historical_refund'): {'order_id': ('orderRef',), 'event_time': ('refundedAt',), 'amount': ('amount',), 'currency': ('currency',)},
+    ('vendor_b', 'historical_refund'): {'order_id': ('order_id',), 'event_time': ('refunded_at',), 'amount': ('refundAmount',), 'currency': ('currencyCode',)},
+    ('vendor_c', 'historical_refund'): {'order_id': ('order',), 'event_time': ('ts',), 'amount': ('amt',), 'currency': ('ccy',)},
+    ('vendor_a', 'historical_shipment'): {'order_id': ('orderRef',), 'event_time': ('updates', -1, 'time')},
+    ('vendor_b', 'historical_shipment'): {'order_id': ('order_id',), 'event_time': ('status_history', -1, 'time')},
+    ('vendor_c', 'historical_shipment'): {'order_id': ('order', 'id'), 'event_time': ('timeline', -1, 'time')},
+}
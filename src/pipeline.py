@@ -1,47 +1,118 @@
 from pathlib import Path
 from datetime import datetime
-from .bootstrap_loader import bootstrap_load, check_bootstrap_loaded
+from .bootstrap_loader import bootstrap_load, find_pending_bootstrap_files
 from .live_event_loader import live_event_loader
+from .raw_zone import backfill_query_keys, compact_events_raw, storage_report, print_storage_report
+from .raw_snapshot import export_raw_snapshot
+from .profiling import enable_profiling, profile_stage, finish_profiling
 from config import configs
 from src.analytics.run_analytics import run_analytics
+from src.analytics.reprocess import reprocess
+from src.analytics.stream_sync import run_change_stream_sync
+from src.analytics.create_tables import create_tables_if_not_exists
+from src.analytics.data_quality import generate_dq_report
 
 BOOTSTRAP_DIR = configs['BOOTSTRAP_DIR']
+PROFILE_DIR = configs['PROFILE_DIR']
 
 def run_pipeline(args):
     # Determine live events file path
-    if args.date:
-        live_event_path = Path(f'data/live_events/{args.date}/events.jsonl')
-    else:
-        today = datetime.now().strftime('%Y-%m-%d')
-        live_event_path = Path(f'data/live_events/{today}/events.jsonl')
+    report_date = args.date or datetime.now().strftime('%Y-%m-%d')
+    live_event_path = Path(f'data/live_events/{report_date}/events.jsonl')
+    
+    # Sample every stage below; off by default so the hooks cost nothing
+    if args.profile:
+        enable_profiling(PROFILE_DIR)
     
     try:
-        # Handle bootstrap loading
+        # Rebuild the Postgres model from the raw zone instead of loading new data
+        if args.reprocess_from:
+            print("\n" + "="*60)
+            print("Starting reprocessing...")
+            print("="*60)
+            # Only the coordinating process is sampled, not the worker processes
+            with profile_stage('reprocess'):
+                stats_reprocess = reprocess(
+                    args.reprocess_from,
+                    args.reprocess_to or args.reprocess_from,
+                    workers=args.workers,
+                    snapshot_dir=args.from_snapshot,
+                    swap=not args.no_swap,
+                    accept_changes=args.accept_changes
+                )
+            print(f"Reprocess Stats: {stats_reprocess}\n")
+            return
+        
+        # Stream events_raw changes into the Postgres model instead of a batch run
+        if args.sync:
+            print("\n" + "="*60)
+            print("Starting change stream sync (Ctrl+C to stop)...")
+            print("="*60)
+            create_tables_if_not_exists()
+            stats_sync = run_change_stream_sync(args.batch_size, args.sync_max_wait)
+            print(f"Change Stream Sync Stats: {stats_sync}\n")
+            return
+        
+        # Convert stored documents to the configured storage form before new loads use it
+        if args.compact_raw:
+            print("\n" + "="*60)
+            print("Compacting events_raw...")
+            print("="*60)
+            print_storage_report(storage_report(), "Before")
+            with profile_stage('compact_raw'):
+                stats_compact = compact_events_raw(args.batch_size, recompress=args.recompress)
+            print_storage_report(storage_report(), "After")
+            print(f"Compaction Stats: {stats_compact}\n")
+        elif args.storage_report:
+            print_storage_report(storage_report())
+        
+        # Handle bootstrap loading: only files missing from the manifest or changed since are loaded
         if args.bootstrap_only or not args.skip_bootstrap:
-            bootstrap_loaded = check_bootstrap_loaded()
+            with profile_stage('bootstrap_manifest_check'):
+                pending_files = find_pending_bootstrap_files(BOOTSTRAP_DIR)
             
-            if (not bootstrap_loaded and not args.skip_bootstrap) or args.force_rerun_bootstrap:
+            if (pending_files and not args.skip_bootstrap) or args.force_rerun_bootstrap:
                 print("\n" + "="*60)
                 print("Starting bootstrap load...")
                 print("="*60)
-                stats_bootstrap = bootstrap_load(BOOTSTRAP_DIR, args.batch_size)
+                with profile_stage('bootstrap_load'):
+                    stats_bootstrap = bootstrap_load(BOOTSTRAP_DIR, args.batch_size, force=args.force_rerun_bootstrap)
                 print(f"Bootstrap Load Stats: {stats_bootstrap}\n")
             else:
-                print("\n✓ Bootstrap data already loaded. Skipping bootstrap load...\n")
+                print("\n✓ Bootstrap files already loaded. Skipping bootstrap load...\n")
         
         # Handle live events loading
         if not args.bootstrap_only:
             print("="*60)
             print("Starting live event load...")
             print("="*60)
-            stats_live = live_event_loader(live_event_path, args.batch_size)
+            with profile_stage('live_event_load'):
+                stats_live = live_event_loader(live_event_path, args.batch_size)
             print(f"Live Event Load Stats: {stats_live}\n")
         
         print("="*60)
         
+        # Backfill canonical query keys on documents loaded before they existed
+        if args.backfill_order_keys:
+            with profile_stage('backfill_order_keys'):
+                stats_backfill = backfill_query_keys(args.batch_size)
+            print(f"Order Key Backfill Stats: {stats_backfill}\n")
+        
+        # Append newly loaded raw events to the Parquet snapshot
+        if args.export_snapshot:
+            with profile_stage('export_snapshot'):
+                stats_snapshot = export_raw_snapshot()
+            print(f"Raw Snapshot Export Stats: {stats_snapshot}\n")
+        
         # Run analytics
         print("Running transformations and analytics...")
-        run_analytics()
+        with profile_stage('analytics'):
+            run_analytics(snapshot_dir=args.from_snapshot)
+        
+        # Daily data quality report for events ingested on the run date
+        with profile_stage('dq_report'):
+            dq_report = generate_dq_report(report_date)
+        print(f"Data Quality Report ({report_date}): {dq_report['details']}")
         
         print("Pipeline execution completed successfully!")
         print("="*60)
@@ -49,4 +120,7 @@ def run_pipeline(args):
     except Exception as e:
         print(f"\n Error during pipeline execution: {e}")
         raise
+    
+    finally:
+        finish_profiling()
 
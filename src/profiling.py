@@ -0,0 +1,172 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+# Seconds between two stack samples of the profiled thread
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+DEFAULT_TOP_N = 15
+
+# Returned by profile_stage while profiling is off, so a disabled hook costs one global lookup
+_DISABLED = nullcontext()
+
+
+def frame_label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class StageProfiler:
+    """
+    Wall-clock sampling profiler for named pipeline stages.
+
+    While a stage is open, a background thread samples the stack of the thread
+    that opened it every interval seconds; each sample is weighted by the time
+    since the previous one and attributed to the innermost open stage. Waits
+    (bulk_write round trips, Postgres calls) show up in the stacks as well as
+    Python work. Stages nest: an inner stage is recorded as outer/inner.
+    """
+
+    def __init__(self, output_dir: str, interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self.output_dir = output_dir
+        self.interval = interval
+        # stage -> collapsed stack -> sampled microseconds
+        self.stacks: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self.open_stages: List[str] = []
+        self.thread_id = None
+        self.sampler = None
+        self.stopping = threading.Event()
+
+    @contextmanager
+    def stage(self, name: str):
+        # Only the thread that opened the outermost stage is sampled
+        if self.open_stages and threading.get_ident() != self.thread_id:
+            yield
+            return
+        path = f"{self.open_stages[-1]}/{name}" if self.open_stages else name
+        self.open_stages.append(path)
+        if len(self.open_stages) == 1:
+            self.start_sampler()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[path] += time.perf_counter() - started
+            self.open_stages.pop()
+            if not self.open_stages:
+                self.stop_sampler()
+
+    def start_sampler(self) -> None:
+        self.thread_id = threading.get_ident()
+        self.stopping.clear()
+        self.sampler = threading.Thread(target=self.sample_loop, name='stage-profiler', daemon=True)
+        self.sampler.start()
+
+    def stop_sampler(self) -> None:
+        self.stopping.set()
+        self.sampler.join()
+        self.sampler = None
+
+    def sample_loop(self) -> None:
+        last = time.perf_counter()
+        while not self.stopping.wait(self.interval):
+            now = time.perf_counter()
+            frame = sys._current_frames().get(self.thread_id)
+            stages = self.open_stages
+            if frame is None or not stages:
+                last = now
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[stages[-1]][';'.join(reversed(labels))] += int((now - last) * 1_000_000)
+            last = now
+
+    def hotspots(self, top_n: int = DEFAULT_TOP_N) -> List[Dict[str, Any]]:
+        """Functions with the most sampled time at the top of the stack (self) and anywhere on it (total)."""
+        self_time = defaultdict(int)
+        total_time = defaultdict(int)
+        for stacks in self.stacks.values():
+            for stack, micros in stacks.items():
+                frames = stack.split(';')
+                self_time[frames[-1]] += micros
+                for label in set(frames):
+                    total_time[label] += micros
+        sampled = sum(self_time.values()) or 1
+        ranked = sorted(self_time.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        return [{
+            'function': label,
+            'self_seconds': round(micros / 1_000_000, 3),
+            'self_percent': round(100 * micros / sampled, 1),
+            'total_seconds': round(total_time[label] / 1_000_000, 3),
+        } for label, micros in ranked]
+
+    def write_report(self, top_n: int = DEFAULT_TOP_N) -> Dict[str, Any]:
+        """
+        Write one collapsed-stack file per stage, a combined one rooted at the stage
+        names (inputs for flamegraph.pl or speedscope), and a JSON summary.
+        """
+        run_dir = os.path.join(self.output_dir, datetime.now().strftime('%Y%m%d_%H%M%S'))
+        os.makedirs(run_dir, exist_ok=True)
+        stages = {}
+        combined = []
+        for stage, seconds in self.stage_seconds.items():
+            stacks = self.stacks.get(stage, {})
+            file_path = os.path.join(run_dir, f"{stage.replace('/', '.')}.collapsed")
+            with open(file_path, 'w') as f:
+                for stack, micros in sorted(stacks.items()):
+                    f.write(f"{stack} {micros}\n")
+                    combined.append(f"{stage.replace('/', ';')};{stack} {micros}\n")
+            stages[stage] = {'seconds': round(seconds, 3), 'samples': len(stacks), 'file': file_path}
+        with open(os.path.join(run_dir, 'all_stages.collapsed'), 'w') as f:
+            f.writelines(combined)
+
+        report = {'output_dir': run_dir, 'stages': stages, 'hotspots': self.hotspots(top_n)}
+        with open(os.path.join(run_dir, 'summary.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+# Set by enable_profiling (main.py --profile); None keeps every hook a no-op
+PROFILER: Optional[StageProfiler] = None
+
+
+def enable_profiling(output_dir: str, interval: float = DEFAULT_SAMPLE_INTERVAL) -> StageProfiler:
+    """Start recording the stages of this process."""
+    global PROFILER
+    PROFILER = StageProfiler(output_dir, interval)
+    return PROFILER
+
+
+def profile_stage(name: str):
+    """Context manager timing and sampling a pipeline stage while profiling is enabled."""
+    if PROFILER is None:
+        return _DISABLED
+    return PROFILER.stage(name)
+
+
+def finish_profiling(top_n: int = DEFAULT_TOP_N) -> Optional[Dict[str, Any]]:
+    """Write and print the profile of this run; None when profiling is off."""
+    if PROFILER is None:
+        return None
+    report = PROFILER.write_report(top_n)
+    print_profile_report(report)
+    return report
+
+
+def print_profile_report(report: Dict[str, Any]) -> None:
+    print("Profile Summary:")
+    for stage, details in report['stages'].items():
+        print(f"  {stage:<45} {details['seconds']:>9.3f}s")
+    print(f"  Top {len(report['hotspots'])} hotspots (self time):")
+    for hotspot in report['hotspots']:
+        print(f"    {hotspot['self_seconds']:>8.3f}s {hotspot['self_percent']:>5.1f}%  "
+              f"{hotspot['function']} (total {hotspot['total_seconds']:.3f}s)")
+    print(f"  Collapsed stacks written to {report['output_dir']}")
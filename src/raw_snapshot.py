@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import pandas as pd
+from config import configs
+from src.DB_connection import get_mongo_client
+from src.utility import parse_timestamp
+from src.raw_zone import decode_event_id
+from src.watermarks import get_watermark, set_watermark, loaded_after_query, max_loaded_at
+
+SNAPSHOT_DIR = configs['RAW_SNAPSHOT_DIR']
+WATERMARK_NAME = 'raw_snapshot'
+PARTITION_COLUMNS = ['event_date', 'event_type', 'vendor']
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("The raw snapshot requires pyarrow: pip install pyarrow") from e
+    return pa, ds, pq
+
+
+def snapshot_schema(pa):
+    """Arrow schema of a snapshot row. The vendor payload is kept verbatim as JSON text."""
+    return pa.schema([
+        ('event_id', pa.string()),
+        ('event_time', pa.timestamp('us')),
+        ('order_key', pa.string()),
+        ('skus', pa.list_(pa.string())),
+        ('payload', pa.string()),
+        ('ingested_at', pa.timestamp('us')),
+        ('_loaded_at', pa.timestamp('us')),
+        ('_bootstrapped', pa.bool_()),
+        ('event_date', pa.string()),
+        ('event_type', pa.string()),
+        ('vendor', pa.string()),
+    ])
+
+
+def to_snapshot_row(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten an events_raw document into a typed snapshot row."""
+    event_time = parse_timestamp(doc.get('event_time'))
+    return {
+        'event_id': str(decode_event_id(doc.get('event_id'))),
+        'event_time': event_time,
+        'order_key': doc.get('order_key'),
+        'skus': doc.get('skus') or [],
+        'payload': json.dumps(doc.get('payload'), default=str, sort_keys=True),
+        'ingested_at': parse_timestamp(doc.get('ingested_at')),
+        '_loaded_at': doc.get('_loaded_at'),
+        '_bootstrapped': bool(doc.get('_bootstrapped')),
+        'event_date': event_time.strftime('%Y-%m-%d') if event_time else 'unknown',
+        'event_type': doc.get('event_type') or 'unknown',
+        'vendor': doc.get('vendor') or 'unknown',
+    }
+
+
+def _write_chunk(rows: List[Dict[str, Any]], snapshot_dir: Path, run_id: str, chunk_number: int) -> None:
+    pa, ds, pq = _import_pyarrow()
+    table = pa.Table.from_pylist(rows, schema=snapshot_schema(pa))
+    # A chunk of bootstrap history spans far more than pyarrow's default of 1024 partitions
+    partitions = len({tuple(row[column] for column in PARTITION_COLUMNS) for row in rows})
+    pq.write_to_dataset(
+        table,
+        root_path=str(snapshot_dir),
+        partition_cols=PARTITION_COLUMNS,
+        # Unique file names per run keep earlier increments untouched
+        basename_template=f"part-{run_id}-{chunk_number}-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore',
+        max_partitions=max(partitions, 1024),
+    )
+
+
+def export_raw_snapshot(snapshot_dir: str = SNAPSHOT_DIR, chunk_size: int = 50000, full_refresh: bool = False) -> Dict[str, Any]:
+    """
+    Append events_raw documents loaded since the last export to the Parquet snapshot.
+
+    Files are partitioned by event_date/event_type/vendor. A re-loaded event appears
+    again in a later increment; readers keep its most recent copy.
+    """
+    snapshot_path = Path(snapshot_dir)
+    snapshot_path.mkdir(parents=True, exist_ok=True)
+
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    watermark = None if full_refresh else get_watermark(db, WATERMARK_NAME)
+    print(f"Exporting events_raw loaded after {watermark or 'the beginning'} to {snapshot_path}...")
+
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    new_watermark = watermark
+    rows = []
+    stats = {'exported': 0, 'files_written': 0}
+    for doc in db['events_raw'].find(loaded_after_query(watermark), {'_id': 0}).batch_size(1000):
+        new_watermark = max_loaded_at(new_watermark, doc)
+        rows.append(to_snapshot_row(doc))
+        if len(rows) >= chunk_size:
+            _write_chunk(rows, snapshot_path, run_id, stats['files_written'])
+            stats['exported'] += len(rows)
+            stats['files_written'] += 1
+            rows = []
+
+    if rows:
+        _write_chunk(rows, snapshot_path, run_id, stats['files_written'])
+        stats['exported'] += len(rows)
+        stats['files_written'] += 1
+
+    if new_watermark is not None:
+        set_watermark(db, WATERMARK_NAME, new_watermark)
+
+    logging.info(f"Raw snapshot export: {stats}")
+    client.close()
+    return stats
+
+
+def load_from_snapshot(
+    snapshot_dir: str = SNAPSHOT_DIR,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    event_types: Optional[List[str]] = None,
+    vendors: Optional[List[str]] = None,
+    loaded_after: Optional[datetime] = None,
+) -> pd.DataFrame:
+    """
+    Load events from the Parquet snapshot, as an alternative to load_from_mongoDB.
+
+    Args:
+        snapshot_dir: Root directory of the snapshot
+        start_date: First event_date to include (YYYY-MM-DD)
+        end_date: Last event_date to include (YYYY-MM-DD)
+        event_types: Restrict to these event types
+        vendors: Restrict to these vendors
+        loaded_after: Only events whose _loaded_at is later than this watermark
+    Returns:
+        DataFrame shaped like events_raw, with payloads decoded back to dicts
+    """
+    pa, ds, pq = _import_pyarrow()
+    if not Path(snapshot_dir).exists():
+        raise FileNotFoundError(f"Raw snapshot not found: {snapshot_dir}")
+
+    partitioning = ds.partitioning(
+        pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS]), flavor='hive'
+    )
+    dataset = ds.dataset(snapshot_dir, format='parquet', partitioning=partitioning)
+
+    # Partition filters prune whole directories before any file is opened
+    expression = None
+    conditions = []
+    if start_date:
+        conditions.append(ds.field('event_date') >= start_date)
+    if end_date:
+        conditions.append(ds.field('event_date') <= end_date)
+    if event_types:
+        conditions.append(ds.field('event_type').isin(event_types))
+    if vendors:
+        conditions.append(ds.field('vendor').isin(vendors))
+    if loaded_after is not None:
+        conditions.append(ds.field('_loaded_at') > pa.scalar(loaded_after, type=pa.timestamp('us')))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    df = dataset.to_table(filter=expression, use_threads=True).to_pandas()
+    if df.empty:
+        return df
+
+    df = df.sort_values('_loaded_at').drop_duplicates('event_id', keep='last')
+    df['payload'] = df['payload'].map(json.loads)
+    return df.reset_index(drop=True)
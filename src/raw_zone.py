@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+import bson
+from bson import Binary
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+from config import configs
+from src.DB_connection import get_mongo_client
+from src.utility import extract_order_id, parse_timestamp
+
+# Managed index set for events_raw: (keys, options)
+EVENTS_RAW_INDEXES = [
+    ([('event_id', ASCENDING)], {'unique': True}),
+    ([('event_type', ASCENDING)], {}),
+    ([('event_time', ASCENDING)], {}),
+    ([('ingested_at', ASCENDING)], {}),
+    ([('_loaded_at', ASCENDING)], {}),
+    # Order history and per-type time range scans
+    ([('order_key', ASCENDING), ('event_time', ASCENDING)], {}),
+    ([('event_type', ASCENDING), ('event_time', ASCENDING)], {}),
+    ([('vendor', ASCENDING), ('event_time', ASCENDING)], {}),
+    ([('skus', ASCENDING), ('event_time', ASCENDING)], {}),
+]
+
+# Stored form of event_id: 'string' keeps the text, 'binary' packs hex ids into BinData
+# (20 bytes for a SHA-1 instead of a 40 character string, in the document and the unique index)
+EVENT_ID_FORMAT = configs['EVENT_ID_FORMAT']
+
+# WiredTiger block compressor of events_raw; only applies when the collection is created
+BLOCK_COMPRESSOR = configs['MONGO_BLOCK_COMPRESSOR']
+
+# Envelope timestamps stored as BSON dates (live events arrive as ISO strings)
+ENVELOPE_TIME_FIELDS = ('event_time', 'ingested_at')
+
+# Payload arrays holding line items or refunded items, across vendors and drift variants
+ITEM_ARRAY_FIELDS = ['items', 'line_items', 'refunded_items', 'items_refunded']
+
+# Duplicate deliveries seen by the loaders, one document per (source file, ingest date)
+DELIVERIES_COLLECTION = 'ingest_deliveries'
+
+# Lines of delivered files rejected by the decoder, one document per (source file, line)
+QUARANTINE_COLLECTION = 'events_quarantine'
+
+
+def ensure_events_raw_indexes(collection) -> None:
+    """Create the managed events_raw indexes (no-op for indexes that already exist)."""
+    for keys, options in EVENTS_RAW_INDEXES:
+        collection.create_index(keys, **options)
+
+
+def ensure_events_raw_collection(db):
+    """Return events_raw with its managed indexes, creating it with the configured block compressor."""
+    if BLOCK_COMPRESSOR and 'events_raw' not in db.list_collection_names():
+        try:
+            db.create_collection('events_raw', storageEngine={'wiredTiger': {'configString': f'block_compressor={BLOCK_COMPRESSOR}'}})
+        except CollectionInvalid:
+            pass  # Created by a concurrent loader
+    collection = db['events_raw']
+    ensure_events_raw_indexes(collection)
+    return collection
+
+
+def encode_event_id(event_id: Any, id_format: Optional[str] = None) -> Any:
+    """Stored form of an event_id; ids that are not lowercase hex are kept as strings."""
+    if (id_format or EVENT_ID_FORMAT) != 'binary' or not isinstance(event_id, str) or not event_id:
+        return event_id
+    try:
+        packed = bytes.fromhex(event_id)
+    except ValueError:
+        return event_id
+    return Binary(packed) if packed.hex() == event_id else event_id
+
+
+def decode_event_id(value: Any) -> Any:
+    """Text form of a stored event_id (pymongo returns BinData as bytes)."""
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def normalise_envelope_times(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Replace ISO string envelope timestamps by naive UTC datetimes; unparseable values are kept."""
+    for field in ENVELOPE_TIME_FIELDS:
+        value = event.get(field)
+        if isinstance(value, str):
+            parsed = parse_timestamp(value)
+            if parsed is not None:
+                event[field] = parsed
+    return event
+
+
+def ingest_date(event: Dict[str, Any]) -> Optional[str]:
+    """YYYY-MM-DD (UTC) of an event's ingested_at."""
+    ingested_at = parse_timestamp(event.get('ingested_at'))
+    return ingested_at.strftime('%Y-%m-%d') if ingested_at else None
+
+
+def record_deliveries(db, source: str, deliveries: Dict[str, Dict[str, int]]) -> None:
+    """
+    Store the duplicate deliveries of one load of a source file, per ingest date.
+
+    deliveries maps an ingest date to 'written' (distinct event_ids upserted),
+    'repeated' (lines repeating an event_id earlier in the file) and 'matched'
+    (written event_ids that were already stored). A reload matches every id the
+    earlier loads of the file wrote (bootstrap reloads under a new ingest date),
+    so only matches beyond those count as redeliveries and reloading a file, or
+    the day's growing live file, does not count it again.
+    """
+    collection = db[DELIVERIES_COLLECTION]
+    previous_loads = list(collection.find({'source': source}, {'_id': 0}))
+    loaded_before = sum(doc.get('written', 0) for doc in previous_loads)
+    for day, counts in deliveries.items():
+        key = {'source': source, 'ingest_date': day}
+        previous = next((doc for doc in previous_loads if doc['ingest_date'] == day), {})
+        redelivered = previous.get('redelivered', 0) + max(0, counts['matched'] - loaded_before)
+        collection.update_one(key, {'$set': {
+            'written': counts['written'],
+            'repeated': counts['repeated'],
+            'redelivered': redelivered,
+            'updated_at': datetime.now(),
+        }}, upsert=True)
+
+
+def duplicate_deliveries(db, day: str) -> Dict[str, int]:
+    """Repeated lines and redelivered events recorded for one ingest date, across sources."""
+    totals = {'repeated': 0, 'redelivered': 0}
+    for doc in db[DELIVERIES_COLLECTION].find({'ingest_date': day}, {'repeated': 1, 'redelivered': 1}):
+        totals['repeated'] += doc.get('repeated', 0)
+        totals['redelivered'] += doc.get('redelivered', 0)
+    return totals
+
+
+def quarantine_lines(db, source: str, invalid_lines: List[Dict[str, Any]]) -> int:
+    """
+    Keep the lines of a delivered file that the decoder rejected, with the reason and raw bytes.
+
+    A line is keyed by its source file and line number, so reloading a file (or the
+    day's growing live file) does not quarantine it twice. It is dated by the
+    ingested_at it carries when that still parses, and by the day it was first
+    rejected otherwise.
+    """
+    if not invalid_lines:
+        return 0
+    collection = db[QUARANTINE_COLLECTION]
+    collection.create_index([('source', ASCENDING), ('line', ASCENDING)], unique=True)
+    collection.create_index('ingest_date')
+    now = datetime.now()
+    operations = []
+    for invalid in invalid_lines:
+        raw = invalid.get('raw') or b''
+        try:
+            document = json.loads(raw)
+        except ValueError:
+            document = None
+        day = (ingest_date(document) if isinstance(document, dict) else None) or now.strftime('%Y-%m-%d')
+        operations.append(UpdateOne(
+            {'source': source, 'line': invalid['line']},
+            {'$set': {'reason': invalid['reason'], 'raw': Binary(raw)},
+             '$setOnInsert': {'ingest_date': day, 'quarantined_at': now}},
+            upsert=True
+        ))
+    collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def quarantined_lines(db, day: str) -> int:
+    """Rejected lines quarantined for one ingest date, across sources."""
+    return db[QUARANTINE_COLLECTION].count_documents({'ingest_date': day})
+
+
+def extract_skus(payload: Dict[str, Any]) -> List[str]:
+    """Return the distinct SKUs referenced by a payload's item arrays."""
+    skus = []
+    for field in ITEM_ARRAY_FIELDS:
+        for item in payload.get(field) or []:
+            sku = item.get('sku') or item.get('productSku')
+            if sku and sku not in skus:
+                skus.append(sku)
+    return skus
+
+
+def derive_query_keys(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Canonical top-level fields written next to the raw payload at ingest time."""
+    return {
+        'order_key': extract_order_id(payload),
+        'skus': extract_skus(payload),
+    }
+
+
+def get_order_history(order_key: str) -> List[Dict[str, Any]]:
+    """Return all raw events of an order in event_time order (index seek on order_key, event_time)."""
+    client = get_mongo_client()
+    collection = client[os.getenv('MONGO_DB')]['events_raw']
+    events = list(collection.find({'order_key': order_key}, {'_id': 0}).sort('event_time', ASCENDING))
+    client.close()
+    return events
+
+
+def backfill_query_keys(batch_size: int = 1000) -> Dict[str, int]:
+    """Derive order_key and skus for existing events_raw documents that predate them."""
+    client = get_mongo_client()
+    collection = client[os.getenv('MONGO_DB')]['events_raw']
+    ensure_events_raw_indexes(collection)
+
+    stats = {'scanned': 0, 'updated': 0}
+    bulk_operations = []
+    cursor = collection.find({'order_key': {'$exists': False}}, {'_id': 1, 'payload': 1}).batch_size(batch_size)
+    for doc in cursor:
+        stats['scanned'] += 1
+        bulk_operations.append(UpdateOne({'_id': doc['_id']}, {'$set': derive_query_keys(doc.get('payload') or {})}))
+        if len(bulk_operations) >= batch_size:
+            stats['updated'] += collection.bulk_write(bulk_operations, ordered=False).modified_count
+            bulk_operations = []
+
+    if bulk_operations:
+        stats['updated'] += collection.bulk_write(bulk_operations, ordered=False).modified_count
+
+    logging.info(f"Backfilled order_key/skus: {stats}")
+    client.close()
+    return stats
+
+
+def compact_document(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Fields of a stored document that differ from their configured compact form."""
+    changes = {}
+    stored_id = doc.get('event_id')
+    event_id = encode_event_id(decode_event_id(stored_id))
+    # The text round-trips exactly, so only the stored kind can differ
+    if isinstance(event_id, bytes) != isinstance(stored_id, bytes):
+        changes['event_id'] = event_id
+    for field, value in normalise_envelope_times({field: doc.get(field) for field in ENVELOPE_TIME_FIELDS}).items():
+        if value is not doc.get(field):
+            changes[field] = value
+    return changes
+
+
+def compaction_query() -> Dict[str, Any]:
+    """Documents stored in a form other than the configured one."""
+    id_type = 'string' if EVENT_ID_FORMAT == 'binary' else 'binData'
+    return {'$or': [{'event_id': {'$type': id_type}}] + [{field: {'$type': 'string'}} for field in ENVELOPE_TIME_FIELDS]}
+
+
+def compact_events_raw(batch_size: int = 1000, recompress: bool = False) -> Dict[str, int]:
+    """
+    Rewrite existing events_raw documents into the configured storage form: event_id in
+    EVENT_ID_FORMAT and envelope timestamps as dates. _loaded_at is left untouched, so
+    incremental jobs and the change stream sync do not pick the documents up again.
+
+    With recompress, the documents are copied into a new collection created with
+    MONGO_BLOCK_COMPRESSOR, which then replaces events_raw. Stop the loaders first:
+    writes to events_raw during the copy are lost.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    stats = {'scanned': 0, 'updated': 0, 'conflicts': 0}
+    if recompress:
+        stats.update(rebuild_events_raw(db, batch_size))
+        client.close()
+        logging.info(f"Rebuilt events_raw: {stats}")
+        return stats
+
+    collection = ensure_events_raw_collection(db)
+    bulk_operations = []
+    cursor = collection.find(compaction_query(), {'_id': 1, 'event_id': 1, **{field: 1 for field in ENVELOPE_TIME_FIELDS}}).batch_size(batch_size)
+    for doc in cursor:
+        stats['scanned'] += 1
+        changes = compact_document(doc)
+        if changes:
+            bulk_operations.append(UpdateOne({'_id': doc['_id']}, {'$set': changes}))
+        if len(bulk_operations) >= batch_size:
+            write_compacted(collection, bulk_operations, stats)
+            bulk_operations = []
+    if bulk_operations:
+        write_compacted(collection, bulk_operations, stats)
+
+    client.close()
+    logging.info(f"Compacted events_raw: {stats}")
+    return stats
+
+
+def write_compacted(collection, bulk_operations: List[UpdateOne], stats: Dict[str, int]) -> None:
+    try:
+        stats['updated'] += collection.bulk_write(bulk_operations, ordered=False).modified_count
+    except BulkWriteError as e:
+        # The event is already stored under its converted id (loaded after EVENT_ID_FORMAT changed)
+        stats['updated'] += e.details.get('nModified', 0)
+        stats['conflicts'] += len(e.details.get('writeErrors', []))
+        logging.warning(f"{len(e.details.get('writeErrors', []))} event_id(s) already stored in converted form; kept both documents")
+
+
+def rebuild_events_raw(db, batch_size: int) -> Dict[str, int]:
+    """Copy events_raw in compact form into a collection with the configured block compressor and swap it in."""
+    stats = {'scanned': 0, 'updated': 0, 'conflicts': 0}
+    target_name = 'events_raw_rebuild'
+    db.drop_collection(target_name)
+    options = {'storageEngine': {'wiredTiger': {'configString': f'block_compressor={BLOCK_COMPRESSOR}'}}} if BLOCK_COMPRESSOR else {}
+    target = db.create_collection(target_name, **options)
+    ensure_events_raw_indexes(target)
+
+    batch = []
+    for doc in db['events_raw'].find({}).batch_size(batch_size):
+        stats['scanned'] += 1
+        changes = compact_document(doc)
+        stats['updated'] += bool(changes)
+        batch.append({**doc, **changes})
+        if len(batch) >= batch_size:
+            stats['conflicts'] += insert_rebuilt(target, batch)
+            batch = []
+    if batch:
+        stats['conflicts'] += insert_rebuilt(target, batch)
+
+    target.rename('events_raw', dropTarget=True)
+    return stats
+
+
+def insert_rebuilt(collection, documents: List[Dict[str, Any]]) -> int:
+    """Insert a batch into the rebuild collection; returns the documents dropped as duplicate event_ids."""
+    try:
+        collection.insert_many(documents, ordered=False)
+        return 0
+    except BulkWriteError as e:
+        return len(e.details.get('writeErrors', []))
+
+
+def document_bytes(doc: Dict[str, Any]) -> int:
+    return len(bson.encode(doc))
+
+
+def storage_report(sample_size: int = 1000) -> Dict[str, Any]:
+    """
+    Bytes per events_raw document: BSON size of a sample as stored, in the text form
+    (hex string event_id, ISO string live timestamps) and in the compact form (BinData
+    event_id, dates), plus the data, on-disk and index sizes where the server reports them.
+    """
+    client = get_mongo_client()
+    db = client[os.getenv('MONGO_DB')]
+    collection = db['events_raw']
+    sample = list(collection.find({}).limit(sample_size))
+    report = {'events': collection.estimated_document_count(), 'sampled': len(sample)}
+
+    stored = text = compact = 0
+    for doc in sample:
+        stored += document_bytes(doc)
+        text_doc = {**doc, 'event_id': decode_event_id(doc.get('event_id'))}
+        if not doc.get('_bootstrapped'):
+            for field in ENVELOPE_TIME_FIELDS:
+                if isinstance(doc.get(field), datetime):
+                    text_doc[field] = doc[field].strftime('%Y-%m-%dT%H:%M:%SZ')
+        text += document_bytes(text_doc)
+        compact_doc = normalise_envelope_times({**doc, 'event_id': encode_event_id(decode_event_id(doc.get('event_id')), 'binary')})
+        compact += document_bytes(compact_doc)
+    if sample:
+        report['bson_bytes_per_event'] = {
+            'stored': round(stored / len(sample), 1),
+            'text_form': round(text / len(sample), 1),
+            'compact_form': round(compact / len(sample), 1),
+        }
+
+    try:
+        coll_stats = db.command({'collStats': 'events_raw'})
+        count = coll_stats.get('count') or 1
+        report['collection'] = {
+            'data_bytes_per_event': round(coll_stats['size'] / count, 1),
+            'disk_bytes_per_event': round(coll_stats['storageSize'] / count, 1),
+            'index_bytes_per_event': round(coll_stats['totalIndexSize'] / count, 1),
+            'event_id_index_bytes_per_event': round(coll_stats.get('indexSizes', {}).get('event_id_1', 0) / count, 1),
+            'block_compressor': block_compressor_of(coll_stats),
+        }
+    except (OperationFailure, NotImplementedError, KeyError) as e:
+        logging.info(f"collStats not available: {e}")
+    report['event_id_format'] = EVENT_ID_FORMAT
+    report['wire_compressors'] = configs['MONGO_COMPRESSORS'] or 'none'
+    client.close()
+    return report
+
+
+def block_compressor_of(coll_stats: Dict[str, Any]) -> Optional[str]:
+    creation = coll_stats.get('wiredTiger', {}).get('creationString', '')
+    for option in creation.split(','):
+        if option.startswith('block_compressor='):
+            return option.split('=', 1)[1] or 'none'
+    return None
+
+
+def print_storage_report(report: Dict[str, Any], title: str = "events_raw Storage") -> None:
+    print(f"{title}: {report['events']:,} events (event_id format: {report['event_id_format']}, wire compression: {report['wire_compressors']})")
+    sizes = report.get('bson_bytes_per_event')
+    if sizes:
+        print(f"  BSON bytes/event over {report['sampled']:,} sampled: stored {sizes['stored']}, "
+              f"text form {sizes['text_form']}, compact form {sizes['compact_form']}")
+    collection = report.get('collection')
+    if collection:
+        print(f"  Collection bytes/event: data {collection['data_bytes_per_event']}, on disk {collection['disk_bytes_per_event']} "
+              f"({collection['block_compressor'] or 'default'} blocks), indexes {collection['index_bytes_per_event']} "
+              f"(event_id {collection['event_id_index_bytes_per_event']})")
@@ -0,0 +1,120 @@
+import logging
+from datetime import datetime
+from typing import Dict, Any, FrozenSet, List, NamedTuple, Optional, Tuple
+from pymongo import UpdateOne
+from src.payload_schemas import CANONICAL_PAYLOAD_KEYS, DRIFT_RENAMES, EXTRACTION_PLANS
+
+FINGERPRINT_COLLECTION = 'schema_fingerprints'
+
+
+class PayloadVariant(NamedTuple):
+    vendor: str
+    event_type: str
+    variant: str
+    plan: Dict[str, Tuple]
+
+
+def payload_fingerprint(payload: Dict[str, Any]) -> FrozenSet[str]:
+    """Key-set fingerprint of a payload; key order and values do not matter."""
+    return frozenset(payload)
+
+
+def fingerprint_label(fingerprint: FrozenSet[str]) -> str:
+    return ','.join(sorted(fingerprint))
+
+
+def extract_path(payload: Dict[str, Any], path: Tuple) -> Any:
+    """Follow a plan path of keys and list positions; None when any step is missing."""
+    value = payload
+    for step in path:
+        if isinstance(step, int):
+            if not isinstance(value, list) or not value:
+                return None
+            value = value[step]
+        elif isinstance(value, dict):
+            value = value.get(step)
+        else:
+            return None
+    return value
+
+
+class SchemaRegistry:
+    """
+    Dispatch table from (event_type, payload fingerprint) to a known vendor variant.
+
+    Recognising a payload is one dict lookup whatever the number of variants;
+    fingerprints that match nothing are counted for drift reporting.
+    """
+
+    def __init__(self):
+        self.variants: Dict[Tuple[str, FrozenSet[str]], PayloadVariant] = {}
+        self.seen: Dict[Tuple[str, FrozenSet[str]], int] = {}
+        self.unseen: Dict[Tuple[str, Optional[str], FrozenSet[str]], int] = {}
+
+    def register(self, vendor: str, event_type: str, variant: str, keys, plan: Dict[str, Tuple]) -> None:
+        self.variants[(event_type, frozenset(keys))] = PayloadVariant(vendor, event_type, variant, plan)
+
+    def dispatch(self, event_type: str, payload: Dict[str, Any], vendor: Optional[str] = None) -> Optional[PayloadVariant]:
+        """Known variant of a payload, or None (and the fingerprint is counted as unseen)."""
+        key = (event_type, payload_fingerprint(payload))
+        variant = self.variants.get(key)
+        if variant is None:
+            key = (event_type, vendor, key[1])
+            self.unseen[key] = self.unseen.get(key, 0) + 1
+        else:
+            self.seen[key] = self.seen.get(key, 0) + 1
+        return variant
+
+    def extract(self, variant: PayloadVariant, payload: Dict[str, Any], field: str) -> Any:
+        path = variant.plan.get(field)
+        return extract_path(payload, path) if path else None
+
+    def flush_counts(self, db) -> int:
+        """Add the fingerprint counts collected since the last flush to the fingerprint collection."""
+        now = datetime.now()
+        operations = []
+        seen = {(event_type, self.variants[(event_type, fingerprint)].vendor, fingerprint): count
+                for (event_type, fingerprint), count in self.seen.items()}
+        for counts, known in ((seen, True), (self.unseen, False)):
+            for (event_type, vendor, fingerprint), count in counts.items():
+                label = fingerprint_label(fingerprint)
+                operations.append(UpdateOne(
+                    {'event_type': event_type, 'fingerprint': label},
+                    {
+                        '$inc': {'count': count},
+                        '$set': {'known': known, 'vendor': vendor, 'keys': sorted(fingerprint), 'last_seen': now},
+                        '$setOnInsert': {'first_seen': now},
+                    },
+                    upsert=True
+                ))
+        if operations:
+            db[FINGERPRINT_COLLECTION].bulk_write(operations, ordered=False)
+        if self.unseen:
+            logging.warning(f"Unseen payload fingerprints: {sum(self.unseen.values())} event(s) in {len(self.unseen)} shape(s)")
+        self.seen.clear()
+        self.unseen.clear()
+        return len(operations)
+
+
+def build_registry() -> SchemaRegistry:
+    """Registry of every canonical shape and its generator drift variant."""
+    registry = SchemaRegistry()
+    for (vendor, event_type), keys in CANONICAL_PAYLOAD_KEYS.items():
+        plan = EXTRACTION_PLANS[(vendor, event_type)]
+        registry.register(vendor, event_type, 'canonical', keys, plan)
+        renames = DRIFT_RENAMES.get((vendor, event_type))
+        if renames:
+            drifted_keys = {renames.get(key, key) for key in keys}
+            drifted_plan = {field: (renames.get(path[0], path[0]),) + path[1:] for field, path in plan.items()}
+            registry.register(vendor, event_type, 'drift', drifted_keys, drifted_plan)
+    return registry
+
+
+def drift_report(db, unknown_only: bool = True) -> List[Dict[str, Any]]:
+    """Recorded fingerprints, most frequent first."""
+    query = {'known': False} if unknown_only else {}
+    return list(db[FINGERPRINT_COLLECTION].find(query, {'_id': 0}).sort('count', -1))
+
+
+# Shared registry used by the loaders
+REGISTRY = build_registry()
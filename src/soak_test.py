@@ -0,0 +1,290 @@
+"""
+Sustained-rate soak test of the live event loader.
+
+A producer thread appends generated events to data/live_events/<date>/events.jsonl
+at a fixed rate while the loader tails the file and upserts the new lines into
+events_raw. The run records, per event, the time from being appended to being
+queryable in MongoDB (bulk write acknowledged), the backlog and the process
+memory every second, and checks the lag against an SLO.
+
+Usage:
+  python src/soak_test.py --rate 200 --duration 300 --slo-p99 5
+Options:
+  --dup-rate 0.05 --late-rate 0.10 --schema-drift-rate 0.15
+  --batch-size 1000 --poll-interval 0.5 --out data/live_events --date 2026-01-20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import numpy as np
+
+if __name__ == '__main__':
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.DB_connection import get_mongo_client
+from src.event_decoder import decode_events_data
+from src.live_event_generator import generate_event
+from src.live_event_loader import load_events_to_mongo
+from src.raw_zone import encode_event_id
+
+SOAK_REPORT_DIR = 'data/soak'
+
+# Seconds between two producer writes; each write catches up with the target rate
+PRODUCER_TICK = 0.05
+
+# Seconds the loader may take to drain the backlog once the producer stops
+DEFAULT_DRAIN_TIMEOUT = 60.0
+
+# Backlog growth (events/s, as a fraction of the producer rate) above which the loader is falling behind
+MAX_BACKLOG_GROWTH = 0.02
+
+LAG_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def rss_mb() -> float:
+    """Resident memory of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RateProducer(threading.Thread):
+    """Appends generated events to the live events file at rate events per second."""
+
+    def __init__(self, out_path: Path, rate: float, duration: float, dup_rate: float,
+                 late_rate: float, schema_drift_rate: float, seed: int):
+        super().__init__(name='soak-producer', daemon=True)
+        self.out_path = out_path
+        self.rate = rate
+        self.duration = duration
+        self.rates = (dup_rate, late_rate, schema_drift_rate)
+        self.seed = seed
+        # Append time of every line written, in file order; recorded before the lines
+        # reach the file, so the loader never reads a line without its time
+        self.produced_at: List[float] = []
+        self.lock = threading.Lock()
+        self.event_ids = set()
+        self.order_pool: List[str] = []
+        self.new_orders: List[str] = []
+        self.next_order = 1
+        self.done = threading.Event()
+
+    def refill_orders(self) -> None:
+        prefix = f"ORD-SOAK-{datetime.now().strftime('%y%m%d%H%M%S')}"
+        ids = [f"{prefix}-{number:06d}" for number in range(self.next_order, self.next_order + 500)]
+        self.next_order += 500
+        self.new_orders.extend(ids)
+        self.order_pool.extend(ids)
+
+    def generate(self) -> List[Dict[str, Any]]:
+        if len(self.new_orders) < 10:
+            self.refill_orders()
+        now = datetime.utcnow().replace(microsecond=0)
+        return generate_event(now, now, self.order_pool, self.new_orders, *self.rates, ingested_at=now)
+
+    def run(self) -> None:
+        # The generator draws from the module-level random, used only by this thread during the run
+        random.seed(self.seed)
+        self.out_path.parent.mkdir(parents=True, exist_ok=True)
+        started = time.time()
+        written = 0
+        with self.out_path.open('a', encoding='utf-8') as f:
+            while True:
+                elapsed = time.time() - started
+                if elapsed >= self.duration:
+                    break
+                lines = []
+                while written + len(lines) < self.rate * elapsed:
+                    for event in self.generate():
+                        self.event_ids.add(event['event_id'])
+                        lines.append(json.dumps(event) + '\n')
+                if lines:
+                    with self.lock:
+                        self.produced_at.extend([time.time()] * len(lines))
+                    f.writelines(lines)
+                    f.flush()
+                    written += len(lines)
+                time.sleep(PRODUCER_TICK)
+        self.done.set()
+
+    def append_times(self, start: int, stop: int) -> List[float]:
+        """Append times of lines start..stop of the file."""
+        with self.lock:
+            return self.produced_at[start:stop]
+
+
+class TailingLoader:
+    """Loads the lines appended to the live events file since the last poll through the live loader."""
+
+    def __init__(self, path: Path, batch_size: int):
+        self.path = path
+        self.batch_size = batch_size
+        self.offset = path.stat().st_size if path.exists() else 0
+        self.loaded_lines = 0
+        self.lags: List[float] = []
+
+    def poll(self, producer: RateProducer) -> int:
+        if not self.path.exists():
+            return 0
+        with self.path.open('rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Only complete lines; a partial last line is read again on the next poll
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return 0
+        self.offset += end
+        lines = data[:end].count(b'\n')
+        events, _ = decode_events_data(data[:end], self.path)
+        if events:
+            load_events_to_mongo(events, self.batch_size)
+        queryable_at = time.time()
+        self.lags.extend(queryable_at - produced for produced in producer.append_times(self.loaded_lines, self.loaded_lines + lines))
+        self.loaded_lines += lines
+        return lines
+
+
+def count_missing(event_ids: set) -> int:
+    """Produced event_ids that cannot be found in events_raw."""
+    client = get_mongo_client()
+    collection = client[os.getenv('MONGO_DB')]['events_raw']
+    ids = [encode_event_id(event_id) for event_id in event_ids]
+    found = 0
+    for start in range(0, len(ids), 10000):
+        found += collection.count_documents({'event_id': {'$in': ids[start:start + 10000]}})
+    client.close()
+    return len(ids) - found
+
+
+def run_soak_test(
+    rate: float,
+    duration: float,
+    slo_p99_seconds: float,
+    out_dir: str = 'data/live_events',
+    date: Optional[str] = None,
+    dup_rate: float = 0.05,
+    late_rate: float = 0.10,
+    schema_drift_rate: float = 0.15,
+    batch_size: int = 1000,
+    poll_interval: float = 0.5,
+    drain_timeout: float = DEFAULT_DRAIN_TIMEOUT,
+    seed: int = 42,
+) -> Dict[str, Any]:
+    """Run producer and loader concurrently for duration seconds and evaluate the lag SLO."""
+    date = date or datetime.now().strftime('%Y-%m-%d')
+    out_path = Path(out_dir) / date / 'events.jsonl'
+    producer = RateProducer(out_path, rate, duration, dup_rate, late_rate, schema_drift_rate, seed)
+    loader = TailingLoader(out_path, batch_size)
+
+    timeline = []
+    memory_start = rss_mb()
+    started = time.time()
+    next_sample = started
+    producer.start()
+    while True:
+        producer_done = producer.done.is_set()
+        loader.poll(producer)
+        now = time.time()
+        if now >= next_sample:
+            recent = loader.lags[-int(rate) or -1:]
+            timeline.append({
+                'second': round(now - started, 1),
+                'produced': len(producer.produced_at),
+                'loaded': loader.loaded_lines,
+                'backlog': len(producer.produced_at) - loader.loaded_lines,
+                'rss_mb': round(rss_mb(), 1),
+                'recent_lag_p99': round(float(np.quantile(recent, 0.99)), 3) if recent else None,
+            })
+            next_sample = now + 1.0
+        if producer_done and loader.loaded_lines >= len(producer.produced_at):
+            break
+        if producer_done and now - started > duration + drain_timeout:
+            print(f"Soak test: backlog of {len(producer.produced_at) - loader.loaded_lines} line(s) not drained within {drain_timeout}s")
+            break
+        time.sleep(poll_interval)
+
+    lags = np.array(loader.lags)
+    # Backlog growth while the producer ran: slope of backlog over time
+    running = [point for point in timeline if point['second'] <= duration]
+    backlog_growth = 0.0
+    if len(running) >= 2:
+        backlog_growth = float(np.polyfit([p['second'] for p in running], [p['backlog'] for p in running], 1)[0])
+    lag_summary = {f"p{q * 100:g}": round(float(np.quantile(lags, q)), 3) for q in LAG_QUANTILES} if len(lags) else {}
+    lag_summary['max'] = round(float(lags.max()), 3) if len(lags) else None
+    missing = count_missing(producer.event_ids)
+
+    checks = {
+        'lag_p99_within_slo': bool(len(lags)) and lag_summary['p99'] <= slo_p99_seconds,
+        'backlog_not_growing': backlog_growth <= MAX_BACKLOG_GROWTH * rate,
+        'all_events_queryable': missing == 0 and loader.loaded_lines >= len(producer.produced_at),
+    }
+    return {
+        'file': str(out_path),
+        'target_rate': rate,
+        'achieved_rate': round(len(producer.produced_at) / duration, 1),
+        'duration_seconds': duration,
+        'produced_lines': len(producer.produced_at),
+        'loaded_lines': loader.loaded_lines,
+        'missing_events': missing,
+        'lag_seconds': lag_summary,
+        'backlog': {
+            'max': max((p['backlog'] for p in timeline), default=0),
+            'growth_per_second': round(backlog_growth, 2),
+        },
+        'memory_mb': {
+            'start': round(memory_start, 1),
+            'peak': max((p['rss_mb'] for p in timeline), default=memory_start),
+            'end': round(rss_mb(), 1),
+        },
+        'slo': {'lag_p99_seconds': slo_p99_seconds, 'max_backlog_growth_per_second': MAX_BACKLOG_GROWTH * rate},
+        'checks': checks,
+        'passed': all(checks.values()),
+        'timeline': timeline,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test the live event loader against a rate-controlled producer.')
+    parser.add_argument('--rate', type=float, default=100, help='Events per second appended by the producer')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds the producer runs')
+    parser.add_argument('--slo-p99', type=float, default=5.0, help='p99 append-to-queryable lag SLO in seconds')
+    parser.add_argument('--out', default='data/live_events', help='Live events root directory')
+    parser.add_argument('--date', default=None, help='YYYY-MM-DD of the events file; default=today')
+    parser.add_argument('--dup-rate', type=float, default=0.05)
+    parser.add_argument('--late-rate', type=float, default=0.10)
+    parser.add_argument('--schema-drift-rate', type=float, default=0.15)
+    parser.add_argument('--batch-size', type=int, default=1000, help='Loader bulk write batch size')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='Seconds between loader polls of the file')
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    # The loader logs every batch and every duplicate; keep the soak output to the summary
+    logging.getLogger().setLevel(logging.ERROR)
+    report = run_soak_test(
+        args.rate, args.duration, args.slo_p99, args.out, args.date, args.dup_rate, args.late_rate,
+        args.schema_drift_rate, args.batch_size, args.poll_interval, args.drain_timeout, args.seed,
+    )
+
+    os.makedirs(SOAK_REPORT_DIR, exist_ok=True)
+    report_path = os.path.join(SOAK_REPORT_DIR, f"soak_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: value for key, value in report.items() if key != 'timeline'}, indent=2))
+    print(f"Soak test {'PASSED' if report['passed'] else 'FAILED'}; report written to {report_path}")
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from pathlib import Path
+from datetime import datetime, timezone
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 
 def load_json_file(file_path: Path) -> List[Dict[str, Any]]:
@@ -23,3 +24,57 @@ def load_json_file(file_path: Path) -> List[Dict[str, Any]]:
                     records.append(json.loads(line))
             return records
     return []  # Return empty list if no data found
+
+
+# Timestamp formats seen across vendor payloads and live event envelopes
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y/%m/%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+]
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """Parse a datetime, ISO-like string or Unix epoch into a naive UTC datetime (None if unparseable)."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, tz=timezone.utc).replace(tzinfo=None)
+    if isinstance(value, str):
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+        try:
+            return parse_timestamp(datetime.fromisoformat(value))
+        except ValueError:
+            return None
+    return None
+
+
+def first_present(payload: Dict[str, Any], keys: List[str]) -> Any:
+    """Return the first non-null value among alternative field names of a payload."""
+    for key in keys:
+        value = payload.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def extract_order_id(payload: Dict[str, Any]) -> Optional[str]:
+    """Return the order reference of any vendor payload (orderRef, order_id, order or order.id)."""
+    order_id = payload.get('orderRef') or payload.get('order_id')
+    if order_id:
+        return order_id
+    order = payload.get('order')
+    if isinstance(order, dict):
+        return order.get('id')
+    return order or None
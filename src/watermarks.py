@@ -0,0 +1,54 @@
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+# Collection holding one high-water mark per incremental job
+WATERMARK_COLLECTION = 'pipeline_watermarks'
+
+# Loaders stamp every upserted document with _loaded_at. The generator's ingested_at
+# is simulated (and a string for live events), so it cannot order loads reliably.
+WATERMARK_FIELD = '_loaded_at'
+
+# Update operator stamping _loaded_at with the server clock as each document is written.
+# A client-side datetime.now() taken while a batch is built can land behind a watermark
+# already advanced past it by a concurrent loader, and that document would never be read.
+LOADED_AT_STAMP = {'$currentDate': {WATERMARK_FIELD: True}}
+
+
+def get_watermark(db, job_name: str) -> Optional[datetime]:
+    """Return the last processed load time for a job, or None if the job has never run."""
+    doc = db[WATERMARK_COLLECTION].find_one({'_id': job_name})
+    return doc['watermark'] if doc else None
+
+
+def set_watermark(db, job_name: str, watermark: datetime) -> None:
+    """Persist the high-water mark of a job after a successful run."""
+    # Watermarks folded from a snapshot DataFrame arrive as pandas Timestamps
+    if hasattr(watermark, 'to_pydatetime'):
+        watermark = watermark.to_pydatetime()
+    db[WATERMARK_COLLECTION].update_one(
+        {'_id': job_name},
+        {'$set': {'watermark': watermark, 'updated_at': datetime.now()}},
+        upsert=True
+    )
+
+
+def reset_watermark(db, job_name: str) -> None:
+    """Forget the high-water mark of a job, so its next run starts from the beginning."""
+    db[WATERMARK_COLLECTION].delete_one({'_id': job_name})
+
+
+def loaded_after_query(since: Optional[datetime]) -> Dict[str, Any]:
+    """Build an events_raw filter for documents loaded after a watermark (all documents if None)."""
+    if since is None:
+        return {}
+    return {WATERMARK_FIELD: {'$gt': since}}
+
+
+def max_loaded_at(current: Optional[datetime], doc: Dict[str, Any]) -> Optional[datetime]:
+    """Fold a document's _loaded_at into a running maximum."""
+    loaded_at = doc.get(WATERMARK_FIELD)
+    if loaded_at is None:
+        return current
+    if current is None or loaded_at > current:
+        return loaded_at
+    return current
@@ -0,0 +1,80 @@
+from datetime import datetime
+import pandas as pd
+from src.analytics.revenue_history import MEASURES, VERSION_COLUMNS, VERSION_KEY, build_versions, history_lines
+
+DAY = 20260119
+T1 = datetime(2026, 1, 19, 10)
+T2 = datetime(2026, 1, 20, 9)
+T3 = datetime(2026, 1, 22, 15)
+
+
+def deltas(*rows):
+    """Summed measures per key and known_at: (known_at, gross_revenue, refunded_amount, orders, refunds)."""
+    return pd.DataFrame([
+        {'date_id': DAY, 'currency': 'NGN', 'vendor_id': 'vendor_a', 'known_at': known_at,
+         **dict(zip(MEASURES, measures))}
+        for known_at, *measures in rows
+    ], columns=VERSION_KEY + ['known_at'] + MEASURES)
+
+
+def stored(*rows):
+    """Stored versions: (known_from, known_to, gross_revenue, refunded_amount, orders, refunds)."""
+    return pd.DataFrame([
+        {'date_id': DAY, 'currency': 'NGN', 'vendor_id': 'vendor_a', 'known_from': known_from, 'known_to': known_to,
+         **dict(zip(MEASURES, measures))}
+        for known_from, known_to, *measures in rows
+    ], columns=VERSION_COLUMNS)
+
+
+def timeline(versions):
+    """(known_from, known_to, gross_revenue, refunded_amount, orders, refunds) of each version, in time order."""
+    return [
+        (row.known_from, None if pd.isna(row.known_to) else row.known_to,
+         row.gross_revenue, row.refunded_amount, row.orders, row.refunds)
+        for row in versions.sort_values('known_from').itertuples()
+    ]
+
+
+def test_in_order_events_close_the_current_version_and_append():
+    first = build_versions(stored(), deltas((T1, 100.0, 0.0, 1, 0)))
+    assert timeline(first) == [(T1, None, 100.0, 0.0, 1, 0)]
+
+    second = build_versions(first, deltas((T2, 0.0, 30.0, 0, 1)))
+    assert timeline(second) == [
+        (T1, T2, 100.0, 0.0, 1, 0),
+        (T2, None, 100.0, 30.0, 1, 1),
+    ]
+
+
+def test_late_known_event_restates_the_versions_after_it():
+    existing = stored((T1, T3, 100.0, 0.0, 1, 0), (T3, None, 150.0, 0.0, 2, 0))
+    versions = build_versions(existing, deltas((T2, 0.0, 30.0, 0, 1)))
+    assert timeline(versions) == [
+        (T1, T2, 100.0, 0.0, 1, 0),
+        (T2, T3, 100.0, 30.0, 1, 1),
+        (T3, None, 150.0, 30.0, 2, 1),
+    ]
+
+
+def test_redelivered_event_is_counted_once():
+    event = {
+        'event_id': 'evt-1', 'event_type': 'order_created', 'event_time': '2026-01-19T09:40:00Z',
+        'ingested_at': '2026-01-19T10:00:00Z', 'vendor': 'vendor_a',
+        'payload': {'order_id': 'ORD-1', 'currency': 'NGN', 'total': 100},
+    }
+    redelivered = {**event, 'event_id': 'evt-2', 'ingested_at': '2026-01-20T09:00:00Z'}
+    lines = history_lines([event, redelivered])
+    assert len(lines) == 1
+
+    new = lines.groupby(VERSION_KEY + ['known_at'], as_index=False)[MEASURES].sum()
+    assert timeline(build_versions(stored(), new)) == [(T1, None, 100.0, 0.0, 1, 0)]
+
+
+def test_bootstrapped_events_are_known_from_their_event_time():
+    event = {
+        'event_id': 'hist-1', 'event_type': 'historical_order', 'event_time': '2023-03-04T12:00:00',
+        'ingested_at': '2026-01-18T08:00:00', 'vendor': 'vendor_b', '_bootstrapped': True,
+        'payload': {'order_id': 'ORD-2023-1', 'currency': 'NGN', 'total': 50},
+    }
+    lines = history_lines([event])
+    assert lines['known_at'].tolist() == [datetime(2023, 3, 4, 12)]